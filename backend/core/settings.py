@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'insights.metrics.ServerTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -136,3 +137,203 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
+
+# JSON responses are written by orjson (insights.renderers.FastJSONRenderer)
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'insights.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# numeric values are sent as exact strings ("12.50"); True sends them as
+# JSON numbers, which clients read as doubles and may round
+INSIGHTS_DECIMAL_AS_FLOAT = False
+
+# Pooled connections to the databases queried through the insights API
+INSIGHTS_POOL = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'MAX_IDLE_SECONDS': 300,
+    'HEALTH_CHECK_INTERVAL': 30,
+    'ACQUIRE_TIMEOUT': 10,
+}
+
+# Rows fetched per round trip when /api/raw-sql/ streams a result
+INSIGHTS_STREAM_BATCH_SIZE = 2000
+
+# Per-connection schema cache, revalidated against a catalog fingerprint.
+# REVALIDATE_SECONDS > 0 serves entries without the fingerprint round trip
+# for that long after they were last validated.
+INSIGHTS_SCHEMA_CACHE = {
+    'MAX_ENTRIES': 64,
+    'REVALIDATE_SECONDS': 0,
+}
+
+# Natural-language-to-SQL generations, cached in memory and persisted to SQLite
+INSIGHTS_GENERATION_CACHE = {
+    'PATH': BASE_DIR / 'nl2sql_cache.sqlite3',
+    'MAX_ENTRIES': 1024,
+    'TTL_SECONDS': 7 * 24 * 3600,
+}
+
+# /api/export/: CSV is copied out of Postgres in CSV_CHUNK_BYTES pieces with at
+# most MAX_BUFFERED_CHUNKS waiting for the client; Arrow and Parquet are written
+# one ROW_GROUP_SIZE batch (record batch or row group) at a time. Exports run
+# under STATEMENT_TIMEOUT_MS rather than the raw-SQL timeouts, as a COPY lasts
+# as long as the download, slow clients included, and a COPY that sends nothing
+# for FIRST_CHUNK_TIMEOUT_SECONDS is cancelled. Exports take MAX_CONCURRENT
+# slots per database of their own (queueing as INSIGHTS_QUERY_LIMITS does), so
+# long downloads never hold up interactive queries
+INSIGHTS_EXPORT = {
+    'STATEMENT_TIMEOUT_MS': 600000,
+    'FIRST_CHUNK_TIMEOUT_SECONDS': 120,
+    'MAX_CONCURRENT': 2,
+    'MAX_QUEUED': 4,
+    'QUEUE_TIMEOUT': 5,
+    'CSV_CHUNK_BYTES': 65536,
+    'MAX_BUFFERED_CHUNKS': 16,
+    'ROW_GROUP_SIZE': 100000,
+    'PARQUET_COMPRESSION': 'snappy',
+}
+
+# Catalog bulk import (/query/import/<model>/ and import_catalog): records
+# validated and written per batch, and how many row errors a response lists
+QUERING_IMPORT = {
+    'BATCH_SIZE': 5000,
+    'MAX_ERRORS': 100,
+}
+
+# Monthly partitions of quering_analytics and quering_watchhistory, kept by
+# manage_partitions: months created ahead of the current one, and months of
+# data kept (None keeps every month)
+QUERING_PARTITIONS = {
+    'MONTHS_AHEAD': 3,
+    'RETENTION_MONTHS': None,
+}
+
+# Rollup tables (refresh_rollups): each refresh also recomputes the last
+# SETTLE_DAYS days, picking up late commits and recent updates
+QUERING_ROLLUPS = {
+    'SETTLE_DAYS': 2,
+}
+
+# Results of read-only SELECTs sent with "cache": true to /api/raw-sql/
+INSIGHTS_RESULT_CACHE = {
+    'MAX_ENTRIES': 256,
+    'MAX_ROWS': 200000,
+    'MAX_ROWS_PER_ENTRY': 10000,
+    'TTL_SECONDS': 60,
+}
+
+# Server-side paging of /api/raw-sql/ results
+INSIGHTS_PAGINATION = {
+    'MAX_PAGE_SIZE': 10000,
+}
+
+# Schema context sent with NL-to-SQL prompts; larger schemas are pruned to the most relevant tables
+INSIGHTS_SCHEMA_PROMPT = {
+    'MAX_TABLES': 12,
+    'TOKEN_BUDGET': 3000,
+}
+
+# Rollup tables the NL-to-SQL prompt points the model to when they are in the
+# target schema and a question's time grain (and topic) matches: grain is the
+# period one row covers, sources the tables the rollup aggregates and distinct
+# the distinct-count columns, which cannot be summed across rows
+INSIGHTS_ROLLUPS = [
+    {
+        'table': 'quering_analytics_daily',
+        'grain': 'day',
+        'sources': ['quering_analytics'],
+        'distinct': ['users'],
+        'description': 'playback events, distinct users, movie and episode events per day and event type',
+    },
+    {
+        'table': 'quering_payment_monthly',
+        'grain': 'month',
+        'sources': ['quering_payment'],
+        'distinct': ['payers'],
+        'description': 'payment count, revenue and distinct payers per month, subscription plan and status',
+    },
+    {
+        'table': 'quering_movie_watch_daily',
+        'grain': 'day',
+        'sources': ['quering_watchhistory'],
+        'distinct': ['viewers'],
+        'description': 'movie views, completed views and distinct viewers per day and movie',
+    },
+]
+
+# Guards on queries run through /api/raw-sql/: statement timeouts (a Connection
+# record's statement_timeout_ms takes precedence over the default, and is
+# re-read at most every TIMEOUT_CACHE_SECONDS) and a cap on concurrent queries
+# per target database, with a short queue before a 429
+INSIGHTS_QUERY_LIMITS = {
+    'DEFAULT_STATEMENT_TIMEOUT_MS': 30000,
+    'MAX_STATEMENT_TIMEOUT_MS': 300000,
+    'TIMEOUT_CACHE_SECONDS': 60,
+    'MAX_CONCURRENT': 4,
+    'MAX_QUEUED': 16,
+    'QUEUE_TIMEOUT': 5,
+}
+
+# Visualizations: common result shapes are charted by rule (USE_RULES); for the
+# rest the model sees the dataset's profile and SAMPLE_ROWS rows. Charts are
+# downsampled to MAX_POINTS points unless a request sends its own max_points.
+INSIGHTS_VISUALIZATION = {
+    'USE_RULES': True,
+    'SAMPLE_ROWS': 20,
+    'MAX_POINTS': 1000,
+}
+
+# /api/ask/: rows sent in the first rows event, rows read for charting, and
+# how many times a query the database rejects is sent back to the model
+INSIGHTS_PIPELINE = {
+    'PREVIEW_ROWS': 100,
+    'MAX_ROWS': 100000,
+    'RETRIES': 1,
+}
+
+# LLM calls: a pluggable backend behind one process-wide client; rate limits and
+# server errors are retried with jittered exponential backoff
+INSIGHTS_LLM = {
+    'BACKEND': 'insights.llm.GroqBackend',
+    'MAX_RETRIES': 3,
+    'BACKOFF_BASE_SECONDS': 0.5,
+    'BACKOFF_MAX_SECONDS': 8.0,
+    'TIMEOUT': 30,
+}
+
+# Generated SQL is checked against the cached schema before it is returned:
+# identifiers within MATCH_CUTOFF similarity of exactly one real table or column
+# are fixed locally, and what cannot be fixed is sent back to the model up to
+# MODEL_RETRIES times
+INSIGHTS_SQL_VALIDATION = {
+    'ENABLED': True,
+    'MATCH_CUTOFF': 0.8,
+    'MODEL_RETRIES': 1,
+}
+
+# Cost guard: queries are EXPLAINed before they run and the plan summary is
+# returned with the results. Plans over WARN_* get warnings, plans over MAX_*
+# (None to allow any) are refused, sequential scans of tables with at least
+# LARGE_TABLE_ROWS rows are pointed out. SELECTs without a LIMIT of their own
+# return every row unless PREVIEW_LIMIT is set or the request sends its own
+# preview_limit; the response's preview field then says whether rows were cut
+INSIGHTS_COST_GUARD = {
+    'ENABLED': True,
+    'WARN_COST': 1000000,
+    'WARN_ROWS': 1000000,
+    'MAX_COST': None,
+    'MAX_ROWS': None,
+    'LARGE_TABLE_ROWS': 100000,
+    'PREVIEW_LIMIT': None,
+}
+
+# Stage timings: histogram buckets (seconds) for /metrics, and whether each
+# response carries its own timings in a Server-Timing header
+INSIGHTS_METRICS = {
+    'BUCKETS': [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+    'SERVER_TIMING': True,
+}
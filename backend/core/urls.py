@@ -17,8 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from insights.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('insights.urls')),
     path('query/', include('quering.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,80 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import asyncpg
+from django.conf import settings
+
+from .metrics import stage
+from .pool import pool_key
+
+
+class AsyncPoolManager:
+    """
+    Keeps one asyncpg pool per resolved set of credentials.
+
+    asyncpg pools are bound to the loop that created them, so a pool made
+    under another loop (e.g. a per-request loop under WSGI) is replaced
+    rather than handed out. Under ASGI there is a single loop and pools
+    live for the life of the process.
+    """
+
+    def __init__(self):
+        self._pools = {}
+
+    async def get(self, params):
+        loop = asyncio.get_running_loop()
+        key = pool_key(params)
+        pool = self._usable(key, loop)
+        if pool is not None:
+            return pool
+
+        options = getattr(settings, 'INSIGHTS_POOL', {})
+        pool = await asyncpg.create_pool(
+            host=params['host'],
+            port=int(params['port']),
+            database=params['dbname'],
+            user=params['user'],
+            password=params['password'],
+            min_size=options.get('MIN_SIZE', 1),
+            max_size=options.get('MAX_SIZE', 10),
+            max_inactive_connection_lifetime=options.get('MAX_IDLE_SECONDS', 300),
+        )
+        # Another request may have created the same pool while we awaited
+        existing = self._usable(key, loop)
+        if existing is not None:
+            await pool.close()
+            return existing
+        self._pools[key] = (loop, pool)
+        return pool
+
+    def _usable(self, key, loop):
+        entry = self._pools.get(key)
+        if entry is None:
+            return None
+        pool_loop, pool = entry
+        if pool_loop is not loop or pool.is_closing():
+            return None
+        return pool
+
+    async def close_all(self):
+        loop = asyncio.get_running_loop()
+        for key, (pool_loop, pool) in list(self._pools.items()):
+            del self._pools[key]
+            if pool_loop is loop:
+                await pool.close()
+
+
+async_pools = AsyncPoolManager()
+
+
+@asynccontextmanager
+async def borrow_async(params):
+    """Borrow a pooled asyncpg connection for the duration of an async with block"""
+    pool = await async_pools.get(params)
+    timeout = getattr(settings, 'INSIGHTS_POOL', {}).get('ACQUIRE_TIMEOUT', 10)
+    with stage('connect'):
+        conn = await pool.acquire(timeout=timeout)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
@@ -0,0 +1,252 @@
+"""
+Async counterparts of the insights API views.
+
+These run on asyncpg and the async Groq client so that, served through
+core.asgi (e.g. ``uvicorn core.asgi:application``), a single process can
+keep many slow LLM calls and queries in flight without tying up a worker
+thread for each one.
+
+The async raw-SQL view returns results whole, as records, and always runs
+the query: pagination (page_size), streaming (stream), the result cache
+(cache) and the other output formats are only served by /api/raw-sql/, and
+requests asking for them here are refused with a 400 saying so.
+"""
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from asyncpg.exceptions import QueryCanceledError
+from django.http import HttpResponse
+
+from .async_pool import borrow_async
+from .charts import build_charts, max_points_from, rule_based_specs
+from .explain import CostRejected, guard_async, preview_limit_from, trim_preview
+from .generation import arun_generation, generation_key, generation_steps, should_cache
+from .generation_cache import generation_cache
+from .llm import llm_gateway
+from .metrics import count_rows, stage
+from .limits import TooManyQueries, query_limiters, statement_timeout_ms
+from .pool import pool_key, resolve_db_config
+from .profiling import Dataset, profile_dataset, sample_rows
+from .renderers import dumps
+from .result_cache import result_cache
+from .prompts import (
+    SQL_MODEL,
+    VISUALIZATION_MODEL,
+    VisualizationParseError,
+    extract_visualizations,
+    sql_messages,
+    visualization_messages,
+)
+from .schema import fetch_schema_async
+
+
+def _response(data, status=200):
+    with stage('serialize'):
+        return HttpResponse(dumps(data), status=status, content_type='application/json')
+
+
+def async_api_view(view):
+    """
+    The async equivalent of @api_view(['POST']): rejects other methods,
+    parses the JSON body and exempts the view from CSRF as DRF does.
+    The view is called as view(request, data).
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return _response({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError as e:
+            return _response({'detail': f'JSON parse error - {e}'}, status=400)
+        if not isinstance(data, dict):
+            return _response({'detail': 'Expected a JSON object'}, status=400)
+        return await view(request, data, *args, **kwargs)
+
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+def _sync_only_options(data):
+    """The options of a raw-SQL request that only the sync view supports"""
+    options = [name for name in ('stream', 'cache') if data.get(name)]
+    if data.get('page_size') is not None:
+        options.append('page_size')
+    if data.get('format', 'records') != 'records':
+        options.append('format')
+    return options
+
+
+def _affected_rows(status_line):
+    """Row count from a command tag such as 'INSERT 0 3' or 'UPDATE 2'"""
+    last = status_line.rsplit(' ', 1)[-1] if status_line else ''
+    return int(last) if last.isdigit() else -1
+
+
+async def get_db_schema_async(db_config):
+    """Async helper returning a SchemaSnapshot, mirroring views.get_db_schema"""
+    try:
+        params = resolve_db_config(db_config)
+        async with borrow_async(params) as conn:
+            return await fetch_schema_async(conn, pool_key(params))
+    except Exception as e:
+        raise Exception(f'Error getting database schema: {str(e)}')
+
+
+@async_api_view
+async def execute_raw_sql_async(request, data):
+    try:
+        query = data.get('query')
+        if not query:
+            return _response({'error': 'Query parameter is required'}, status=400)
+        unsupported = _sync_only_options(data)
+        if unsupported:
+            return _response({'error': f'{", ".join(unsupported)} not supported here; use /api/raw-sql/'}, status=400)
+
+        try:
+            params = resolve_db_config(data.get('db_config', {}))
+            timeout_ms = await sync_to_async(statement_timeout_ms)(params, data)
+            preview_limit = preview_limit_from(data)
+        except ValueError as e:
+            return _response({'error': str(e)}, status=400)
+
+        limiter = query_limiters.get(params)
+        try:
+            await limiter.acquire_async()
+        except TooManyQueries as e:
+            response = _response({'error': str(e)}, status=429)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+
+        # Since Django 5.0 the view task is cancelled when the client
+        # disconnects, and asyncpg then cancels the running statement
+        try:
+            async with borrow_async(params) as conn, conn.transaction():
+                await conn.execute("SELECT set_config('statement_timeout', $1, true)", f'{timeout_ms}ms')
+                with stage('plan'):
+                    statement, plan, limit = await guard_async(conn, query, preview_limit)
+                if query.strip().upper().startswith('SELECT'):
+                    with stage('execute'):
+                        prepared = await conn.prepare(statement)
+                        rows, truncated = trim_preview(await prepared.fetch(), limit)
+                    count_rows(len(rows))
+                    columns = [attribute.name for attribute in prepared.get_attributes()]
+                    body = {'results': [dict(zip(columns, row)) for row in rows]}
+                    if plan is not None:
+                        body['plan'] = plan
+                    if limit:
+                        body['preview'] = {'limit': limit, 'truncated': truncated}
+                    return _response(body)
+
+                # For other queries (INSERT, UPDATE, DELETE)
+                with stage('execute'):
+                    affected_rows = _affected_rows(await conn.execute(statement))
+            result_cache.invalidate(pool_key(params))
+            body = {'affected_rows': affected_rows}
+            if plan is not None:
+                body['plan'] = plan
+            return _response(body)
+        finally:
+            limiter.release()
+
+    except CostRejected as e:
+        return _response({'error': str(e), 'plan': e.plan}, status=400)
+    except QueryCanceledError:
+        return _response({'error': f'Query cancelled: it ran longer than the {timeout_ms} ms statement timeout'}, status=504)
+    except Exception as e:
+        return _response({'error': str(e)}, status=400)
+
+
+@async_api_view
+async def get_database_schema_async(request, data):
+    try:
+        try:
+            params = resolve_db_config(data.get('db_config', {}))
+        except ValueError as e:
+            return _response({'error': str(e)}, status=400)
+
+        async with borrow_async(params) as conn:
+            snapshot = await fetch_schema_async(conn, pool_key(params))
+
+        return _response({'schema': snapshot.schema, 'schema_cache_hit': snapshot.cache_hit})
+
+    except Exception as e:
+        return _response({'error': str(e)}, status=400)
+
+
+async def generate_sql_async(schema_info, natural_language, error_handling_requested, rollups=None):
+    with stage('prompt'):
+        messages = sql_messages(schema_info, natural_language, error_handling_requested, rollups)
+    return await llm_gateway.acomplete(
+        messages,
+        model=SQL_MODEL,
+        temperature=0,
+        max_tokens=1000,
+    )
+
+
+@async_api_view
+async def generate_sql_query_async(request, data):
+    try:
+        natural_language = data.get('natural_language')
+        if not natural_language:
+            return _response({'error': 'Natural language query is required'}, status=400)
+
+        error_handling_requested = data.get('error', False)
+        snapshot = await get_db_schema_async(data.get('db_config', {}))
+
+        # The same steps as the sync view; only the I/O around them is async
+        cache_key = generation_key(snapshot, natural_language, error_handling_requested)
+        cached_sql = await sync_to_async(generation_cache.get, thread_sensitive=False)(cache_key)
+        steps = generation_steps(snapshot, natural_language, error_handling_requested, cached_sql)
+        body = await arun_generation(steps, generate_sql_async)
+        if should_cache(body):
+            await sync_to_async(generation_cache.put, thread_sensitive=False)(cache_key, body['sql_query'])
+        return _response(body)
+
+    except Exception as e:
+        return _response({'error': str(e)}, status=400)
+
+
+@async_api_view
+async def generate_visualization_data_async(request, data):
+    try:
+        dataset = data.get('dataset')
+        if not dataset:
+            return _response({'error': 'Dataset is required'}, status=400)
+
+        # The model picks charts from a profile and a small sample; the
+        # charts are then computed from the full dataset here and reduced
+        # to at most max_points points each
+        try:
+            result_set = Dataset.from_payload(dataset)
+            max_points = max_points_from(data)
+        except ValueError as e:
+            return _response({'error': str(e)}, status=400)
+
+        # Common shapes are charted by rule without asking the model
+        specs = rule_based_specs(result_set)
+        source = 'rules'
+        if specs is None:
+            with stage('profile'):
+                messages = visualization_messages(profile_dataset(result_set), sample_rows(result_set))
+            raw_output = await llm_gateway.acomplete(
+                messages,
+                model=VISUALIZATION_MODEL,
+                temperature=0,
+                max_tokens=1500,
+            )
+
+            try:
+                specs = extract_visualizations(raw_output)
+            except VisualizationParseError as e:
+                return _response({'error': str(e), 'raw': e.raw}, status=400)
+            source = 'model'
+
+        with stage('charts'):
+            visualizations = build_charts(result_set, specs, max_points)
+        return _response({'visualizations': visualizations, 'source': source})
+
+    except Exception as e:
+        return _response({'error': str(e)}, status=400)
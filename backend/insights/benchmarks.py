@@ -0,0 +1,322 @@
+"""
+Benchmarks for the work the insights views do around the database and the
+model: building the schema dict (get_db_schema), assembling and checking
+the NL-to-SQL prompt (generate_sql_query) and laying out and rendering
+results (execute_raw_sql).
+
+They run the real views against the fakes from insights.tests, fed with
+synthetic schemas and result sets, so only this code is measured. The
+best of several samples is compared with a stored baseline; ``python manage.py benchmark`` runs
+them. Timings depend on the machine, so record baselines on the machine
+that checks them.
+"""
+import datetime
+import gc
+import json
+import random
+import statistics
+import time
+import uuid
+from collections import namedtuple
+from contextlib import ExitStack
+from decimal import Decimal
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from django.test import RequestFactory
+
+from .generation_cache import GenerationCache
+from .llm import GroqBackend, llm_gateway
+from .pool import pools
+from .result_cache import result_cache
+from .schema import schema_cache
+from .tests import FakeDictConnection, FakeDictCursor, FakeGroqResponse
+from .views import execute_raw_sql, generate_sql_query, get_db_schema
+
+BASELINES_PATH = Path(__file__).with_name('benchmark_baselines.json')
+
+# Sizes run for each case: schema and prompt cases in columns, serialization in rows
+SCALES = {
+    'quick': {'schema': (10, 1000), 'prompt': (10, 1000), 'serialize': (1000, 10000)},
+    'default': {'schema': (10, 1000, 10000), 'prompt': (10, 1000, 10000), 'serialize': (1000, 10000, 100000)},
+    'full': {
+        'schema': (10, 1000, 10000, 50000),
+        'prompt': (10, 1000, 10000, 50000),
+        'serialize': (1000, 10000, 100000, 1000000, 2000000),
+    },
+}
+
+COLUMNS_PER_TABLE = 25
+
+# Each timed sample lasts at least this long
+MIN_SAMPLE_SECONDS = 0.1
+
+# Distinct rows in a synthetic result set; larger sets repeat them
+ROW_POOL_SIZE = 1024
+
+QUESTION = 'total amount by status for table_0002 since last month'
+ANSWER = 'SELECT status, SUM(amount) FROM table_0002 GROUP BY status'
+
+Result = namedtuple('Result', ['case', 'size', 'median', 'best', 'repeat'])
+
+# What a case needs: the fake connection, the call to time, what to reset
+# before each call and the patches in force while it runs
+Bench = namedtuple('Bench', ['connection', 'run', 'setup', 'patches'], defaults=(None, ()))
+
+
+def _key(case, size):
+    return f'{case}:{size}'
+
+
+# ---------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------
+_COLUMN_TYPES = ('integer', 'text', 'numeric', 'timestamp with time zone', 'boolean', 'date', 'uuid', 'jsonb')
+
+
+def synthetic_schema(columns):
+    """information_schema.columns rows for columns columns, COLUMNS_PER_TABLE to a table"""
+    named = [('id', 'integer'), ('customer_id', 'integer'), ('amount', 'numeric'),
+             ('status', 'text'), ('created_at', 'timestamp with time zone')]
+    rows = []
+    for index in range(columns):
+        table, position = divmod(index, COLUMNS_PER_TABLE)
+        if position < len(named):
+            name, data_type = named[position]
+        else:
+            name, data_type = f'attribute_{position:02d}', _COLUMN_TYPES[position % len(_COLUMN_TYPES)]
+        rows.append({
+            'table_schema': 'public',
+            'table_name': f'table_{table:04d}',
+            'column_name': name,
+            'data_type': data_type,
+            'is_nullable': 'NO' if position == 0 else 'YES',
+            'column_default': f"nextval('table_{table:04d}_id_seq'::regclass)" if position == 0 else None,
+            'column_comment': f'{name.replace("_", " ")} of table {table}' if position % 4 == 1 else None,
+        })
+    return rows
+
+
+RESULT_COLUMNS = ('id', 'amount', 'created_at', 'day', 'status', 'active', 'score', 'reference')
+
+
+def synthetic_rows(count, seed=0):
+    """
+    count result rows mixing integers, Decimals, timestamps, dates, text,
+    booleans, floats, NULLs and UUIDs. Rows repeat every ROW_POOL_SIZE so
+    millions of them fit in memory; serializing them costs the same.
+    """
+    generator = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    statuses = ('pending', 'paid', 'shipped', 'refunded', 'cancelled')
+    pool = [
+        (
+            index,
+            Decimal(generator.randrange(100, 10000000)) / 100,
+            start + datetime.timedelta(seconds=generator.randrange(365 * 24 * 3600)),
+            (start + datetime.timedelta(days=generator.randrange(365))).date(),
+            generator.choice(statuses),
+            generator.random() < 0.8,
+            None if generator.random() < 0.1 else generator.random() * 100,
+            uuid.UUID(int=generator.getrandbits(128)),
+        )
+        for index in range(min(count, ROW_POOL_SIZE))
+    ]
+    return [pool[index % len(pool)] for index in range(count)]
+
+
+class SyntheticCursor(FakeDictCursor):
+    """FakeDictCursor answering the schema query and plain SELECTs with synthetic data"""
+
+    def __init__(self, schema_rows, rows):
+        super().__init__()
+        self.schema_rows = schema_rows
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        super().execute(query, params)
+        if self.description and self.description[0] == ('table_schema',):
+            self._data = self.schema_rows
+        elif self.description == [('id',)]:
+            self._data = self.rows
+            self.rowcount = len(self.rows)
+            self.description = [(name,) for name in RESULT_COLUMNS]
+
+
+class SyntheticConnection(FakeDictConnection):
+    def __init__(self, schema_rows=(), rows=()):
+        super().__init__()
+        self.schema_rows = list(schema_rows)
+        self.rows = list(rows)
+
+    def cursor(self, *args, **kwargs):
+        return SyntheticCursor(self.schema_rows, self.rows)
+
+
+# ---------------------------------------------------------------------
+# Cases
+# ---------------------------------------------------------------------
+def _post(path, data):
+    return RequestFactory().post(path, data=data, content_type='application/json')
+
+
+def bench_schema(columns):
+    """get_db_schema with a cold schema cache: the catalog rows nested into the schema dict"""
+    return Bench(
+        SyntheticConnection(schema_rows=synthetic_schema(columns)),
+        run=lambda: get_db_schema({}),
+        setup=schema_cache.clear,
+    )
+
+
+def bench_prompt(columns):
+    """
+    generate_sql_query with the schema cached and a fresh generation cache:
+    schema pruning, prompt assembly and checking the model's SQL
+    """
+    groq = MagicMock()
+    groq.chat.completions.create.return_value = FakeGroqResponse(ANSWER)
+    generations = GenerationCache()
+
+    def run():
+        response = generate_sql_query(_post('/api/generate-sql/', {'natural_language': QUESTION}))
+        if response.status_code != 200:
+            raise RuntimeError(response.data.get('error'))
+
+    return Bench(
+        SyntheticConnection(schema_rows=synthetic_schema(columns)),
+        run=run,
+        setup=generations.clear,
+        patches=(
+            patch('insights.views.generation_cache', generations),
+            patch.object(llm_gateway, 'backend', GroqBackend(client=groq)),
+        ),
+    )
+
+
+def bench_serialize(result_format):
+    def case(rows):
+        """execute_raw_sql for a SELECT of rows rows, rendered to the response body"""
+        body = {'query': 'SELECT * FROM orders', 'format': result_format, 'preview_limit': False}
+
+        def run():
+            response = execute_raw_sql(_post('/api/raw-sql/', body))
+            if response.status_code != 200:
+                raise RuntimeError(response.data.get('error'))
+            response.render()
+
+        return Bench(SyntheticConnection(rows=synthetic_rows(rows)), run=run)
+
+    return case
+
+
+CASES = {
+    'schema': ('schema', bench_schema),
+    'prompt': ('prompt', bench_prompt),
+    'serialize-records': ('serialize', bench_serialize('records')),
+    'serialize-columnar': ('serialize', bench_serialize('columnar')),
+}
+
+
+# ---------------------------------------------------------------------
+# Running and comparing
+# ---------------------------------------------------------------------
+def measure(run, setup=None, repeat=5, min_time=MIN_SAMPLE_SECONDS):
+    """
+    Seconds per call of run in each of repeat samples, after one warm-up
+    call. Fast calls are repeated until a sample has taken min_time, so
+    timer resolution and scheduling noise average out; setup is not timed.
+    """
+    if setup is not None:
+        setup()
+    run()
+    samples = []
+    # As with timeit, garbage collection is kept out of the timings
+    enabled = gc.isenabled()
+    try:
+        for _ in range(repeat):
+            elapsed, calls = 0.0, 0
+            gc.collect()
+            gc.disable()
+            while elapsed < min_time or not calls:
+                if setup is not None:
+                    setup()
+                started = time.perf_counter()
+                run()
+                elapsed += time.perf_counter() - started
+                calls += 1
+            gc.enable()
+            samples.append(elapsed / calls)
+    finally:
+        if enabled:
+            gc.enable()
+        else:
+            gc.disable()
+    return samples
+
+
+def run_case(name, size, repeat=5):
+    _, factory = CASES[name]
+    bench = factory(size)
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(patch('insights.pool.psycopg2.connect', return_value=bench.connection))
+            for patcher in bench.patches:
+                stack.enter_context(patcher)
+            timings = measure(bench.run, bench.setup, repeat)
+    finally:
+        pools.close_all()
+        schema_cache.clear()
+        result_cache.clear()
+        FakeDictCursor.executed = []
+    return Result(name, size, statistics.median(timings), min(timings), repeat)
+
+
+def run_benchmarks(scale='default', cases=None, repeat=5, report=None):
+    """Run every case (or those named) at the scale's sizes; report(result) is called as each finishes"""
+    results = []
+    for name in cases or CASES:
+        if name not in CASES:
+            raise ValueError(f'Unknown benchmark: {name}')
+        kind, _ = CASES[name]
+        for size in SCALES[scale][kind]:
+            result = run_case(name, size, repeat)
+            results.append(result)
+            if report is not None:
+                report(result)
+    return results
+
+
+def load_baselines(path=BASELINES_PATH):
+    """Stored best times in seconds, keyed 'case:size'"""
+    try:
+        with open(path) as f:
+            return json.load(f)['results']
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(results, path=BASELINES_PATH):
+    """Store results' best times, keeping baselines for cases or sizes that were not run"""
+    baselines = load_baselines(path)
+    baselines.update({_key(result.case, result.size): round(result.best, 6) for result in results})
+    with open(path, 'w') as f:
+        json.dump({'results': dict(sorted(baselines.items()))}, f, indent=2)
+        f.write('\n')
+
+
+Regression = namedtuple('Regression', ['key', 'best', 'baseline', 'ratio'])
+
+
+def regressions(results, baselines, threshold=0.5):
+    """
+    Results more than threshold (a fraction) slower than their baseline. The
+    best sample is compared, as the one least disturbed by other work.
+    """
+    slower = []
+    for result in results:
+        key = _key(result.case, result.size)
+        baseline = baselines.get(key)
+        if baseline and result.best > baseline * (1 + threshold):
+            slower.append(Regression(key, result.best, baseline, result.best / baseline))
+    return slower
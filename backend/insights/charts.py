@@ -0,0 +1,314 @@
+import numpy as np
+from django.conf import settings
+
+from .profiling import CATEGORICAL, NUMERIC, TEMPORAL
+
+CHART_TYPES = ('bar', 'pie', 'line')
+AGGREGATES = ('sum', 'mean', 'count', 'min', 'max')
+
+# Pie charts are only proposed by the rules up to this many slices
+MAX_PIE_SLICES = 8
+# Buckets of the histogram drawn for a single numeric column
+HISTOGRAM_BINS = 10
+
+
+def _plain(values):
+    """A float array as JSON-friendly numbers, ints where every value is whole"""
+    if len(values) and np.all(values == np.round(values)) and np.all(np.abs(values) < 2 ** 53):
+        return values.astype(np.int64).tolist()
+    return [round(value, 6) for value in values.tolist()]
+
+
+def _keys(dataset, name):
+    """Grouping keys for column name and a mask of the rows that have one"""
+    role = dataset.roles[name]
+    if role == NUMERIC:
+        keys = dataset.numbers(name)
+        return keys, ~np.isnan(keys)
+    if role == TEMPORAL:
+        keys = dataset.times(name)
+        return keys, ~np.isnat(keys)
+    keys = dataset.labels(name)
+    mask = ~np.equal(keys, None)
+    return keys, mask
+
+
+def _key_values(dataset, name, keys):
+    role = dataset.roles[name]
+    if role == NUMERIC:
+        return _plain(keys)
+    if role == TEMPORAL:
+        # Midnight timestamps are shown as plain dates
+        unit = 'D' if np.all(keys == keys.astype('datetime64[D]')) else 's'
+        return np.datetime_as_string(keys, unit=unit).tolist()
+    return keys.tolist()
+
+
+def aggregate(dataset, x, y=None, how='sum'):
+    """
+    Group the rows by column x and aggregate column y (or count rows when
+    y is None). Returns the group keys, sorted, their values and the number
+    of rows in each group.
+    """
+    keys, mask = _keys(dataset, x)
+    weights = None
+    if y is not None:
+        weights = dataset.numbers(y)
+        mask &= ~np.isnan(weights)
+        weights = weights[mask]
+    keys = keys[mask]
+    if dataset.roles[x] == CATEGORICAL:
+        keys = keys.astype(str)
+    groups, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(groups)).astype(np.float64)
+
+    if weights is None or how == 'count':
+        values = counts
+    elif how in ('sum', 'mean'):
+        values = np.bincount(inverse, weights=weights, minlength=len(groups))
+        if how == 'mean':
+            values = values / counts
+    else:
+        order = np.lexsort((weights, inverse))
+        starts = np.searchsorted(inverse[order], np.arange(len(groups)))
+        if how == 'min':
+            values = weights[order][starts]
+        else:
+            ends = np.append(starts[1:], len(order)) - 1
+            values = weights[order][ends]
+    return groups, values, counts
+
+
+def histogram(dataset, x, y=None, bins=HISTOGRAM_BINS):
+    """Bucket numeric column x into equal-width bins; count rows or sum y per bin"""
+    keys = dataset.numbers(x)
+    mask = ~np.isnan(keys)
+    weights = None
+    if y is not None:
+        weights = dataset.numbers(y)
+        mask &= ~np.isnan(weights)
+        weights = weights[mask]
+    counts, edges = np.histogram(keys[mask], bins=bins, weights=weights)
+    labels = [f'{low:g}–{high:g}' for low, high in zip(edges[:-1], edges[1:])]
+    return labels, counts.astype(np.float64)
+
+
+def lttb(x, y, threshold):
+    """
+    Indices of the points Largest-Triangle-Three-Buckets keeps to draw the
+    line (x, y) with threshold points. x must be sorted. The first and last
+    points are always kept; from each bucket in between, the point forming
+    the largest triangle with the previously kept point and the average of
+    the next bucket is chosen.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    edges = np.floor(np.arange(threshold - 1) * every).astype(np.int64) + 1
+    edges[-1] = n - 1
+    sizes = np.diff(edges)
+    average_x = np.append(np.add.reduceat(x[:n - 1], edges[:-1]) / sizes, x[-1])
+    average_y = np.append(np.add.reduceat(y[:n - 1], edges[:-1]) / sizes, y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    kept = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        area = np.abs(
+            (x[kept] - average_x[bucket + 1]) * (y[start:end] - y[kept])
+            - (x[kept] - x[start:end]) * (average_y[bucket + 1] - y[kept])
+        )
+        kept = start + int(np.argmax(area))
+        selected[bucket + 1] = kept
+    return selected
+
+
+def fold_other(labels, values, counts, how, limit):
+    """
+    Keep the limit - 1 largest groups (values must be sorted, largest first)
+    and fold the rest into a single "Other" group aggregated the same way.
+    """
+    head, tail = slice(None, limit - 1), slice(limit - 1, None)
+    if how == 'mean':
+        other = np.sum(values[tail] * counts[tail]) / np.sum(counts[tail])
+    elif how == 'min':
+        other = np.min(values[tail])
+    elif how == 'max':
+        other = np.max(values[tail])
+    else:
+        other = np.sum(values[tail])
+    return list(labels[head]) + ['Other'], np.append(values[head], other)
+
+
+def merge_adjacent(labels, values, counts, how, limit):
+    """Merge neighbouring groups of an ordered axis into at most limit "first–last" ranges"""
+    starts = np.unique(np.linspace(0, len(values), limit, endpoint=False).astype(np.int64))
+    ends = np.append(starts[1:], len(values)) - 1
+    if how == 'mean':
+        merged = np.add.reduceat(values * counts, starts) / np.add.reduceat(counts, starts)
+    elif how == 'min':
+        merged = np.minimum.reduceat(values, starts)
+    elif how == 'max':
+        merged = np.maximum.reduceat(values, starts)
+    else:
+        merged = np.add.reduceat(values, starts)
+    merged_labels = [
+        str(labels[start]) if start == end else f'{labels[start]}–{labels[end]}'
+        for start, end in zip(starts.tolist(), ends.tolist())
+    ]
+    return merged_labels, merged
+
+
+def _axis(dataset, name, groups):
+    """Sorted group keys of an ordered column as plain numbers, for LTTB"""
+    if dataset.roles[name] == TEMPORAL:
+        return groups.astype('datetime64[ms]').astype(np.int64).astype(np.float64)
+    return groups
+
+
+def _valid(dataset, spec):
+    if not isinstance(spec, dict) or spec.get('type') not in CHART_TYPES:
+        return False
+    x, y = spec.get('x'), spec.get('y')
+    if x not in dataset.roles:
+        return False
+    if y is not None and dataset.roles.get(y) != NUMERIC:
+        return False
+    if spec['type'] == 'line' and dataset.roles[x] == CATEGORICAL:
+        return False
+    if spec.get('bins') and dataset.roles[x] != NUMERIC:
+        return False
+    return spec.get('aggregate', 'sum') in AGGREGATES
+
+
+def build_chart(dataset, spec, max_points=None):
+    """
+    Compute one chart in the shape the React chart components take from a
+    spec of {"type", "x", "y", "aggregate"}, plus "bins" to bucket a
+    numeric x into a histogram.
+
+    Charts with more than max_points points are reduced: lines with LTTB,
+    bars and pies over categories to the largest groups plus "Other", and
+    bars over an ordered axis by merging neighbouring groups.
+    """
+    x, y = spec['x'], spec.get('y')
+    how = spec.get('aggregate') or ('sum' if y else 'count')
+    points = None
+    if spec.get('bins'):
+        how = 'sum' if y else 'count'
+        labels, values = histogram(dataset, x, y, int(spec['bins']))
+    else:
+        groups, values, counts = aggregate(dataset, x, y, how)
+        over = bool(max_points) and len(groups) > max_points
+        if over:
+            points = len(groups)
+        if spec['type'] == 'line':
+            if over:
+                keep = lttb(_axis(dataset, x, groups), values, max_points)
+                groups, values = groups[keep], values[keep]
+            labels = _key_values(dataset, x, groups)
+        elif spec['type'] == 'pie' or dataset.roles[x] == CATEGORICAL:
+            # Largest groups first
+            order = np.argsort(-values, kind='stable')
+            groups, values, counts = groups[order], values[order], counts[order]
+            labels = np.array(_key_values(dataset, x, groups), dtype=object)
+            if over:
+                labels, values = fold_other(labels, values, counts, how, max_points)
+            labels = list(labels)
+        else:
+            labels = _key_values(dataset, x, groups)
+            if over:
+                labels, values = merge_adjacent(labels, values, counts, how, max_points)
+    ylabel = f'{how} of {y}' if y and how != 'sum' else (y or 'count')
+    values = _plain(values)
+
+    if spec['type'] == 'pie':
+        chart = {'type': 'pie', 'data': {
+            'xlabel': x,
+            'values': [{'label': label, 'value': value} for label, value in zip(labels, values)],
+        }}
+    else:
+        chart = {'type': spec['type'], 'data': {
+            'xlabel': x,
+            'ylabel': ylabel,
+            'xvalues': labels,
+            'yvalues': values,
+        }}
+    if points is not None:
+        chart['original_points'] = points
+    return chart
+
+
+def build_charts(dataset, specs, max_points=None):
+    """Charts for every usable spec; specs naming unknown or unsuitable columns are skipped"""
+    return [build_chart(dataset, spec, max_points) for spec in specs if _valid(dataset, spec)]
+
+
+def max_points_from(data):
+    """The max_points of a visualization request, defaulting to INSIGHTS_VISUALIZATION's MAX_POINTS"""
+    max_points = data.get('max_points')
+    if max_points is None:
+        return getattr(settings, 'INSIGHTS_VISUALIZATION', {}).get('MAX_POINTS', 1000)
+    try:
+        max_points = int(max_points)
+    except (TypeError, ValueError):
+        raise ValueError('max_points must be an integer')
+    if max_points < 3:
+        raise ValueError('max_points must be 3 or greater')
+    return max_points
+
+
+def rule_based_specs(dataset):
+    """
+    Chart specs for the common result shapes, worked out without the model:
+
+    - one categorical and one numeric column: bar (and pie) of the sum
+    - one temporal and one numeric column: line of the sum over time
+    - a single numeric column: histogram of its distribution
+    - a single categorical column: bar (and pie) of row counts
+
+    Returns None for anything else, which is left to the model.
+    """
+    if not getattr(settings, 'INSIGHTS_VISUALIZATION', {}).get('USE_RULES', True):
+        return None
+    if not dataset.row_count:
+        return None
+    by_role = {CATEGORICAL: [], TEMPORAL: [], NUMERIC: []}
+    for name in dataset.names:
+        by_role[dataset.roles[name]].append(name)
+    categorical, temporal, numeric = by_role[CATEGORICAL], by_role[TEMPORAL], by_role[NUMERIC]
+    shape = (len(categorical), len(temporal), len(numeric))
+
+    if shape == (1, 0, 1):
+        x, y = categorical[0], numeric[0]
+        specs = [{'type': 'bar', 'x': x, 'y': y, 'aggregate': 'sum'}]
+        if _pie_friendly(dataset, x, y):
+            specs.append({'type': 'pie', 'x': x, 'y': y, 'aggregate': 'sum'})
+        return specs
+    if shape == (0, 1, 1):
+        return [{'type': 'line', 'x': temporal[0], 'y': numeric[0], 'aggregate': 'sum'}]
+    if shape == (0, 0, 1):
+        return [{'type': 'bar', 'x': numeric[0], 'y': None, 'aggregate': 'count', 'bins': HISTOGRAM_BINS}]
+    if shape == (1, 0, 0):
+        x = categorical[0]
+        if _distinct(dataset, x) == dataset.row_count > 1:
+            return None  # every value unique: nothing to count
+        specs = [{'type': 'bar', 'x': x, 'y': None, 'aggregate': 'count'}]
+        if _pie_friendly(dataset, x):
+            specs.append({'type': 'pie', 'x': x, 'y': None, 'aggregate': 'count'})
+        return specs
+    return None
+
+
+def _pie_friendly(dataset, x, y=None):
+    """A pie only reads well with a few slices of non-negative values"""
+    if _distinct(dataset, x) > MAX_PIE_SLICES:
+        return False
+    return y is None or not np.any(dataset.numbers(y) < 0)
+
+
+def _distinct(dataset, name):
+    labels = dataset.labels(name)
+    return len(np.unique(labels[~np.equal(labels, None)].astype(str)))
@@ -0,0 +1,179 @@
+import json
+
+import sqlparse
+from django.conf import settings
+from sqlparse.tokens import Keyword
+
+from .result_cache import is_read_only
+
+# Statements EXPLAIN accepts; anything else runs unguarded
+EXPLAINABLE_TYPES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+TABLE_ROWS_QUERY = """
+    SELECT relname, max(reltuples)::bigint AS reltuples
+    FROM pg_catalog.pg_class
+    WHERE relkind IN ('r', 'p', 'm') AND relname = ANY(%s)
+    GROUP BY relname;
+"""
+
+
+def explain(cursor, query):
+    """The planner's top plan node for query, from EXPLAIN (FORMAT JSON)"""
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + query)
+    return cursor.fetchall()[0][0][0]['Plan']
+
+
+def estimated_rows(cursor, query):
+    """Cheap row estimate for query, used in place of a COUNT(*)"""
+    return int(explain(cursor, query)['Plan Rows'])
+
+
+class CostRejected(Exception):
+    """The planner's estimate for a query is over INSIGHTS_COST_GUARD's MAX_COST or MAX_ROWS"""
+
+    def __init__(self, message, plan):
+        super().__init__(message)
+        self.plan = plan
+
+
+def _options():
+    return getattr(settings, 'INSIGHTS_COST_GUARD', {})
+
+
+def preview_limit_from(data):
+    """
+    Row limit put on unbounded SELECTs: the request's preview_limit (false
+    to turn it off), else INSIGHTS_COST_GUARD's PREVIEW_LIMIT, which is off
+    by default. Limited responses say so in their preview field.
+    """
+    limit = data.get('preview_limit')
+    if limit is None:
+        return _options().get('PREVIEW_LIMIT')
+    if limit is False:
+        return None
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('preview_limit must be an integer or false')
+    if limit < 1:
+        raise ValueError('preview_limit must be 1 or greater')
+    return limit
+
+
+def explainable(query):
+    statements = [s for s in sqlparse.parse(query) if s.token_first(skip_cm=True) is not None]
+    return len(statements) == 1 and statements[0].get_type() in EXPLAINABLE_TYPES
+
+
+def is_bounded(query):
+    """True when the statement itself ends in LIMIT or FETCH (subqueries do not count)"""
+    statement = sqlparse.parse(query)[0]
+    return any(token.ttype is Keyword and token.normalized in ('LIMIT', 'FETCH') for token in statement.tokens)
+
+
+def with_limit(query, limit):
+    """
+    query wrapped to return at most limit rows, plus one to tell whether
+    more were cut off. Newlines keep a trailing comment from swallowing
+    the wrapper.
+    """
+    inner = query.strip().rstrip(';')
+    return f'SELECT * FROM (\n{inner}\n) AS _preview LIMIT {limit + 1}'
+
+
+def limit_for(query, limit):
+    """The preview limit to put on query, or None if it should run as written"""
+    if limit and is_read_only(query) and not is_bounded(query):
+        return limit
+    return None
+
+
+def summarize_plan(plan, limited=False):
+    """
+    Total cost, estimated rows and the tables read by sequential scan in a
+    plan. For a query wrapped by with_limit the rows are those of the query
+    without the limit.
+    """
+    rows = plan['Plan Rows']
+    if limited and plan.get('Node Type') == 'Limit' and plan.get('Plans'):
+        rows = plan['Plans'][0]['Plan Rows']
+    scanned = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') not in scanned:
+            scanned.append(node['Relation Name'])
+        nodes.extend(node.get('Plans', []))
+    return {'total_cost': plan['Total Cost'], 'estimated_rows': int(rows), 'seq_scans': scanned}
+
+
+def assess(summary, table_rows):
+    """
+    Fill in a plan summary's warnings and the size of each sequentially
+    scanned table; only scans of tables with LARGE_TABLE_ROWS rows or more
+    are kept. Raises CostRejected when the plan is over MAX_COST or MAX_ROWS.
+    """
+    options = _options()
+    large = options.get('LARGE_TABLE_ROWS', 100000)
+    summary['seq_scans'] = [
+        {'table': table, 'rows': table_rows[table]}
+        for table in summary['seq_scans'] if table_rows.get(table, 0) >= large
+    ]
+    warnings = []
+    cost, rows = summary['total_cost'], summary['estimated_rows']
+    if options.get('WARN_COST') and cost > options['WARN_COST']:
+        warnings.append(f'Estimated cost {cost:.0f} is above {options["WARN_COST"]}')
+    if options.get('WARN_ROWS') and rows > options['WARN_ROWS']:
+        warnings.append(f'About {rows} rows are expected')
+    for scan in summary['seq_scans']:
+        warnings.append(f'Sequential scan of {scan["table"]} (about {scan["rows"]} rows)')
+    summary['warnings'] = warnings
+
+    if options.get('MAX_COST') and cost > options['MAX_COST']:
+        raise CostRejected(
+            f'Query rejected: estimated cost {cost:.0f} is above the limit of {options["MAX_COST"]}', summary)
+    if options.get('MAX_ROWS') and rows > options['MAX_ROWS']:
+        raise CostRejected(
+            f'Query rejected: about {rows} rows are expected, above the limit of {options["MAX_ROWS"]}', summary)
+    return summary
+
+
+def guard(cursor, query, limit=None):
+    """
+    EXPLAIN query before it runs. Returns the statement to execute (wrapped
+    with the preview limit when it is an unbounded SELECT), the plan summary
+    and the limit applied (or None). There is no summary for statements
+    EXPLAIN does not take or when the guard is off; raises CostRejected.
+    """
+    limit = limit_for(query, limit)
+    statement = with_limit(query, limit) if limit else query
+    if not _options().get('ENABLED', True) or not explainable(query):
+        return statement, None, limit
+    summary = summarize_plan(explain(cursor, statement), limited=bool(limit))
+    table_rows = {}
+    if summary['seq_scans']:
+        cursor.execute(TABLE_ROWS_QUERY, (summary['seq_scans'],))
+        table_rows = {name: int(rows) for name, rows in cursor.fetchall()}
+    return statement, assess(summary, table_rows), limit
+
+
+async def guard_async(conn, query, limit=None):
+    """guard() for an asyncpg connection"""
+    limit = limit_for(query, limit)
+    statement = with_limit(query, limit) if limit else query
+    if not _options().get('ENABLED', True) or not explainable(query):
+        return statement, None, limit
+    plan = json.loads(await conn.fetchval('EXPLAIN (FORMAT JSON) ' + statement))[0]['Plan']
+    summary = summarize_plan(plan, limited=bool(limit))
+    table_rows = {}
+    if summary['seq_scans']:
+        rows = await conn.fetch(TABLE_ROWS_QUERY.replace('%s', '$1'), summary['seq_scans'])
+        table_rows = {row['relname']: int(row['reltuples']) for row in rows}
+    return statement, assess(summary, table_rows), limit
+
+
+def trim_preview(rows, limit):
+    """Rows of a statement run through with_limit, and whether more were cut off"""
+    if limit is None or len(rows) <= limit:
+        return rows, False
+    return rows[:limit], True
@@ -0,0 +1,256 @@
+"""
+/api/export/: a read-only statement's full result as a file download.
+
+CSV comes straight from Postgres through ``COPY (...) TO STDOUT``: a worker
+thread runs psycopg2's copy_expert and hands what it writes to the response
+in chunks through a bounded queue, so rows are never parsed in Python and
+a slow client holds back the COPY rather than filling memory. Arrow and
+Parquet are built from a server-side cursor, one record batch or row group
+per fetch (see streaming.ArrowBatchStream).
+
+Downloads last as long as the client takes to read them, so they queue for
+slots of their own (export_limiters) rather than the interactive queries'.
+"""
+import queue
+import threading
+
+import psycopg2
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from psycopg2.extensions import QueryCanceledError
+from rest_framework import status
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+
+from .explain import CostRejected, guard
+from .limits import LimiterManager, TooManyQueries, set_statement_timeout
+from .metrics import stage
+from .pool import is_broken, pools, resolve_db_config
+from .result_cache import is_read_only
+from .streaming import stream_select
+
+# Export formats and the extension of the file each is saved as
+EXPORT_FORMATS = {
+    'csv': 'csv',
+    'arrow': 'arrow',
+    'parquet': 'parquet',
+}
+
+_DONE = object()
+
+
+def _options():
+    return getattr(settings, 'INSIGHTS_EXPORT', {})
+
+
+# Concurrent exports per database, apart from the raw-SQL and ask queries
+export_limiters = LimiterManager(_options)
+
+
+class ExportStalled(Exception):
+    """The COPY sent nothing within FIRST_CHUNK_TIMEOUT_SECONDS and was cancelled"""
+
+
+def copy_statement(query):
+    """query as a COPY to CSV with a header row; newlines keep a trailing comment from swallowing it"""
+    inner = query.strip().rstrip(';')
+    return f'COPY (\n{inner}\n) TO STDOUT WITH (FORMAT csv, HEADER true)'
+
+
+class _ChunkWriter:
+    """The file copy_expert writes to: rows are gathered into chunk_size pieces for put()"""
+
+    def __init__(self, put, chunk_size):
+        self.put = put
+        self.chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+        self._first = True
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        # The first piece goes out at once so the view knows the COPY has started
+        if self._first or self._size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.put(b''.join(self._parts))
+            self._parts, self._size, self._first = [], 0, False
+
+
+class CopyStream:
+    """
+    Streams the output of a COPY ... TO STDOUT run by a worker thread. At
+    most max_chunks chunks wait in the queue; beyond that the worker blocks,
+    and the server with it. Closing the stream early (the client hung up)
+    cancels the COPY. The pooled connection is returned, and on_close
+    called, once the worker has finished.
+    """
+    content_type = 'text/csv'
+
+    def __init__(self, pool, conn, statement, chunk_size=65536, max_chunks=16, on_close=None,
+                 first_chunk_timeout=120):
+        self.pool = pool
+        self.conn = conn
+        self.statement = statement
+        self.chunk_size = chunk_size
+        self.first_chunk_timeout = first_chunk_timeout
+        self.on_close = on_close
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._copy, daemon=True)
+        self._first = None
+        self._released = False
+
+    def start(self):
+        """
+        Start the COPY and wait for its first chunk, so errors in the
+        statement are raised here rather than cutting the download short.
+        A COPY that sends nothing within first_chunk_timeout seconds is
+        cancelled and ExportStalled raised.
+        """
+        self._thread.start()
+        try:
+            first = self._queue.get(timeout=self.first_chunk_timeout)
+        except queue.Empty:
+            first = ExportStalled(f'The export sent no data within {self.first_chunk_timeout} s and was cancelled')
+        if isinstance(first, Exception):
+            # Nothing was streamed; what on_close would release is still the caller's
+            self.on_close = None
+            self.close()
+            raise first
+        self._first = first
+        return self
+
+    def _copy(self):
+        try:
+            with self.conn.cursor() as cursor:
+                writer = _ChunkWriter(self._put, self.chunk_size)
+                cursor.copy_expert(self.statement, writer)
+                writer.flush()
+            self.conn.commit()
+            self._put(_DONE)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Once the stream is closed nobody reads the queue; what is left is dropped
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        try:
+            item = self._first
+            while item is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                item = self._queue.get()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._stopped.set()
+        discard = False
+        if self._thread.is_alive():
+            # Still copying: the client went away before the end, or the
+            # COPY stalled. A worker the cancel does not reach in time
+            # leaves its connection to be closed rather than reused.
+            try:
+                self.conn.cancel()
+            except psycopg2.Error:
+                pass
+            self._thread.join(self.first_chunk_timeout)
+            discard = self.conn.closed or self._thread.is_alive()
+        self.pool.release(self.conn, discard=discard)
+        if self.on_close is not None:
+            self.on_close()
+
+
+def stream_copy(params, query, statement_timeout_ms=None, on_close=None):
+    """
+    Run query as COPY ... TO STDOUT (FORMAT csv) and return a
+    StreamingHttpResponse of the CSV; the cost guard sees the query first
+    """
+    options = _options()
+    pool = pools.get(params)
+    conn = pool.acquire()
+    try:
+        if statement_timeout_ms is not None:
+            set_statement_timeout(conn, statement_timeout_ms)
+        with conn.cursor() as cursor, stage('plan'):
+            guard(cursor, query)
+    except Exception as e:
+        pool.release(conn, discard=is_broken(e))
+        raise
+
+    stream = CopyStream(
+        pool, conn, copy_statement(query),
+        chunk_size=options.get('CSV_CHUNK_BYTES', 65536),
+        max_chunks=options.get('MAX_BUFFERED_CHUNKS', 16),
+        on_close=on_close,
+        first_chunk_timeout=options.get('FIRST_CHUNK_TIMEOUT_SECONDS', 120),
+    ).start()
+    return StreamingHttpResponse(stream, content_type=stream.content_type)
+
+
+@api_view(['POST'])
+def export_query(request):
+    try:
+        query = request.data.get('query')
+        db_config = request.data.get('db_config', {})
+        export_format = request.data.get('format', 'csv')
+
+        if not query:
+            return Response({'error': 'Query parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if export_format not in EXPORT_FORMATS:
+            return Response({'error': f'Unsupported export format: {export_format}'}, status=status.HTTP_400_BAD_REQUEST)
+        if not is_read_only(query):
+            return Response({'error': 'Only read-only SELECT statements can be exported'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            params = resolve_db_config(db_config)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # COPY is a single statement that runs until the client has the whole
+        # file, so the raw-SQL timeouts would cut slow downloads short
+        timeout_ms = _options().get('STATEMENT_TIMEOUT_MS', 600000)
+
+        # The export holds one of the database's export slots until it ends
+        limiter = export_limiters.get(params)
+        try:
+            limiter.acquire()
+        except TooManyQueries as e:
+            return Response({'error': str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                            headers={'Retry-After': str(e.retry_after)})
+        try:
+            if export_format == 'csv':
+                response = stream_copy(params, query, statement_timeout_ms=timeout_ms, on_close=limiter.release)
+            else:
+                response = stream_select(params, query, export_format, statement_timeout_ms=timeout_ms,
+                                         on_close=limiter.release,
+                                         batch_size=_options().get('ROW_GROUP_SIZE', 100000))
+        except Exception:
+            limiter.release()
+            raise
+        response['Content-Disposition'] = f'attachment; filename="export.{EXPORT_FORMATS[export_format]}"'
+        return response
+
+    except CostRejected as e:
+        return Response({'error': str(e), 'plan': e.plan}, status=status.HTTP_400_BAD_REQUEST)
+    except ExportStalled as e:
+        return Response({'error': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+    except QueryCanceledError:
+        return Response({'error': f'Query cancelled: it ran longer than the {timeout_ms} ms export timeout'},
+                        status=status.HTTP_504_GATEWAY_TIMEOUT)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
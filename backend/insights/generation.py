@@ -0,0 +1,95 @@
+"""
+Natural-language-to-SQL generation, shared by the sync and async views.
+
+``generation_steps`` holds the whole flow (prompt schema, model calls,
+identifier checks and retries, the response body) without doing any I/O
+of its own: it yields the arguments of each model call and is sent the
+model's answer back. ``run_generation`` and ``arun_generation`` drive it
+with a blocking or an awaitable call, so both views follow the same steps.
+"""
+from .generation_cache import GenerationCache
+from .metrics import count_cache, stage
+from .prompts import SQL_MODEL, clean_sql_output
+from .rollups import add_rollups
+from .schema_index import prune_schema
+from .sql_check import check_sql, problems_message, validation_info, validation_options
+
+
+def generation_key(snapshot, natural_language, error_handling_requested):
+    """
+    Generation cache key: deterministic (temperature=0) generations are
+    reused for the same question against the same schema
+    """
+    return GenerationCache.make_key(natural_language, snapshot.fingerprint, SQL_MODEL, error_handling_requested)
+
+
+def generation_steps(snapshot, natural_language, error_handling_requested, cached_sql=None):
+    """
+    Generate SQL for a question against snapshot, starting from cached_sql
+    when the generation cache had it. Yields (schema, question, error,
+    rollups) for every model call and returns the generate-sql response body.
+    """
+    generation_cache_hit = cached_sql is not None
+    count_cache('generation', generation_cache_hit)
+    # Only the tables relevant to the question go into the prompt
+    with stage('prompt'):
+        prompt_schema, prompt_tables, pruned = prune_schema(snapshot, natural_language)
+        prompt_schema, prompt_tables, rollups = add_rollups(snapshot, natural_language, prompt_schema, prompt_tables)
+    sql_query = cached_sql
+    if not generation_cache_hit:
+        sql_query = yield prompt_schema, natural_language, error_handling_requested, rollups
+
+    # Identifiers are checked against the full schema and fixed here when
+    # the intended one is clear; only what cannot be fixed goes back to the model
+    validation = None
+    enabled, model_retries = validation_options()
+    if enabled:
+        with stage('validate'):
+            check = check_sql(clean_sql_output(sql_query), snapshot.schema)
+        retries = 0
+        while check.problems and retries < model_retries and not generation_cache_hit:
+            retries += 1
+            sql_query = yield prompt_schema, natural_language, problems_message(check.problems), rollups
+            with stage('validate'):
+                check = check_sql(clean_sql_output(sql_query), snapshot.schema)
+        sql_query = check.sql
+        validation = validation_info(check, retries)
+
+    return {
+        'sql_query': sql_query,
+        'schema': snapshot.schema,
+        'schema_context': {'tables': prompt_tables, 'pruned': pruned, 'rollups': rollups},
+        'schema_cache_hit': snapshot.cache_hit,
+        'generation_cache_hit': generation_cache_hit,
+        'validation': validation,
+    }
+
+
+def should_cache(body):
+    """
+    Whether a generation is worth caching: a new one that validation passed
+    (or did not check). A cached generation is served without the model
+    retries, so one with problems left would stay broken until it expired.
+    """
+    validation = body['validation']
+    return not body['generation_cache_hit'] and (validation is None or not validation['problems'])
+
+
+def run_generation(steps, generate):
+    """Drive generation_steps, calling generate(*arguments) for each model call"""
+    try:
+        arguments = next(steps)
+        while True:
+            arguments = steps.send(generate(*arguments))
+    except StopIteration as done:
+        return done.value
+
+
+async def arun_generation(steps, generate):
+    """run_generation() for an async generate"""
+    try:
+        arguments = next(steps)
+        while True:
+            arguments = steps.send(await generate(*arguments))
+    except StopIteration as done:
+        return done.value
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def normalize_question(question):
+    """Fold case, whitespace and trailing punctuation so trivial rephrasings share a key"""
+    question = re.sub(r'\s+', ' ', question).strip().lower()
+    return question.rstrip(' ?.!;')
+
+
+class GenerationCache:
+    """
+    LRU cache of natural-language-to-SQL generations.
+
+    Entries live in memory up to max_entries and are written through to a
+    SQLite file so they survive restarts. Both tiers expire entries after
+    ttl seconds.
+    """
+
+    def __init__(self, path=None, max_entries=1024, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+    @staticmethod
+    def make_key(question, fingerprint, model, error_handling):
+        payload = json.dumps(
+            [normalize_question(question), fingerprint, model, error_handling or False],
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+                if entry is None:
+                    return None
+                self._remember(key, entry)
+            sql_query, created_at = entry
+            if now - created_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return sql_query
+
+    def put(self, key, sql_query):
+        entry = (sql_query, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            self._store(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            db = self._connect()
+            if db is not None:
+                with db:
+                    db.execute('DELETE FROM generations')
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _connect(self):
+        # Caller holds self._lock, which also serialises use of the connection
+        if self.path is None:
+            return None
+        if self._db is None:
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS generations ('
+                'key TEXT PRIMARY KEY, sql_query TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+        return self._db
+
+    def _load(self, key):
+        db = self._connect()
+        if db is None:
+            return None
+        row = db.execute(
+            'SELECT sql_query, created_at FROM generations WHERE key = ?', (key,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def _store(self, key, entry):
+        db = self._connect()
+        if db is None:
+            return
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO generations (key, sql_query, created_at) VALUES (?, ?, ?)',
+                (key, entry[0], entry[1]),
+            )
+            db.execute('DELETE FROM generations WHERE created_at < ?', (time.time() - self.ttl,))
+
+
+_options = getattr(settings, 'INSIGHTS_GENERATION_CACHE', {})
+generation_cache = GenerationCache(
+    path=_options.get('PATH'),
+    max_entries=_options.get('MAX_ENTRIES', 1024),
+    ttl=_options.get('TTL_SECONDS', 7 * 24 * 3600),
+)
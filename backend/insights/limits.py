@@ -0,0 +1,321 @@
+import asyncio
+import io
+import select
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from .models import Connection
+from .pool import pool_key
+
+
+class TooManyQueries(Exception):
+    """Raised when a database already has as many queries running and queued as allowed"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _options():
+    return getattr(settings, 'INSIGHTS_QUERY_LIMITS', {})
+
+
+class _Waiter:
+    """A queued request; release() hands it the slot and calls wake()"""
+
+    def __init__(self, wake):
+        self.granted = False
+        self.wake = wake
+
+
+class QueryLimiter:
+    """
+    Caps the number of queries running at once against one database.
+
+    Up to max_concurrent queries run; up to max_queued more wait (for at
+    most queue_timeout seconds) for a slot. Anything beyond that is
+    rejected straight away with TooManyQueries rather than piling onto the
+    database. Waiters, threads and coroutines alike, are served in arrival
+    order: a released slot passes straight to the first of them.
+    """
+
+    def __init__(self, name, max_concurrent=4, max_queued=16, queue_timeout=5):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queue = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+        with self._lock:
+            if self._admit():
+                return
+            cond = threading.Condition(self._lock)
+            waiter = self._enqueue(cond.notify)
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queue.remove(waiter)
+                    raise self._busy()
+                cond.wait(remaining)
+
+    async def acquire_async(self):
+        """acquire() for the event loop: waits without blocking the loop's thread"""
+        deadline = time.monotonic() + self.queue_timeout
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._lock:
+            if self._admit():
+                return
+            # release() may run on another thread
+            waiter = self._enqueue(lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            await asyncio.wait_for(event.wait(), max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter.granted:
+                    return  # granted just as the wait ran out
+                self._queue.remove(waiter)
+            raise self._busy()
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._release()
+                else:
+                    self._queue.remove(waiter)
+            raise
+
+    def release(self):
+        with self._lock:
+            self._release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def waiting(self):
+        return len(self._queue)
+
+    def _admit(self):
+        # Caller holds self._lock. Queued requests keep their place.
+        if self._active < self.max_concurrent and not self._queue:
+            self._active += 1
+            return True
+        return False
+
+    def _enqueue(self, wake):
+        if len(self._queue) >= self.max_queued:
+            raise self._busy()
+        waiter = _Waiter(wake)
+        self._queue.append(waiter)
+        return waiter
+
+    def _release(self):
+        # Caller holds self._lock. The slot stays taken when it is handed over.
+        while self._queue:
+            waiter = self._queue.popleft()
+            waiter.granted = True
+            try:
+                waiter.wake()
+                return
+            except RuntimeError:
+                waiter.granted = False  # its event loop is closed; try the next
+        self._active -= 1
+
+    def _busy(self):
+        return TooManyQueries(
+            f'Too many queries running against {self.name}; try again shortly',
+            retry_after=max(1, round(self.queue_timeout)),
+        )
+
+
+class LimiterManager:
+    """
+    Keeps one QueryLimiter per target database, shared by every user of it,
+    sized by the settings options() returns (INSIGHTS_QUERY_LIMITS by default)
+    """
+
+    def __init__(self, options=_options):
+        self.options = options
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, params):
+        key = (params['host'], params['port'], params['dbname'])
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                options = self.options()
+                limiter = QueryLimiter(
+                    f'{params["dbname"]}@{params["host"]}',
+                    max_concurrent=options.get('MAX_CONCURRENT', 4),
+                    max_queued=options.get('MAX_QUEUED', 16),
+                    queue_timeout=options.get('QUEUE_TIMEOUT', 5),
+                )
+                self._limiters[key] = limiter
+            return limiter
+
+    def clear(self):
+        with self._lock:
+            self._limiters.clear()
+
+
+query_limiters = LimiterManager()
+
+
+class ConfiguredTimeouts:
+    """
+    Connection records' statement timeouts by pool key, so requests do not
+    query the Connection table each time. Saving or deleting a record clears
+    this process's entries; other processes pick the change up within
+    TIMEOUT_CACHE_SECONDS.
+    """
+
+    def __init__(self):
+        self._entries = {}  # pool key -> (statement_timeout_ms or None, time read)
+        self._lock = threading.Lock()
+
+    def get(self, params):
+        """The matching active Connection record's statement_timeout_ms, or None"""
+        key = pool_key(params)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and now - entry[1] < _options().get('TIMEOUT_CACHE_SECONDS', 60):
+            return entry[0]
+        configured = Connection.objects.filter(
+            hostname=params['host'],
+            port=int(params['port']),
+            dbname=params['dbname'],
+            username=params['user'],
+            is_active=True,
+        ).values_list('statement_timeout_ms', flat=True).first()
+        with self._lock:
+            self._entries[key] = (configured, now)
+        return configured
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._entries.clear()
+
+
+configured_timeouts = ConfiguredTimeouts()
+post_save.connect(configured_timeouts.clear, sender=Connection, weak=False)
+post_delete.connect(configured_timeouts.clear, sender=Connection, weak=False)
+
+
+def statement_timeout_ms(params, data):
+    """
+    The statement timeout for one request: the request's own
+    statement_timeout_ms if given, else the matching Connection record's,
+    else the configured default. Capped at MAX_STATEMENT_TIMEOUT_MS.
+    """
+    options = _options()
+    maximum = options.get('MAX_STATEMENT_TIMEOUT_MS', 300000)
+    requested = data.get('statement_timeout_ms')
+    if requested is not None:
+        try:
+            requested = int(requested)
+        except (TypeError, ValueError):
+            raise ValueError('statement_timeout_ms must be an integer')
+        if not 1 <= requested <= maximum:
+            raise ValueError(f'statement_timeout_ms must be between 1 and {maximum}')
+        return requested
+
+    configured = configured_timeouts.get(params)
+    if configured is None:
+        configured = options.get('DEFAULT_STATEMENT_TIMEOUT_MS', 30000)
+    return min(configured, maximum) if configured else maximum
+
+
+def set_statement_timeout(conn, timeout_ms):
+    """Equivalent of SET LOCAL statement_timeout: lasts until the transaction ends"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT set_config('statement_timeout', %s, true)", (f'{timeout_ms}ms',))
+
+
+def client_socket(request):
+    """
+    The socket of the request's client connection, or None when the server
+    does not expose it. gunicorn passes it as gunicorn.socket; under
+    runserver and other wsgiref-based servers it is found by unwrapping
+    wsgi.input, a (Limited)stream over the socket's buffered reader.
+    """
+    sock = request.META.get('gunicorn.socket')
+    stream = request.META.get('wsgi.input')
+    for _ in range(5):
+        if sock is not None or stream is None:
+            break
+        if isinstance(stream, socket.socket):
+            sock = stream
+        elif isinstance(stream, socket.SocketIO):
+            stream = getattr(stream, '_sock', None)
+        elif isinstance(stream, io.BufferedIOBase):
+            stream = getattr(stream, 'raw', None)
+        else:
+            # Django's LimitedStream keeps the stream (4.2) or its read method (5.0+)
+            stream = getattr(stream, 'stream', None) or getattr(getattr(stream, '_read', None), '__self__', None)
+    return sock
+
+
+class DisconnectWatch:
+    """
+    Cancels conn's running statement if the HTTP client hangs up.
+
+    Needs the client socket (see client_socket); under servers that do not
+    expose it, such as uWSGI, this does nothing and the statement timeout
+    alone bounds the query.
+    """
+
+    def __init__(self, request, conn):
+        self.sock = client_socket(request)
+        self.conn = conn
+        self.cancelled = False
+        self._done = threading.Event()
+        self._thread = None
+        self._wake = None
+
+    def __enter__(self):
+        if self.sock is not None:
+            # __exit__ writes to one end so the watcher stops waiting at once
+            self._wake = socket.socketpair()
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        if self._thread is not None:
+            self._wake[1].send(b'x')
+            self._thread.join()
+            for end in self._wake:
+                end.close()
+
+    def _watch(self):
+        try:
+            readable, _, _ = select.select([self.sock, self._wake[0]], [], [])
+            if self._wake[0] in readable or self.sock.recv(1, socket.MSG_PEEK):
+                return  # the request is done, or a pipelined request is waiting
+        except (OSError, ValueError):
+            pass
+        if not self._done.is_set():
+            self.cancelled = True
+            self.conn.cancel()
@@ -0,0 +1,312 @@
+"""
+Process-wide gateway in front of the LLM provider.
+
+Every completion the insights views need goes through ``llm_gateway``,
+which keeps one HTTP client (and its keep-alive connections) for the life
+of the process, retries rate limits and server errors with jittered
+exponential backoff, coalesces identical prompts that are already in
+flight into a single call, and counts calls, latency and token usage per
+model.
+
+The provider sits behind a small backend interface (``complete`` and
+``acomplete`` returning a Completion, plus ``retry_after``), chosen with
+INSIGHTS_LLM['BACKEND'], so tests and local development can plug in a fake.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import registry, stage
+
+Completion = namedtuple('Completion', ['text', 'prompt_tokens', 'completion_tokens'])
+
+# HTTP statuses worth another attempt
+RETRYABLE_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+def _options():
+    return getattr(settings, 'INSIGHTS_LLM', {})
+
+
+class GroqBackend:
+    """
+    Completions from Groq. The sync client is shared by every thread; the
+    async client is kept per event loop, since its connections belong to
+    the loop that opened them. Either client can be passed in (e.g. a fake).
+    """
+
+    def __init__(self, client=None, async_client=None, timeout=None):
+        self._client = client
+        self._fixed_async_client = async_client
+        self._async_clients = {}
+        self._lock = threading.Lock()
+        self.timeout = timeout if timeout is not None else _options().get('TIMEOUT', 30)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from groq import Groq
+
+                # Retries are the gateway's job
+                self._client = Groq(api_key=os.environ.get('GROQ_API_KEY'), max_retries=0, timeout=self.timeout)
+            return self._client
+
+    def async_client(self):
+        if self._fixed_async_client is not None:
+            return self._fixed_async_client
+        loop = asyncio.get_running_loop()
+        entry = self._async_clients.get(id(loop))
+        if entry is None or entry[0] is not loop:
+            from groq import AsyncGroq
+
+            entry = (loop, AsyncGroq(api_key=os.environ.get('GROQ_API_KEY'), max_retries=0, timeout=self.timeout))
+            # Forget clients of loops that have gone (e.g. per-request loops under WSGI)
+            for loop_id, (other, _) in list(self._async_clients.items()):
+                if other.is_closed():
+                    del self._async_clients[loop_id]
+            self._async_clients[id(loop)] = entry
+        return entry[1]
+
+    def complete(self, messages, model, temperature, max_tokens):
+        response = self.client.chat.completions.create(
+            messages=messages, model=model, temperature=temperature, max_tokens=max_tokens,
+        )
+        return self._completion(response)
+
+    async def acomplete(self, messages, model, temperature, max_tokens):
+        response = await self.async_client().chat.completions.create(
+            messages=messages, model=model, temperature=temperature, max_tokens=max_tokens,
+        )
+        return self._completion(response)
+
+    @staticmethod
+    def _completion(response):
+        usage = getattr(response, 'usage', None)
+        return Completion(
+            response.choices[0].message.content.strip(),
+            getattr(usage, 'prompt_tokens', 0) or 0,
+            getattr(usage, 'completion_tokens', 0) or 0,
+        )
+
+    @staticmethod
+    def retry_after(error):
+        """
+        None when error is not worth retrying; otherwise the delay the
+        provider asked for (0 when it did not say).
+        """
+        import groq
+
+        if isinstance(error, groq.APIConnectionError):
+            return 0
+        if isinstance(error, groq.APIStatusError) and error.status_code in RETRYABLE_STATUSES:
+            try:
+                return float(error.response.headers.get('retry-after', 0))
+            except (TypeError, ValueError):
+                return 0
+        return None
+
+
+class _Flight:
+    """One in-flight call that identical concurrent calls wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncFlight:
+    """One in-flight async call: a task of its own, awaited by every caller"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class LLMGateway:
+    def __init__(self, backend, max_retries=3, backoff_base=0.5, backoff_max=8.0):
+        self.backend = backend
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._flights = {}
+        self._async_flights = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @staticmethod
+    def _key(messages, model, temperature, max_tokens):
+        payload = json.dumps([messages, model, temperature, max_tokens], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def complete(self, messages, model, temperature=0, max_tokens=1000):
+        """The completion text for messages; identical concurrent calls share one request"""
+        key = self._key(messages, model, temperature, max_tokens)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self._count(model, coalesced=1)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._call(model, lambda: self.backend.complete(messages, model, temperature, max_tokens))
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def acomplete(self, messages, model, temperature=0, max_tokens=1000):
+        """
+        complete() for async views, coalescing within the running event loop.
+        The upstream call runs as a task of its own that every caller awaits
+        through a shield, so a caller being cancelled leaves the others
+        waiting; the call itself is cancelled once nobody waits for it.
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), self._key(messages, model, temperature, max_tokens))
+        flight = self._async_flights.get(key)
+        if flight is None:
+            task = loop.create_task(
+                self._acall(model, lambda: self.backend.acomplete(messages, model, temperature, max_tokens)))
+            flight = self._async_flights[key] = _AsyncFlight(task)
+            task.add_done_callback(lambda _: self._end_async_flight(key, flight))
+        else:
+            self._count(model, coalesced=1)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Later identical calls start afresh rather than join a cancelled one
+                self._end_async_flight(key, flight)
+                flight.task.cancel()
+
+    def _end_async_flight(self, key, flight):
+        if self._async_flights.get(key) is flight:
+            del self._async_flights[key]
+
+    def _call(self, model, attempt):
+        for retry in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                with stage('llm'):
+                    completion = attempt()
+            except Exception as e:
+                delay = self._backoff(model, e, retry)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            return self._record(model, started, completion)
+
+    async def _acall(self, model, attempt):
+        for retry in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                with stage('llm'):
+                    completion = await attempt()
+            except Exception as e:
+                delay = self._backoff(model, e, retry)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            return self._record(model, started, completion)
+
+    def _backoff(self, model, error, retry):
+        """Seconds to wait before retrying after error, or None to give up"""
+        retry_after = self.backend.retry_after(error)
+        if retry_after is None or retry >= self.max_retries:
+            self._count(model, errors=1)
+            return None
+        self._count(model, retries=1)
+        # Full jitter, but never sooner than the provider asked for
+        return max(retry_after, random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry)))
+
+    def _record(self, model, started, completion):
+        latency = time.monotonic() - started
+        self._count(
+            model,
+            calls=1,
+            latency_seconds=latency,
+            prompt_tokens=completion.prompt_tokens,
+            completion_tokens=completion.completion_tokens,
+        )
+        with self._lock:
+            stats = self._stats[model]
+            stats['max_latency_seconds'] = max(stats['max_latency_seconds'], latency)
+        return completion.text
+
+    def _count(self, model, **amounts):
+        with self._lock:
+            stats = self._stats.setdefault(model, {
+                'calls': 0, 'errors': 0, 'retries': 0, 'coalesced': 0,
+                'latency_seconds': 0.0, 'max_latency_seconds': 0.0,
+                'prompt_tokens': 0, 'completion_tokens': 0,
+            })
+            for name, amount in amounts.items():
+                stats[name] += amount
+
+    def stats(self):
+        """Per-model counters: calls, errors, retries, coalesced, latency and tokens"""
+        with self._lock:
+            return {model: dict(stats) for model, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def _build_gateway():
+    options = _options()
+    backend_class = import_string(options.get('BACKEND', 'insights.llm.GroqBackend'))
+    return LLMGateway(
+        backend_class(),
+        max_retries=options.get('MAX_RETRIES', 3),
+        backoff_base=options.get('BACKOFF_BASE_SECONDS', 0.5),
+        backoff_max=options.get('BACKOFF_MAX_SECONDS', 8.0),
+    )
+
+
+llm_gateway = _build_gateway()
+
+
+def _collect_llm_metrics():
+    """The gateway's per-model counters as Prometheus counters"""
+    stats = llm_gateway.stats()
+    lines = []
+    for name, key, documentation in (
+        ('insights_llm_calls_total', 'calls', 'Completed LLM calls'),
+        ('insights_llm_errors_total', 'errors', 'LLM calls that failed after any retries'),
+        ('insights_llm_retries_total', 'retries', 'LLM calls retried after a rate limit or server error'),
+        ('insights_llm_coalesced_total', 'coalesced', 'LLM calls answered by an identical call in flight'),
+        ('insights_llm_prompt_tokens_total', 'prompt_tokens', 'Prompt tokens sent'),
+        ('insights_llm_completion_tokens_total', 'completion_tokens', 'Completion tokens received'),
+    ):
+        lines += [f'# HELP {name} {documentation}', f'# TYPE {name} counter']
+        lines += [f'{name}{{model="{model}"}} {counters[key]}' for model, counters in sorted(stats.items())]
+    return lines
+
+
+registry.add_collector(_collect_llm_metrics)
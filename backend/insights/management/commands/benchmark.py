@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from insights.benchmarks import (
+    BASELINES_PATH,
+    CASES,
+    SCALES,
+    load_baselines,
+    regressions,
+    run_benchmarks,
+    save_baselines,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Time schema building, NL-to-SQL prompt assembly and result serialization '
+        'against synthetic data and compare the best times with stored baselines.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('cases', nargs='*', metavar='case', help=f'Cases to run (default: all of {", ".join(CASES)})')
+        parser.add_argument('--scale', choices=list(SCALES), default='default',
+                            help='Schema and result sizes to run; "full" goes up to 50k columns and 2M rows')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case and size')
+        parser.add_argument('--baselines', default=str(BASELINES_PATH), help='Baseline file')
+        parser.add_argument('--threshold', type=float, default=0.5,
+                            help='Fail when a best time is this fraction slower than its baseline')
+        parser.add_argument('--save', action='store_true', help='Store these best times as the new baselines')
+
+    def handle(self, *args, **options):
+        baselines = load_baselines(options['baselines'])
+
+        def report(result):
+            key = f'{result.case}:{result.size}'
+            line = f'{key:<32} median {result.median * 1000:10.2f} ms   best {result.best * 1000:10.2f} ms'
+            if key in baselines:
+                line += f'   baseline {baselines[key] * 1000:10.2f} ms ({result.best / baselines[key]:.2f}x)'
+            self.stdout.write(line)
+
+        try:
+            results = run_benchmarks(options['scale'], options['cases'], options['repeat'], report)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['save']:
+            save_baselines(results, options['baselines'])
+            self.stdout.write(self.style.SUCCESS(f'Saved {len(results)} baselines to {options["baselines"]}'))
+            return
+
+        slower = regressions(results, baselines, options['threshold'])
+        if slower:
+            for regression in slower:
+                self.stderr.write(
+                    f'{regression.key}: {regression.best * 1000:.2f} ms is {regression.ratio:.2f}x '
+                    f'the baseline of {regression.baseline * 1000:.2f} ms')
+            raise CommandError(f'{len(slower)} benchmark(s) regressed by more than {options["threshold"]:.0%}')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
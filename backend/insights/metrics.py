@@ -0,0 +1,302 @@
+"""
+Per-stage timings and counters for the insights API.
+
+Code that does a distinct piece of work wraps it in ``stage(name)``. The
+time spent is observed in the ``insights_stage_seconds`` histogram and
+added to the current request's timings, which ServerTimingMiddleware
+sends back in a Server-Timing header. ``/metrics`` serves everything in
+the Prometheus text format.
+
+Metrics live in process memory, so each worker process reports its own;
+scrape every worker, or run a single process per target.
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _options():
+    return getattr(settings, 'INSIGHTS_METRICS', {})
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets or _options().get('BUCKETS', DEFAULT_BUCKETS))) + (math.inf,)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, amount, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += amount
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(labels.get(name, '') for name in self.labelnames))
+        return series[2] if series else 0
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (buckets, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, observed in zip(self.buckets, buckets):
+                    cumulative += observed
+                    labels = _labels(self.labelnames + ('le',), key + (_number(bound),))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {_number(total)}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collect):
+        """collect() returns extra exposition lines, computed at scrape time"""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        for collect in self._collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'insights_stage_seconds', 'Time spent in each stage of a request', ('view', 'stage')))
+request_seconds = registry.register(Histogram(
+    'insights_request_seconds', 'Time to produce a response, by view and status', ('view', 'status')))
+rows_returned = registry.register(Counter(
+    'insights_rows_returned_total', 'Result rows returned to clients', ('view',)))
+bytes_serialized = registry.register(Counter(
+    'insights_bytes_serialized_total', 'Response body bytes rendered', ('view',)))
+cache_lookups = registry.register(Counter(
+    'insights_cache_lookups_total', 'Schema, generation and result cache lookups', ('cache', 'result')))
+
+
+class RequestTimings:
+    """Stage durations of one request, in the order the stages first ran"""
+
+    def __init__(self, view):
+        self.view = view
+        self.started = time.perf_counter()
+        self.stages = OrderedDict()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def header(self):
+        total = time.perf_counter() - self.started
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+
+_current = contextvars.ContextVar('insights_request_timings', default=None)
+
+
+def current_timings():
+    return _current.get()
+
+
+def current_view():
+    timings = _current.get()
+    return timings.view if timings is not None else ''
+
+
+def resumed(timings, iterator):
+    """
+    Iterate a streaming response's content with timings current again, so
+    stages that run after the view has returned keep the view's label.
+    """
+    iterator = iter(iterator)
+    try:
+        while True:
+            token = _current.set(timings)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _current.reset(token)
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+@contextmanager
+def stage(name):
+    """Time a block as stage name of the current request (if any)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        timings = _current.get()
+        stage_seconds.observe(seconds, view=current_view(), stage=name)
+        if timings is not None:
+            timings.add(name, seconds)
+
+
+def count_rows(rows):
+    rows_returned.inc(rows, view=current_view())
+
+
+def count_cache(cache, hit):
+    cache_lookups.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+class ServerTimingMiddleware:
+    """
+    Times every request: the stages it ran go out in a Server-Timing header
+    (unless INSIGHTS_METRICS['SERVER_TIMING'] is False) and its total in
+    the insights_request_seconds histogram. Rendering DRF responses is
+    timed as the serialize stage. Works under both WSGI and ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = self._start(request)
+        try:
+            response = self.get_response(request)
+            return self._finish(response)
+        finally:
+            _current.reset(token)
+
+    async def __acall__(self, request):
+        token = self._start(request)
+        try:
+            response = await self.get_response(request)
+            return self._finish(response)
+        finally:
+            _current.reset(token)
+
+    @staticmethod
+    def _start(request):
+        # Labelled by route name rather than path so the series stay bounded
+        try:
+            match = resolve(request.path_info)
+            view = match.url_name or match.view_name
+        except Resolver404:
+            view = 'unresolved'
+        return _current.set(RequestTimings(view))
+
+    def process_template_response(self, request, response):
+        timings = _current.get()
+        started = time.perf_counter()
+
+        def rendered(response):
+            seconds = time.perf_counter() - started
+            stage_seconds.observe(seconds, view=timings.view, stage='serialize')
+            timings.add('serialize', seconds)
+
+        if timings is not None:
+            response.add_post_render_callback(rendered)
+        return response
+
+    def _finish(self, response):
+        timings = _current.get()
+        request_seconds.observe(time.perf_counter() - timings.started, view=timings.view, status=response.status_code)
+        if not response.streaming:
+            bytes_serialized.inc(len(response.content), view=timings.view)
+        if _options().get('SERVER_TIMING', True):
+            response['Server-Timing'] = timings.header()
+        return response
+
+
+def metrics_view(request):
+    """Every metric in the Prometheus text exposition format"""
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
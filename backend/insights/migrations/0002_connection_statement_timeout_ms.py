@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insights', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='statement_timeout_ms',
+            field=models.PositiveIntegerField(default=30000),
+        ),
+    ]
@@ -14,6 +14,7 @@ class Connection(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     last_connected_at = models.DateTimeField(null=True, blank=True)
+    statement_timeout_ms = models.PositiveIntegerField(default=30000)
 
     class Meta:
         ordering = ['-created_at']
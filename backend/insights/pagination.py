@@ -0,0 +1,109 @@
+from django.conf import settings
+from psycopg2 import sql
+
+from .explain import estimated_rows
+
+
+class PageRequest:
+    """
+    Paging parameters sent to /api/raw-sql/.
+
+    Offset paging uses page_size and page (1-based). Keyset paging is used
+    when order_by is given without page: each response returns next_after,
+    the order_by values of its last row, to send back as after for the next
+    page. Keyset paging stays fast at any depth but needs order_by to be
+    unique (add a tie-breaking column such as the primary key if not).
+    """
+
+    def __init__(self, page_size, page=None, order_by=None, descending=False, after=None):
+        self.page_size = page_size
+        self.page = page
+        self.order_by = order_by or []
+        self.descending = descending
+        self.after = after
+
+    @property
+    def keyset(self):
+        return bool(self.order_by) and self.page is None
+
+    @classmethod
+    def from_data(cls, data):
+        max_page_size = getattr(settings, 'INSIGHTS_PAGINATION', {}).get('MAX_PAGE_SIZE', 10000)
+        try:
+            page_size = int(data.get('page_size'))
+            page = int(data['page']) if data.get('page') is not None else None
+        except (TypeError, ValueError):
+            raise ValueError('page_size and page must be integers')
+        if not 1 <= page_size <= max_page_size:
+            raise ValueError(f'page_size must be between 1 and {max_page_size}')
+        if page is not None and page < 1:
+            raise ValueError('page must be 1 or greater')
+
+        order_by = data.get('order_by') or []
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        after = data.get('after')
+        if after is not None:
+            if not isinstance(after, list):
+                after = [after]
+            if len(after) != len(order_by):
+                raise ValueError('after must hold one value per order_by column')
+        return cls(page_size, page, order_by, bool(data.get('descending', False)), after)
+
+    def wrap(self, query):
+        """
+        Wrap query so that only this page (plus one row to detect more) is
+        fetched. Returns the composed statement and its parameters.
+        """
+        # The inner statement always goes through parameter interpolation
+        # (params is a list even when empty), so literal %s must be doubled
+        inner = sql.SQL(query.strip().rstrip(';').replace('%', '%%'))
+        columns = [sql.Identifier(column) for column in self.order_by]
+        direction = sql.SQL(' DESC' if self.descending else '')
+        parts = [sql.SQL('SELECT * FROM ({}) AS _page').format(inner)]
+        params = []
+
+        if self.keyset and self.after is not None:
+            parts.append(sql.SQL(' WHERE ({}) {} ({})').format(
+                sql.SQL(', ').join(columns),
+                sql.SQL('<' if self.descending else '>'),
+                sql.SQL(', ').join(sql.Placeholder() * len(columns)),
+            ))
+            params.extend(self.after)
+        if columns:
+            parts.append(sql.SQL(' ORDER BY {}').format(
+                sql.SQL(', ').join(sql.SQL('{}{}').format(column, direction) for column in columns)
+            ))
+        parts.append(sql.SQL(' LIMIT {}').format(sql.Literal(self.page_size + 1)))
+        if not self.keyset:
+            parts.append(sql.SQL(' OFFSET {}').format(sql.Literal(((self.page or 1) - 1) * self.page_size)))
+        return sql.Composed(parts), params
+
+
+def fetch_page(conn, query, page, total=None):
+    """
+    Run one page of query. Returns its columns, rows and a description of
+    where the page sits in the full result; total is the planner's row
+    estimate when the caller already has it.
+    """
+    statement, params = page.wrap(query)
+    with conn.cursor() as cursor:
+        if total is None:
+            total = estimated_rows(cursor, query)
+        cursor.execute(statement, params)
+        rows = cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description] if cursor.description else []
+
+    has_more = len(rows) > page.page_size
+    rows = rows[:page.page_size]
+    info = {
+        'page_size': page.page_size,
+        'has_more': has_more,
+        'estimated_total': total,
+    }
+    if page.keyset:
+        positions = [columns.index(column) for column in page.order_by]
+        info['next_after'] = [rows[-1][position] for position in positions] if has_more else None
+    else:
+        info['page'] = page.page or 1
+    return columns, rows, info
@@ -0,0 +1,199 @@
+"""
+The one-shot ask pipeline: question in, SQL, rows and charts out.
+
+/api/ask/ runs generation, execution and visualization in one request and
+reports each stage as a server-sent event as soon as it is ready:
+
+    event: sql      the generate-sql response body (sent again on a retry)
+    event: rows     the first rows of the result, as {"columns", "results", "plan"}
+    event: charts   {"visualizations", "source", "row_count", "truncated"}
+    event: error    {"stage", "error"}; the stream ends after it
+    event: done     {}
+
+A query the database rejects is regenerated only before its rows event;
+an error while the rest of the rows are read ends the stream with an
+error event of stage "fetch", so at most one rows event is ever sent.
+
+The result set never leaves the server between execution and charting.
+"""
+import uuid
+
+import psycopg2
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+
+from .charts import build_charts, max_points_from
+from .explain import CostRejected, guard
+from .metrics import count_rows, current_timings, resumed, stage
+from .limits import TooManyQueries, query_limiters, set_statement_timeout, statement_timeout_ms
+from .models import Connection
+from .pool import borrow, resolve_db_config
+from .profiling import Dataset
+from .prompts import VisualizationParseError, clean_sql_output
+from .renderers import dumps
+from .result_cache import is_read_only
+from .views import chart_specs, generate_sql_for
+
+# SQLSTATE classes of errors in the query itself, which a new generation can
+# fix: syntax errors and access rule violations (42) and data exceptions (22).
+# Timeouts, lost connections and the like are reported straight away.
+RETRYABLE_SQLSTATE_CLASSES = ('42', '22')
+
+
+def sse(event, data):
+    """One server-sent event carrying data as JSON"""
+    return f'event: {event}\ndata: {dumps(data).decode()}\n\n'
+
+
+def db_config_from(data):
+    """db_config from the request, or built from a saved Connection when connection_id is given"""
+    connection_id = data.get('connection_id')
+    if connection_id is None:
+        return data.get('db_config', {})
+    try:
+        connection = Connection.objects.get(pk=connection_id)
+    except (Connection.DoesNotExist, ValueError, TypeError):
+        raise ValueError(f'Unknown connection: {connection_id}')
+    return {
+        'name': connection.dbname,
+        'user': connection.username,
+        'password': connection.password,
+        'host': connection.hostname,
+        'port': connection.port,
+    }
+
+
+class FetchFailed(Exception):
+    """A database error raised after the rows event went out; its cause is the error"""
+
+
+def fetch_rows(params, query, timeout_ms, preview_rows, max_rows):
+    """
+    Run a read-only query on a server-side cursor once the cost guard has
+    passed it. Yields the rows event as soon as the first preview_rows rows
+    arrive, keeps reading up to max_rows, and returns (columns, rows, truncated).
+    Database errors after the rows event are raised as FetchFailed.
+    """
+    batch_size = getattr(settings, 'INSIGHTS_STREAM_BATCH_SIZE', 2000)
+    with borrow(params) as conn:
+        set_statement_timeout(conn, timeout_ms)
+        with conn.cursor() as cursor, stage('plan'):
+            _, plan, _ = guard(cursor, query)
+        with conn.cursor(name=f'insights_ask_{uuid.uuid4().hex}') as cursor:
+            with stage('execute'):
+                cursor.execute(query)
+                rows = cursor.fetchmany(min(preview_rows, max_rows))
+            columns = [desc[0] for desc in cursor.description] if cursor.description else []
+            yield sse('rows', {'columns': columns, 'results': [dict(zip(columns, row)) for row in rows], 'plan': plan})
+
+            try:
+                with stage('fetch'):
+                    while len(rows) < max_rows:
+                        batch = cursor.fetchmany(min(batch_size, max_rows - len(rows)))
+                        if not batch:
+                            break
+                        rows.extend(batch)
+                    truncated = len(rows) >= max_rows and bool(cursor.fetchmany(1))
+            except psycopg2.Error as e:
+                raise FetchFailed(str(e)) from e
+    count_rows(len(rows))
+    return columns, rows, truncated
+
+
+def pipeline_events(data, db_config, params, max_points):
+    """The event stream of one question; see the module docstring"""
+    options = getattr(settings, 'INSIGHTS_PIPELINE', {})
+    natural_language = data['natural_language']
+    error_handling_requested = data.get('error', False)
+    retries = options.get('RETRIES', 1)
+
+    for attempt in range(retries + 1):
+        try:
+            generation = generate_sql_for(db_config, natural_language, error_handling_requested)
+        except Exception as e:
+            yield sse('error', {'stage': 'generate', 'error': str(e)})
+            return
+        query = clean_sql_output(generation['sql_query'])
+        yield sse('sql', dict(generation, sql_query=query, attempt=attempt + 1))
+
+        if not is_read_only(query):
+            yield sse('error', {
+                'stage': 'execute',
+                'error': 'Only read-only SELECT statements are run automatically; send this one to /api/raw-sql/',
+            })
+            return
+
+        limiter = query_limiters.get(params)
+        try:
+            limiter.acquire()
+        except TooManyQueries as e:
+            yield sse('error', {'stage': 'execute', 'error': str(e), 'retry_after': e.retry_after})
+            return
+        try:
+            columns, rows, truncated = yield from fetch_rows(
+                params, query, statement_timeout_ms(params, data),
+                options.get('PREVIEW_ROWS', 100), options.get('MAX_ROWS', 100000),
+            )
+        except CostRejected as e:
+            yield sse('error', {'stage': 'execute', 'error': str(e), 'plan': e.plan})
+            return
+        except FetchFailed as e:
+            # Rows were already sent; a new query now would send a second set
+            yield sse('error', {'stage': 'fetch', 'error': str(e)})
+            return
+        except psycopg2.Error as e:
+            # Give the model one more go with the database's error, as the
+            # client does when /api/raw-sql/ reports a missing relation
+            if attempt < retries and (e.pgcode or '')[:2] in RETRYABLE_SQLSTATE_CLASSES:
+                error_handling_requested = str(e).strip()
+                continue
+            yield sse('error', {'stage': 'execute', 'error': str(e)})
+            return
+        finally:
+            limiter.release()
+        break
+
+    try:
+        result_set = Dataset.from_rows(columns, rows)
+        specs, source = chart_specs(result_set) if rows else ([], 'rules')
+        visualizations = build_charts(result_set, specs, max_points)
+    except VisualizationParseError as e:
+        yield sse('error', {'stage': 'visualize', 'error': str(e), 'raw': e.raw})
+        return
+    except Exception as e:
+        yield sse('error', {'stage': 'visualize', 'error': str(e)})
+        return
+    yield sse('charts', {
+        'visualizations': visualizations,
+        'source': source,
+        'row_count': len(rows),
+        'truncated': truncated,
+    })
+    yield sse('done', {})
+
+
+@api_view(['POST'])
+def ask(request):
+    natural_language = request.data.get('natural_language')
+    if not natural_language:
+        return Response({'error': 'Natural language query is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        db_config = db_config_from(request.data)
+        params = resolve_db_config(db_config)
+        max_points = max_points_from(request.data)
+        statement_timeout_ms(params, request.data)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    response = StreamingHttpResponse(
+        resumed(current_timings(), pipeline_events(request.data, db_config, params, max_points)),
+        content_type='text/event-stream',
+    )
+    # Keep proxies from buffering the events
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,249 @@
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from django.conf import settings
+from psycopg2.extensions import QueryCanceledError
+
+from .metrics import stage
+
+# Credentials used when a request does not carry its own db_config
+DEFAULT_DB_CONFIG = {
+    'name': 'querydb',
+    'user': 'user',
+    'password': 'password',
+    'host': 'querydb',
+    'port': '5432'
+}
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection becomes available within the acquire timeout"""
+
+
+def resolve_db_config(db_config):
+    """
+    Turn a request's db_config into psycopg2 connect parameters.
+    Falls back to the default querydb credentials when db_config is empty.
+    """
+    if not db_config:
+        db_config = DEFAULT_DB_CONFIG
+
+    params = {
+        'dbname': db_config.get('name'),
+        'user': db_config.get('user'),
+        'password': db_config.get('password'),
+        'host': db_config.get('host'),
+        'port': str(db_config.get('port') or '5432'),
+    }
+    if not all([params['dbname'], params['user'], params['password'], params['host']]):
+        raise ValueError('Incomplete database credentials')
+    return params
+
+
+def pool_key(params):
+    """
+    Key a pool by (host, port, dbname, user). A digest of the password is
+    included so a request with the wrong password never borrows a connection
+    that was authenticated by someone else.
+    """
+    password_digest = hashlib.sha256(params['password'].encode()).hexdigest()
+    return (params['host'], params['port'], params['dbname'], params['user'], password_digest)
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of psycopg2 connections to a single database.
+
+    Released connections are rolled back and their session state is
+    discarded. Idle connections are reused most-recently-used first, closed
+    after sitting idle for longer than max_idle (down to min_size), and
+    pinged before reuse when they have not been used for
+    health_check_interval.
+    """
+
+    def __init__(self, params, min_size=1, max_size=10, max_idle=300,
+                 health_check_interval=30, acquire_timeout=10):
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # (connection, last_used) pairs, most recent last
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                self._evict_idle()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted(
+                            f'No connection to {self.params["dbname"]}@{self.params["host"]} '
+                            f'available after {self.acquire_timeout}s'
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    return psycopg2.connect(**self.params)
+                except Exception:
+                    self._forget()
+                    raise
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                # Drop any transaction the borrower left open, then the session
+                # state it left behind (SET, temporary tables, prepared
+                # statements, advisory locks), as asyncpg's pool does on
+                # release. DISCARD ALL cannot run inside a transaction.
+                conn.rollback()
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute('DISCARD ALL')
+                finally:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _evict_idle(self):
+        # Caller holds self._cond. Oldest idle connections sit at the front.
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size:
+            conn, last_used = self._idle[0]
+            if now - last_used < self.max_idle:
+                break
+            self._idle.pop(0)
+            self._size -= 1
+            self._close_quietly(conn)
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class PoolManager:
+    """Keeps one ConnectionPool per resolved set of credentials"""
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, params):
+        key = pool_key(params)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                options = getattr(settings, 'INSIGHTS_POOL', {})
+                pool = ConnectionPool(
+                    params,
+                    min_size=options.get('MIN_SIZE', 1),
+                    max_size=options.get('MAX_SIZE', 10),
+                    max_idle=options.get('MAX_IDLE_SECONDS', 300),
+                    health_check_interval=options.get('HEALTH_CHECK_INTERVAL', 30),
+                    acquire_timeout=options.get('ACQUIRE_TIMEOUT', 10),
+                )
+                self._pools[key] = pool
+            return pool
+
+    def close_all(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+
+pools = PoolManager()
+
+
+def is_broken(error):
+    """
+    Whether error leaves its connection unusable. A cancelled statement
+    (statement_timeout or cancel()) is raised as QueryCanceledError, an
+    OperationalError, but its connection only needs the rollback release() does.
+    """
+    return (isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            and not isinstance(error, QueryCanceledError))
+
+
+@contextmanager
+def borrow(params):
+    """
+    Borrow a pooled connection for the duration of a with block.
+    Connections that fail at the transport level are discarded, not reused.
+    """
+    pool = pools.get(params)
+    with stage('connect'):
+        conn = pool.acquire()
+    discard = False
+    try:
+        yield conn
+    except Exception as e:
+        discard = is_broken(e)
+        raise
+    finally:
+        pool.release(conn, discard=discard)
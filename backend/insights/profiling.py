@@ -0,0 +1,222 @@
+import datetime
+import decimal
+import uuid
+
+import numpy as np
+from django.conf import settings
+
+NUMERIC = 'numeric'
+TEMPORAL = 'temporal'
+CATEGORICAL = 'categorical'
+
+
+def _nonnull_mask(values):
+    return ~np.equal(values, None)
+
+
+def _as_float(values, numeric_strings=True):
+    """values as float64 with NaN for nulls, or None if any value is not a number"""
+    mask = _nonnull_mask(values)
+    present = values[mask]
+    excluded = (bool, dict, list) if numeric_strings else (bool, dict, list, str)
+    if not len(present) or any(isinstance(value, excluded) for value in present):
+        return None
+    try:
+        numbers = present.astype(np.float64)
+    except (TypeError, ValueError):
+        return None
+    result = np.full(len(values), np.nan)
+    result[mask] = numbers
+    return result
+
+
+def _as_datetime(values):
+    """values as datetime64[ms] with NaT for nulls, or None if any value is not a date/time"""
+    mask = _nonnull_mask(values)
+    present = values[mask]
+    if not len(present) or not all(isinstance(value, str) and len(value) >= 8 for value in present):
+        return None
+    # numpy parses ISO 8601 but not UTC offsets; the local wall time is what gets charted
+    trimmed = np.char.partition(np.char.replace(present.astype(str), 'Z', ''), '+')[:, 0]
+    trimmed = np.where(np.char.count(trimmed, '-') > 2, np.char.rpartition(trimmed, '-')[:, 0], trimmed)
+    try:
+        stamps = trimmed.astype('datetime64[ms]')
+    except ValueError:
+        return None
+    result = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ms]')
+    result[mask] = stamps
+    return result
+
+
+class Dataset:
+    """
+    A query result held column by column as NumPy arrays.
+
+    Built from either body /api/raw-sql/ returns: a list of row objects
+    ('records') or {'columns': [...], 'data': [[...], ...]} ('columnar').
+    Each column's role is inferred once: numeric, temporal (ISO date and
+    timestamp strings) or categorical (everything else). Strings holding
+    numbers count as numeric, since that is how Decimal values arrive in
+    JSON, unless numeric_strings is False.
+    """
+
+    def __init__(self, names, columns, numeric_strings=True):
+        self.names = list(names)
+        self.columns = columns
+        self.row_count = len(columns[self.names[0]]) if self.names else 0
+        self.roles = {}
+        self._numbers = {}
+        self._times = {}
+        for name in self.names:
+            numbers = _as_float(columns[name], numeric_strings)
+            if numbers is not None:
+                self.roles[name], self._numbers[name] = NUMERIC, numbers
+                continue
+            times = _as_datetime(columns[name])
+            if times is not None:
+                self.roles[name], self._times[name] = TEMPORAL, times
+            else:
+                self.roles[name] = CATEGORICAL
+
+    @classmethod
+    def from_payload(cls, dataset):
+        if isinstance(dataset, dict) and 'columns' in dataset:
+            names = dataset['columns']
+            data = dataset.get('data') or [[] for _ in names]
+            return cls(names, {name: _object_array(values) for name, values in zip(names, data)})
+        if isinstance(dataset, list) and all(isinstance(row, dict) for row in dataset):
+            names = list(dataset[0]) if dataset else []
+            return cls(names, {name: _object_array([row.get(name) for row in dataset]) for name in names})
+        raise ValueError('Dataset must be a list of row objects or {"columns": [...], "data": [...]}')
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        """From a cursor's column names and row tuples, where text is never a number"""
+        names = list(columns)
+        data = list(zip(*rows)) if rows else [() for _ in names]
+        arrays = {name: _object_array(_json_like(values)) for name, values in zip(names, data)}
+        return cls(names, arrays, numeric_strings=False)
+
+    def numbers(self, name):
+        return self._numbers[name]
+
+    def times(self, name):
+        return self._times[name]
+
+    def labels(self, name):
+        """A column as strings (None for nulls), for grouping and display"""
+        values = self.columns[name]
+        mask = _nonnull_mask(values)
+        labels = np.full(len(values), None, dtype=object)
+        labels[mask] = values[mask].astype(str)
+        return labels
+
+    def row(self, index):
+        return {name: self.columns[name][index] for name in self.names}
+
+
+def _json_like(values):
+    """Database values as the JSON encoder would send them (Decimal as number, dates as ISO text)"""
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, decimal.Decimal):
+        return [None if value is None else float(value) for value in values]
+    if isinstance(sample, (datetime.date, datetime.time)):
+        return [None if value is None else value.isoformat() for value in values]
+    if isinstance(sample, uuid.UUID):
+        return [None if value is None else str(value) for value in values]
+    return values
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _round(value):
+    return float(round(value, 4))
+
+
+def profile_column(dataset, name, top=5):
+    """Role, null count, cardinality and summary statistics of one column"""
+    role = dataset.roles[name]
+    profile = {'name': name, 'role': role}
+    if role == NUMERIC:
+        numbers = dataset.numbers(name)
+        present = numbers[~np.isnan(numbers)]
+        p25, p50, p75 = np.percentile(present, [25, 50, 75])
+        profile.update({
+            'nulls': int(len(numbers) - len(present)),
+            'distinct': int(len(np.unique(present))),
+            'min': _round(present.min()),
+            'max': _round(present.max()),
+            'mean': _round(present.mean()),
+            'std': _round(present.std()),
+            'p25': _round(p25),
+            'median': _round(p50),
+            'p75': _round(p75),
+            'integer': bool(np.all(present == np.round(present))),
+        })
+    elif role == TEMPORAL:
+        times = dataset.times(name)
+        present = times[~np.isnat(times)]
+        profile.update({
+            'nulls': int(len(times) - len(present)),
+            'distinct': int(len(np.unique(present))),
+            'min': str(present.min().astype('datetime64[s]')),
+            'max': str(present.max().astype('datetime64[s]')),
+        })
+    else:
+        labels = dataset.labels(name)
+        present = labels[_nonnull_mask(labels)].astype(str)
+        values, counts = np.unique(present, return_counts=True)
+        order = np.argsort(-counts, kind='stable')[:top]
+        profile.update({
+            'nulls': int(len(labels) - len(present)),
+            'distinct': int(len(values)),
+            'top': [[str(values[i]), int(counts[i])] for i in order],
+        })
+    return profile
+
+
+def profile_dataset(dataset):
+    return {
+        'row_count': dataset.row_count,
+        'columns': [profile_column(dataset, name) for name in dataset.names],
+    }
+
+
+def sample_rows(dataset, size=None):
+    """
+    Up to size rows (INSIGHTS_VISUALIZATION's SAMPLE_ROWS by default)
+    spread across the dataset. When there is a categorical
+    column with a handful of values, every value gets rows in proportion to
+    its share (and at least one), so rare groups are still seen.
+    """
+    if size is None:
+        size = getattr(settings, 'INSIGHTS_VISUALIZATION', {}).get('SAMPLE_ROWS', 20)
+    total = dataset.row_count
+    if total <= size:
+        return [dataset.row(i) for i in range(total)]
+
+    strata = None
+    for name in dataset.names:
+        if dataset.roles[name] == CATEGORICAL:
+            labels = dataset.labels(name).astype(str)
+            keys, inverse = np.unique(labels, return_inverse=True)
+            if 1 < len(keys) <= size and (strata is None or len(keys) < strata[0]):
+                strata = (len(keys), inverse)
+
+    if strata is None:
+        indices = np.unique(np.linspace(0, total - 1, size).round().astype(int))
+    else:
+        count, inverse = strata
+        sizes = np.bincount(inverse, minlength=count)
+        quotas = np.maximum(1, np.floor(sizes * size / total)).astype(int)
+        picked = []
+        for stratum in range(count):
+            members = np.flatnonzero(inverse == stratum)
+            positions = np.linspace(0, len(members) - 1, min(quotas[stratum], len(members))).round().astype(int)
+            picked.append(members[positions])
+        indices = np.unique(np.concatenate(picked))
+    return [dataset.row(int(i)) for i in indices]
@@ -0,0 +1,152 @@
+import json
+import re
+
+from rest_framework.utils.encoders import JSONEncoder
+
+SQL_MODEL = "llama3-8b-8192"
+VISUALIZATION_MODEL = "mixtral-8x7b-32768"
+
+
+class VisualizationParseError(ValueError):
+    """The model's answer did not contain a usable JSON array"""
+
+    def __init__(self, message, raw):
+        super().__init__(message)
+        self.raw = raw
+
+
+def describe_table(table_name, columns):
+    """One table's block of the schema description sent to the model"""
+    lines = [f"Table: {table_name}\n"]
+    for column in columns:
+        line = f"  - {column['column_name']} ({column['data_type']})"
+        if column['is_nullable'] == 'YES':
+            line += " NULL"
+        if column.get('comment'):
+            line += f" -- {column['comment']}"
+        lines.append(line + "\n")
+    return ''.join(lines)
+
+
+def format_schema(schema_info):
+    """Describe a {schema: {table: [columns]}} mapping for the prompt"""
+    parts = ["Database Schema:\n"]
+    for schema_name, tables in schema_info.items():
+        parts.append(f"Schema: {schema_name}\n")
+        for table_name, columns in tables.items():
+            parts.append(describe_table(table_name, columns))
+        parts.append("\n")
+    return ''.join(parts)
+
+
+def describe_rollups(rollups):
+    """Hint block naming the rollup tables that can answer the question"""
+    lines = ["Pre-aggregated rollup tables (one row per period, kept up to date from their source tables):\n"]
+    for rollup in rollups:
+        lines.append(f"  - {rollup['table']}: {rollup['description']} "
+                     f"(one row per {rollup['grain']}; aggregates {', '.join(rollup['sources'])})\n")
+        if rollup.get('distinct'):
+            lines.append(f"    Distinct counts, exact for a single row only: {', '.join(rollup['distinct'])}. "
+                         "Never sum or otherwise re-aggregate them across rows; count distinct values "
+                         "in the source table instead.\n")
+    lines.append("Prefer a rollup table over aggregating its source table whenever it has the columns the "
+                 "question needs; sum its other counts to answer at a coarser period.\n")
+    return ''.join(lines)
+
+
+def sql_messages(schema_info, natural_language, error_handling_requested, rollups=None):
+    """Build the chat messages asking the model to translate a question into SQL"""
+    # Format schema for prompt
+    schema_description = format_schema(schema_info)
+    if rollups:
+        schema_description += describe_rollups(rollups)
+
+    # Create the base prompt
+    base_prompt = f"""Given the following database schema:
+    {schema_description}
+    Convert this natural language query to SQL: "{natural_language}"
+    Respond with ONLY the SQL query, no explanations or additional text.
+    Ensure that both table names and column names are properly quoted with double quotes. 
+    For example, generate queries like:
+    SELECT * FROM "UserWorkspace" INNER JOIN "User" ON "UserWorkspace"."userId" = "User"."id";
+    This guarantees the query is valid PostgreSQL syntax.
+    """
+
+    # Modify prompt for error handling if requested
+    if error_handling_requested:
+        prompt = base_prompt + f"""\n\nWhen generating the SQL query, please be extra careful to avoid potential errors. Ensure that the query is robust and handles cases where data might be missing or inconsistent. Focus on generating a query that is less likely to fail, even if it means being slightly less precise in perfectly capturing the natural language intent. prioritize correctness and stability over aggressive data retrieval.Check for upper case or lower case values issue. Check for proper or similar column names. The error message is: {error_handling_requested}"""
+    else:
+        prompt = base_prompt
+
+    return [
+        {
+            "role": "system",
+            "content": "You are a SQL expert that converts natural language to SQL queries. Only respond with the SQL query, no explanations."
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+def clean_sql_output(raw_output):
+    """Strip the markdown fences and escaping the model sometimes wraps its SQL in"""
+    sql_query = re.sub(r'\\+', r'\\', raw_output)
+    sql_query = sql_query.replace('\\*', '*').replace('\\_', '_')
+    sql_query = re.sub(r'```sql\n?', '', sql_query).replace('```', '')
+    return sql_query.strip()
+
+
+def visualization_messages(profile, sample):
+    """
+    Build the chat messages asking the model to pick charts for a dataset.
+
+    The model only sees the dataset's profile and a few sample rows and
+    answers with chart specs; the charts themselves are computed locally
+    from the full data.
+    """
+    prompt = f"""Choose the most relevant and meaningful visualizations for a query result.
+        The result has {profile['row_count']} rows. Each column is described with its role
+        (categorical, temporal or numeric), number of distinct values and summary statistics:
+        {json.dumps(profile['columns'], cls=JSONEncoder)}
+
+        Some sample rows: {json.dumps(sample, cls=JSONEncoder)}
+
+        For each chart give its type (bar, pie or line), the column for the x axis or pie slices,
+        the numeric column to plot (or null to count rows) and how to aggregate it per x value
+        (sum, mean, count, min or max). Line charts need a temporal or numeric x column.
+        Skip chart types that do not suit the data; return several charts of a type if useful.
+        Provide ONLY the JSON output in the following format:
+        [
+            {{ "type": "bar", "x": "", "y": "", "aggregate": "sum" }},
+            {{ "type": "pie", "x": "", "y": null, "aggregate": "count" }},
+            {{ "type": "line", "x": "", "y": "", "aggregate": "mean" }}
+        ]
+
+        Output ONLY valid JSON without any extra commentary or explanations."""
+
+    return [
+        {
+            "role": "system",
+            "content": "You are a data visualization expert. Output ONLY valid JSON for visualizations in the requested format, without any commentary or extra text."
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+def extract_visualizations(raw_output):
+    """Pull the JSON array of visualizations out of the model's answer"""
+    # Attempt to extract only the JSON array from the response
+    start_index = raw_output.find('[')
+    end_index = raw_output.rfind(']')
+    if start_index == -1 or end_index == -1:
+        raise VisualizationParseError('No JSON array found in response', raw_output)
+    json_str = raw_output[start_index:end_index+1]
+    try:
+        return json.loads(json_str)
+    except Exception as e:
+        raise VisualizationParseError(f'Failed to parse JSON: {e}', raw_output)
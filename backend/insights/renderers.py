@@ -0,0 +1,156 @@
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder is used instead
+    orjson = None
+
+RESULT_FORMATS = ('records', 'columnar', 'msgpack', 'arrow')
+
+_drf_encoder = JSONEncoder()
+
+
+def encode_value(value):
+    """
+    JSON form of a value JSON has no type for. numeric (Decimal) becomes
+    its exact text, or a float with INSIGHTS_DECIMAL_AS_FLOAT; bytea
+    (memoryview from psycopg2, bytes from asyncpg) becomes Postgres' hex
+    text, \\x...; everything else converts as DRF's JSONEncoder does
+    (timedelta to seconds, numpy values to lists and scalars).
+    """
+    # numeric columns are the common case, so they are checked first
+    if type(value) is Decimal:
+        return float(value) if getattr(settings, 'INSIGHTS_DECIMAL_AS_FLOAT', False) else str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    return _drf_encoder.default(value)
+
+
+class ResultEncoder(JSONEncoder):
+    """The stdlib encoder with encode_value's conversions"""
+
+    def default(self, obj):
+        return encode_value(obj)
+
+
+if orjson is not None:
+    # Datetimes, dates, times, UUIDs and numpy arrays are written natively,
+    # UTC datetimes ending in Z as DRF's encoder writes them; encode_value
+    # is only called for the rest (Decimal, bytea, ...)
+    ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def dumps(data):
+    """
+    Compact UTF-8 JSON (bytes) for data, written by orjson where it is
+    installed. Bodies orjson refuses (e.g. integers over 64 bits) go
+    through ResultEncoder instead.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=encode_value, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data, cls=ResultEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def shape_results(result_format, columns, rows):
+    """
+    Lay rows out for the requested format. 'records' is the original
+    list-of-objects body; every other format is column oriented so each
+    column name is sent once and no per-row dict is built.
+    """
+    if result_format == 'records':
+        return {'results': [dict(zip(columns, row)) for row in rows]}
+    data = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+    return {'columns': list(columns), 'data': data}
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    DRF's JSONRenderer on dumps(), which is several times faster for large
+    result bodies. Indented output (?indent= in the Accept header) is left
+    to DRF.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped as DRF does, so the body is safe to embed in a <script>
+        return dumps(data).replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        import msgpack
+
+        if data is None:
+            return b''
+        # Fall back to the same conversions the JSON renderer applies
+        return msgpack.packb(data, default=encode_value, use_bin_type=True)
+
+
+class ArrowStreamRenderer(BaseRenderer):
+    """
+    Renders a columnar body as an Arrow IPC stream. Any other keys of the
+    body (e.g. cache or page information, or an error) are attached as
+    JSON schema metadata.
+    """
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        import pyarrow as pa
+
+        if data is None:
+            return b''
+        columns = data.get('columns', [])
+        arrays = [self._array(pa, values) for values in data.get('data', [])]
+        extra = {key: value for key, value in data.items() if key not in ('columns', 'data')}
+        metadata = {'insights': dumps(extra).decode()} if extra else None
+        table = pa.Table.from_arrays(arrays, names=columns, metadata=metadata)
+
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    @staticmethod
+    def _array(pa, values):
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            # Types Arrow cannot infer (UUID, intervals, mixed columns) go as text
+            return pa.array([None if value is None else as_text(value) for value in values])
+
+
+def as_text(value):
+    """A value as text for columns Arrow has no type for; json and jsonb values stay JSON"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return dumps(value).decode()
+    try:
+        return str(encode_value(value))
+    except TypeError:
+        return str(value)
+
+
+RENDERERS_BY_FORMAT = {
+    'msgpack': MessagePackRenderer,
+    'arrow': ArrowStreamRenderer,
+}
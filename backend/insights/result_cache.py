@@ -0,0 +1,180 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import psycopg2.extras
+import sqlparse
+from django.conf import settings
+from sqlparse.sql import Identifier, IdentifierList, Parenthesis
+from sqlparse.tokens import DML, Keyword
+
+# Tuple counters move on every committed write to a table. Other backends
+# flush their statistics asynchronously (up to several seconds later), so
+# entries also carry a TTL as a backstop for writes made outside the API.
+# Writes to a partitioned table are counted on its partitions, so the
+# counters of every table in each referenced table's partition tree go in.
+WRITE_MARKER_QUERY = """
+    SELECT coalesce(md5(string_agg(
+        stats.relid::text || ':' || stats.n_tup_ins || ':' || stats.n_tup_upd || ':' || stats.n_tup_del
+            || ':' || stats.n_live_tup,
+        ',' ORDER BY stats.relid
+    )), '') AS marker
+    FROM pg_catalog.pg_class
+    CROSS JOIN LATERAL pg_catalog.pg_partition_tree(pg_class.oid) AS tree
+    JOIN pg_catalog.pg_stat_user_tables AS stats ON stats.relid = tree.relid
+    WHERE pg_class.relname = ANY(%s) AND pg_class.relkind IN ('r', 'p');
+"""
+
+# Functions and clauses that make a SELECT write or lock something
+_UNSAFE_SELECT = re.compile(
+    r'\b(nextval|setval|pg_advisory_\w*|pg_sleep|lo_\w+|dblink\w*)\s*\(|\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b',
+    re.IGNORECASE,
+)
+
+CacheLookup = namedtuple('CacheLookup', ['key', 'marker', 'entry'])
+
+
+def is_read_only(query):
+    """True for a single SELECT (or WITH ... SELECT) that writes nothing"""
+    statements = [s for s in sqlparse.parse(query) if s.token_first(skip_cm=True) is not None]
+    if len(statements) != 1 or statements[0].get_type() != 'SELECT':
+        return False
+    for token in statements[0].flatten():
+        if token.ttype is DML and token.normalized != 'SELECT':
+            return False
+        if token.ttype is Keyword and token.normalized == 'INTO':
+            return False
+    return not _UNSAFE_SELECT.search(query)
+
+
+def normalize_sql(query):
+    """Strip comments, fold keyword case and whitespace so equivalent statements share a key"""
+    query = sqlparse.format(query, strip_comments=True, keyword_case='upper')
+    return re.sub(r'\s+', ' ', query).strip().rstrip(';').strip()
+
+
+def referenced_tables(query):
+    """Names of the relations a statement reads from (schema qualifiers dropped)"""
+    tables = set()
+    for statement in sqlparse.parse(query):
+        _collect_tables(statement, tables)
+    return sorted(tables)
+
+
+def _collect_tables(token_list, tables):
+    expecting = False
+    for token in token_list.tokens:
+        if token.is_whitespace or token.ttype in sqlparse.tokens.Comment:
+            continue
+        if expecting:
+            if isinstance(token, IdentifierList):
+                for identifier in token.get_identifiers():
+                    _add_table(identifier, tables)
+            elif isinstance(token, Identifier):
+                _add_table(token, tables)
+            expecting = False
+        if token.is_group and not isinstance(token, (Identifier, IdentifierList)):
+            _collect_tables(token, tables)
+        elif isinstance(token, (Identifier, IdentifierList)):
+            # Subqueries and CTE bodies hang off identifiers
+            for child in token.get_sublists():
+                if isinstance(child, Parenthesis):
+                    _collect_tables(child, tables)
+        if token.ttype is Keyword and (token.normalized == 'FROM' or token.normalized.endswith('JOIN')):
+            expecting = True
+
+
+def _add_table(identifier, tables):
+    if not isinstance(identifier, Identifier):
+        return
+    if isinstance(identifier.token_first(skip_cm=True), Parenthesis):
+        return  # a subquery, walked separately
+    name = identifier.get_real_name()
+    if name:
+        tables.add(name)
+
+
+class ResultCache:
+    """
+    Size-bounded cache of SELECT results keyed by (connection, normalized SQL).
+
+    Each entry remembers a write marker for the tables the statement reads;
+    it is only served while the marker is unchanged and the entry is younger
+    than ttl seconds.
+    """
+
+    def __init__(self, max_entries=256, max_rows=200000, max_rows_per_entry=10000, ttl=60):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.max_rows_per_entry = max_rows_per_entry
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, conn, conn_key, query):
+        """Validate any cached result for query against the database's current write marker"""
+        normalized = normalize_sql(query)
+        key = (conn_key, hashlib.sha256(normalized.encode()).hexdigest())
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(WRITE_MARKER_QUERY, (referenced_tables(normalized),))
+            marker = cursor.fetchall()[0]['marker']
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry['marker'] != marker or time.time() - entry['created_at'] > self.ttl:
+                    self._remove(key)
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+        return CacheLookup(key, marker, entry)
+
+    def store(self, lookup, columns, rows):
+        if len(rows) > self.max_rows_per_entry:
+            return
+        with self._lock:
+            if lookup.key in self._entries:
+                self._remove(lookup.key)
+            self._entries[lookup.key] = {
+                'columns': columns,
+                'rows': rows,
+                'marker': lookup.marker,
+                'created_at': time.time(),
+            }
+            self._rows += len(rows)
+            while self._entries and (len(self._entries) > self.max_entries or self._rows > self.max_rows):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, conn_key):
+        """Drop every entry for one connection, e.g. after a write made through the API"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == conn_key]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._rows -= len(entry['rows'])
+
+
+def cache_info(entry):
+    """The cache block returned alongside results"""
+    if entry is None:
+        return {'hit': False, 'age': 0}
+    return {'hit': True, 'age': round(time.time() - entry['created_at'], 3)}
+
+
+_options = getattr(settings, 'INSIGHTS_RESULT_CACHE', {})
+result_cache = ResultCache(
+    max_entries=_options.get('MAX_ENTRIES', 256),
+    max_rows=_options.get('MAX_ROWS', 200000),
+    max_rows_per_entry=_options.get('MAX_ROWS_PER_ENTRY', 10000),
+    ttl=_options.get('TTL_SECONDS', 60),
+)
@@ -0,0 +1,93 @@
+"""
+Rollup hints for NL-to-SQL prompts.
+
+Rollup tables (INSIGHTS_ROLLUPS) hold pre-aggregated copies of large
+tables, one row per period (day or month) and dimensions. A question whose
+time grain is no finer than a rollup's, and whose words touch the rollup's
+table, source tables or description, is answered far more cheaply from the
+rollup; the prompt names such rollups so the model reaches for them.
+
+Distinct counts (distinct users, payers...) are exact only for one rollup
+row and cannot be summed across periods, so a question asking for them at
+a grain other than the rollup's gets no hint for it.
+"""
+from django.conf import settings
+
+from .schema_index import tokenize
+
+# Periods from finest to coarsest; a rollup answers questions at its own
+# grain or any coarser one (each is a whole number of the finer ones, but
+# for weeks and months)
+GRAINS = ('hour', 'day', 'week', 'month', 'quarter', 'year')
+
+# Question words and the grain they ask for
+GRAIN_WORDS = {
+    'hour': 'hour', 'hourly': 'hour', 'minute': 'hour',
+    'day': 'day', 'daily': 'day', 'date': 'day', 'today': 'day', 'yesterday': 'day',
+    'week': 'week', 'weekly': 'week',
+    'month': 'month', 'monthly': 'month',
+    'quarter': 'quarter', 'quarterly': 'quarter',
+    'year': 'year', 'yearly': 'year', 'annual': 'year', 'annually': 'year',
+}
+
+# Question words asking for a distinct count, besides the distinct columns' names
+DISTINCT_WORDS = frozenset(('distinct', 'unique', 'active'))
+
+
+def question_grain(question):
+    """The finest time grain question asks for (one of GRAINS), or None"""
+    grains = {GRAIN_WORDS[token] for token in tokenize(question) if token in GRAIN_WORDS}
+    for grain in GRAINS:
+        if grain in grains:
+            return grain
+    return None
+
+
+def _qualified(name):
+    schema_name, _, table_name = name.rpartition('.')
+    return schema_name or 'public', table_name
+
+
+def matching_rollups(schema_info, question):
+    """The configured rollups present in schema_info that can answer question"""
+    grain = question_grain(question)
+    if grain is not None and GRAINS.index(grain) == 0:
+        return []
+    topic = {token for token in tokenize(question) if token not in GRAIN_WORDS}
+    matches = []
+    for rollup in getattr(settings, 'INSIGHTS_ROLLUPS', []):
+        schema_name, table_name = _qualified(rollup['table'])
+        if table_name not in schema_info.get(schema_name, {}):
+            continue
+        if grain is not None and GRAINS.index(rollup['grain']) > GRAINS.index(grain):
+            continue
+        distinct = list(rollup.get('distinct', []))
+        if grain != rollup['grain'] and topic & (DISTINCT_WORDS | set(tokenize(' '.join(distinct)))):
+            continue
+        words = ' '.join([table_name, rollup.get('description', '')] + list(rollup.get('sources', [])))
+        if topic & (set(tokenize(words)) - set(GRAIN_WORDS)):
+            matches.append({
+                'table': f'{schema_name}.{table_name}',
+                'grain': rollup['grain'],
+                'sources': list(rollup.get('sources', [])),
+                'distinct': distinct,
+                'description': rollup.get('description', ''),
+            })
+    return matches
+
+
+def add_rollups(snapshot, question, prompt_schema, prompt_tables):
+    """
+    Find the rollups matching question and make sure the pruned prompt
+    schema holds their tables. Returns the prompt schema, its table list
+    and the rollup hints for sql_messages.
+    """
+    rollups = matching_rollups(snapshot.schema, question)
+    missing = [rollup['table'] for rollup in rollups if rollup['table'] not in prompt_tables]
+    if not missing:
+        return prompt_schema, prompt_tables, rollups
+    prompt_schema = {schema_name: dict(tables) for schema_name, tables in prompt_schema.items()}
+    for name in missing:
+        schema_name, table_name = _qualified(name)
+        prompt_schema.setdefault(schema_name, {})[table_name] = snapshot.schema[schema_name][table_name]
+    return prompt_schema, prompt_tables + missing, rollups
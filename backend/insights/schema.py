@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import psycopg2.extras
+from django.conf import settings
+
+from .metrics import count_cache, stage
+
+SCHEMA_QUERY = """
+    SELECT
+        c.table_schema,
+        c.table_name,
+        c.column_name,
+        c.data_type,
+        c.is_nullable,
+        c.column_default,
+        pg_catalog.col_description(pc.oid, c.ordinal_position::int) AS column_comment
+    FROM
+        information_schema.columns c
+    LEFT JOIN pg_catalog.pg_namespace pn ON pn.nspname = c.table_schema
+    LEFT JOIN pg_catalog.pg_class pc ON pc.relnamespace = pn.oid AND pc.relname = c.table_name
+    WHERE
+        c.table_schema NOT IN ('information_schema', 'pg_catalog')
+    ORDER BY
+        c.table_schema,
+        c.table_name,
+        c.ordinal_position;
+"""
+
+# Any DDL (or COMMENT ON COLUMN) that can change what SCHEMA_QUERY returns
+# rewrites at least one of these catalog rows, which gives it a new xmin.
+# Hashing the row versions is not an index scan: it reads pg_attribute,
+# pg_class, pg_attrdef and pg_description in full (a few ms on a small
+# database, growing with the catalog). It still skips the joins and
+# privilege checks of information_schema.columns and returns one row;
+# INSIGHTS_SCHEMA_CACHE['REVALIDATE_SECONDS'] skips it for cached entries.
+FINGERPRINT_QUERY = """
+    SELECT
+        coalesce(md5(string_agg(
+            a.attrelid::text || '.' || a.attnum::text || '.' || a.xmin::text || '.'
+                || c.xmin::text || '.' || coalesce(d.xmin::text, '') || '.' || coalesce(ds.xmin::text, ''),
+            ',' ORDER BY a.attrelid, a.attnum
+        )), '') AS fingerprint
+    FROM pg_catalog.pg_attribute a
+    JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_catalog.pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    LEFT JOIN pg_catalog.pg_description ds
+        ON ds.objoid = a.attrelid AND ds.classoid = 'pg_catalog.pg_class'::regclass AND ds.objsubid = a.attnum
+    WHERE c.relkind IN ('r', 'v', 'm', 'f', 'p')
+        AND n.nspname NOT IN ('information_schema', 'pg_catalog')
+        AND n.nspname NOT LIKE 'pg_toast%'
+        AND a.attnum > 0;
+"""
+
+SchemaSnapshot = namedtuple('SchemaSnapshot', ['schema', 'fingerprint', 'cache_hit'])
+
+
+def build_schema(columns_data):
+    """Nest information_schema.columns rows as {schema: {table: [columns]}}"""
+    schema_info = {}
+    for column in columns_data:
+        table_schema = column['table_schema']
+        table_name = column['table_name']
+        if table_schema not in schema_info:
+            schema_info[table_schema] = {}
+        if table_name not in schema_info[table_schema]:
+            schema_info[table_schema][table_name] = []
+        schema_info[table_schema][table_name].append({
+            'column_name': column['column_name'],
+            'data_type': column['data_type'],
+            'is_nullable': column['is_nullable'],
+            'column_default': column['column_default'],
+            'comment': column.get('column_comment')
+        })
+    return schema_info
+
+
+class SchemaCache:
+    """
+    Keeps the last schema seen for each connection together with the
+    catalog fingerprint it was built from. An entry is only served while
+    the database still reports the same fingerprint.
+    """
+
+    def __init__(self, max_entries=64, revalidate_after=0):
+        self.max_entries = max_entries
+        self.revalidate_after = revalidate_after
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, fingerprint=None):
+        """
+        Return the cached entry for key. With no fingerprint the entry is
+        only returned while it is within the revalidate_after window.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if fingerprint is None:
+                if time.monotonic() - entry['validated_at'] >= self.revalidate_after:
+                    return None
+            elif entry['fingerprint'] != fingerprint:
+                del self._entries[key]
+                return None
+            else:
+                entry['validated_at'] = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, fingerprint, schema):
+        with self._lock:
+            self._entries[key] = {
+                'schema': schema,
+                'fingerprint': fingerprint,
+                'validated_at': time.monotonic(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_options = getattr(settings, 'INSIGHTS_SCHEMA_CACHE', {})
+schema_cache = SchemaCache(
+    max_entries=_options.get('MAX_ENTRIES', 64),
+    revalidate_after=_options.get('REVALIDATE_SECONDS', 0),
+)
+
+
+def fetch_schema(conn, key):
+    """
+    Return a SchemaSnapshot for the database behind conn, reusing the
+    cached schema for key when the catalog fingerprint has not moved.
+    """
+    with stage('schema'):
+        snapshot = _fetch_schema(conn, key)
+    count_cache('schema', snapshot.cache_hit)
+    return snapshot
+
+
+def _fetch_schema(conn, key):
+    entry = schema_cache.get(key)
+    if entry is not None:
+        return SchemaSnapshot(entry['schema'], entry['fingerprint'], True)
+
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+        cursor.execute(FINGERPRINT_QUERY)
+        fingerprint = cursor.fetchall()[0]['fingerprint']
+
+        entry = schema_cache.get(key, fingerprint)
+        if entry is not None:
+            return SchemaSnapshot(entry['schema'], fingerprint, True)
+
+        cursor.execute(SCHEMA_QUERY)
+        schema_info = build_schema(cursor.fetchall())
+
+    schema_cache.put(key, fingerprint, schema_info)
+    return SchemaSnapshot(schema_info, fingerprint, False)
+
+
+async def fetch_schema_async(conn, key):
+    """fetch_schema for an asyncpg connection, sharing the same cache"""
+    with stage('schema'):
+        snapshot = await _fetch_schema_async(conn, key)
+    count_cache('schema', snapshot.cache_hit)
+    return snapshot
+
+
+async def _fetch_schema_async(conn, key):
+    entry = schema_cache.get(key)
+    if entry is not None:
+        return SchemaSnapshot(entry['schema'], entry['fingerprint'], True)
+
+    fingerprint = await conn.fetchval(FINGERPRINT_QUERY)
+    entry = schema_cache.get(key, fingerprint)
+    if entry is not None:
+        return SchemaSnapshot(entry['schema'], fingerprint, True)
+
+    schema_info = build_schema(await conn.fetch(SCHEMA_QUERY))
+    schema_cache.put(key, fingerprint, schema_info)
+    return SchemaSnapshot(schema_info, fingerprint, False)
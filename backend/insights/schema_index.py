@@ -0,0 +1,143 @@
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+from .prompts import describe_table
+
+# Words that say nothing about which table a question is about
+STOPWORDS = frozenset("""
+    a an and are as at be by for from get give has have how i in is it list me most my
+    of on or per show that the their them there these this those to was were what when
+    where which who with all any each every many much number count total top
+""".split())
+
+# BM25 parameters; table-name tokens count several times over column tokens
+K1 = 1.2
+B = 0.75
+TABLE_NAME_WEIGHT = 3
+
+
+def tokenize(text):
+    """Split identifiers and prose into lower-case word stems"""
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text or '')
+    tokens = []
+    for word in re.split(r'[^A-Za-z0-9]+', text.lower()):
+        if not word or word in STOPWORDS:
+            continue
+        # Crude plural folding so "movies" matches the "movie" table
+        if len(word) > 3 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def estimate_tokens(text):
+    """Rough LLM token count (about four characters per token)"""
+    return len(text) // 4 + 1
+
+
+class SchemaIndex:
+    """
+    BM25 index with one document per table (its name, columns and
+    comments), along with the prompt size of each table's description
+    """
+
+    def __init__(self, schema_info):
+        self.tables = []
+        self.term_counts = []
+        self.lengths = []
+        self.sizes = {}
+        document_frequency = Counter()
+        for schema_name, tables in schema_info.items():
+            for table_name, columns in tables.items():
+                self.sizes[(schema_name, table_name)] = estimate_tokens(describe_table(table_name, columns))
+                terms = tokenize(table_name) * TABLE_NAME_WEIGHT
+                for column in columns:
+                    terms += tokenize(column['column_name'])
+                    terms += tokenize(column.get('comment'))
+                counts = Counter(terms)
+                self.tables.append((schema_name, table_name))
+                self.term_counts.append(counts)
+                self.lengths.append(len(terms))
+                document_frequency.update(counts.keys())
+
+        self.total_size = sum(self.sizes.values())
+        total = len(self.tables)
+        self.average_length = (sum(self.lengths) / total) if total else 0
+        self.idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def rank(self, question):
+        """(score, (schema, table)) pairs for every table, best first"""
+        terms = set(tokenize(question))
+        scored = []
+        for position, counts in enumerate(self.term_counts):
+            score = 0.0
+            norm = K1 * (1 - B + B * self.lengths[position] / (self.average_length or 1))
+            for term in terms:
+                frequency = counts.get(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (K1 + 1) / (frequency + norm)
+            scored.append((score, self.tables[position]))
+        scored.sort(key=lambda item: -item[0])
+        return scored
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _index_for(snapshot):
+    # Indexes (and table sizes) are rebuilt only when the schema fingerprint changes
+    key = snapshot.fingerprint
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    index = SchemaIndex(snapshot.schema)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > 16:
+            _indexes.popitem(last=False)
+    return index
+
+
+def prune_schema(snapshot, question):
+    """
+    Select the slice of the schema to send to the model for question.
+
+    The whole schema is used when it fits in the token budget. Otherwise
+    tables are taken in BM25 order, up to MAX_TABLES, for as long as they
+    fit. Returns the pruned {schema: {table: [columns]}} mapping, the list
+    of "schema.table" names it holds and whether anything was left out.
+    """
+    options = getattr(settings, 'INSIGHTS_SCHEMA_PROMPT', {})
+    budget = options.get('TOKEN_BUDGET', 3000)
+    max_tables = options.get('MAX_TABLES', 12)
+    schema_info = snapshot.schema
+    index = _index_for(snapshot)
+
+    if index.total_size <= budget:
+        return schema_info, [f'{schema}.{table}' for schema, table in index.tables], False
+
+    pruned = {}
+    used = 0
+    selected = []
+    for score, (schema_name, table_name) in index.rank(question):
+        if len(selected) >= max_tables:
+            break
+        size = index.sizes[(schema_name, table_name)]
+        if used + size > budget:
+            continue
+        used += size
+        selected.append(f'{schema_name}.{table_name}')
+        pruned.setdefault(schema_name, {})[table_name] = schema_info[schema_name][table_name]
+    return pruned, selected, True
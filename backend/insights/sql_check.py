@@ -0,0 +1,403 @@
+import difflib
+import re
+from collections import namedtuple
+
+import sqlparse
+from django.conf import settings
+from sqlparse import tokens as T
+
+SqlCheck = namedtuple('SqlCheck', ['sql', 'repairs', 'problems'])
+
+# Statements whose identifiers are checked; anything else (DDL, SET, ...) is left alone
+CHECKED_TYPES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+# Keywords that are never read as a column name even when a table has a column of that name
+STRUCTURAL = frozenset("""
+    ALL AND ANY AS ASC BETWEEN BY CASE CAST CROSS DEFAULT DESC DISTINCT ELSE END EXCEPT EXISTS FALSE
+    FILTER FIRST FROM FULL GROUP HAVING ILIKE IN INNER INTERSECT INTERVAL INTO IS JOIN LAST LATERAL
+    LEFT LIKE LIMIT NATURAL NOT NULL NULLS OFFSET ON ONLY OR ORDER OUTER OVER PARTITION RECURSIVE
+    RETURNING RIGHT SELECT SET SOME THEN TRUE UNION USING VALUES WHEN WHERE WINDOW WITH WITHIN
+""".split())
+
+# Keywords PostgreSQL gives a meaning of their own when unquoted (user is current_user)
+RESERVED_COLUMNS = frozenset({'user', 'current_user', 'session_user', 'current_date', 'current_time'})
+
+_PLAIN_IDENTIFIER = re.compile(r'[a-z_][a-z0-9_$]*')
+
+
+class Catalog:
+    """Table and column names of a {schema: {table: [columns]}} mapping, for lookups"""
+
+    def __init__(self, schema_info):
+        self.schemas = {}
+        self.tables = {}
+        self.columns = set()
+        for schema_name, tables in schema_info.items():
+            self.schemas[schema_name] = list(tables)
+            for table_name, columns in tables.items():
+                names = [column['column_name'] for column in columns]
+                self.tables.setdefault(table_name, {})[schema_name] = names
+                self.columns.update(names)
+        self.lowered_columns = {name.lower() for name in self.columns}
+
+    def table_columns(self, table_name, schema_name=None):
+        by_schema = self.tables.get(table_name, {})
+        if schema_name is not None:
+            return by_schema.get(schema_name, [])
+        return [name for names in by_schema.values() for name in names]
+
+
+class _Name:
+    """One part of a (possibly dotted) identifier in the statement"""
+
+    def __init__(self, index, token):
+        self.index = index
+        raw = token.value
+        self.raw = raw
+        self.backticked = raw.startswith('`')
+        self.quoted = raw.startswith('"')
+        if self.quoted:
+            self.value = raw[1:-1].replace('""', '"')
+        elif self.backticked:
+            self.value = raw[1:-1]
+        else:
+            # PostgreSQL folds unquoted identifiers to lower case
+            self.value = raw.lower()
+        self.keyword = token.ttype in T.Keyword or token.ttype in T.Name.Builtin
+
+
+def closest(name, candidates, cutoff):
+    """
+    (match, reason) for name among candidates: itself, a unique match
+    ignoring case ('case'), or the one clearly nearest spelling ('spelling').
+    None when there is nothing close enough, or two candidates are as close.
+    """
+    if name in candidates:
+        return name, None
+    same = [candidate for candidate in candidates if candidate.lower() == name.lower()]
+    if len(same) == 1:
+        return same[0], 'case'
+    if same:
+        return None
+    scored = sorted(
+        ((difflib.SequenceMatcher(None, name.lower(), candidate.lower()).ratio(), candidate) for candidate in candidates),
+        reverse=True,
+    )
+    if scored and scored[0][0] >= cutoff and (len(scored) == 1 or scored[0][0] > scored[1][0]):
+        return scored[0][1], 'spelling'
+    return None
+
+
+def quote_identifier(name, was_quoted=True):
+    """name as it has to be written in SQL; plain lower-case names stay unquoted unless they were quoted"""
+    if not was_quoted and _PLAIN_IDENTIFIER.fullmatch(name) and name not in RESERVED_COLUMNS:
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _significant(flat):
+    return [
+        index for index, token in enumerate(flat)
+        if not token.is_whitespace and token.ttype not in T.Comment
+    ]
+
+
+def _is_punct(token, value):
+    return token is not None and token.ttype in T.Punctuation and token.value == value
+
+
+class _Statement:
+    """The identifiers of one statement, sorted into table references, column references and names it defines"""
+
+    def __init__(self, statement, catalog, cutoff):
+        self.catalog = catalog
+        self.cutoff = cutoff
+        self.flat = list(statement.flatten())
+        self.sig = _significant(self.flat)
+        self.replacements = {}
+        self.repairs = []
+        self.problems = []
+        # (alias, schema, table); table None for CTEs, subqueries, functions and unknown tables
+        self.sources = []
+        self.defined = set()
+        self.ctes = set()
+        self.columns = []
+        self._scan()
+
+    def token(self, position):
+        if 0 <= position < len(self.sig):
+            return self.flat[self.sig[position]]
+        return None
+
+    def _identifier_at(self, position):
+        token = self.token(position)
+        if token is None:
+            return False
+        if token.ttype in T.Literal.String.Symbol or (token.ttype in T.Name and token.ttype not in T.Name.Placeholder
+                                                       and token.ttype not in T.Name.Builtin):
+            return True
+        if token.ttype in T.Keyword or token.ttype in T.Name.Builtin:
+            if token.ttype in T.Keyword.DML or not re.fullmatch(r'\w+', token.value):
+                return False
+            previous, following = self.token(position - 1), self.token(position + 1)
+            if _is_punct(previous, '.') or _is_punct(following, '.'):
+                return True
+            if token.normalized.upper() in STRUCTURAL or _is_punct(previous, '::'):
+                return False
+            if previous is not None and previous.ttype in T.Keyword and previous.normalized == 'AS':
+                return False
+            # e.g. EXTRACT(YEAR FROM ...)
+            if following is not None and following.ttype in T.Keyword and following.normalized == 'FROM' \
+                    and _is_punct(previous, '('):
+                return False
+            return token.value.lower() in self.catalog.lowered_columns
+        return False
+
+    def _chain(self, position):
+        """The dotted name starting at position and the position after it"""
+        names = [_Name(self.sig[position], self.token(position))]
+        position += 1
+        while _is_punct(self.token(position), '.'):
+            following = self.token(position + 1)
+            if following is not None and following.ttype in T.Wildcard:
+                # t.*: only the qualifier is checked
+                return names + [None], position + 2
+            if not self._identifier_at(position + 1):
+                break
+            names.append(_Name(self.sig[position + 1], following))
+            position += 2
+        return names, position
+
+    def _scan(self):
+        levels = [{'query': False, 'clause': None, 'expect': None, 'source': False}]
+        position = 0
+        previous = None
+        while position < len(self.sig):
+            token = self.token(position)
+            level = levels[-1]
+            if _is_punct(token, '('):
+                levels.append({'query': False, 'clause': None, 'expect': None,
+                               'source': level['expect'] in ('table', 'function')})
+                level['expect'] = None
+            elif _is_punct(token, ')'):
+                if len(levels) == 1:
+                    self.problems.append('Unbalanced parentheses: unexpected ")"')
+                else:
+                    closed = levels.pop()
+                    if closed['source']:
+                        # A subquery or set-returning function in FROM; its columns are unknown here
+                        self.sources.append([None, None, None])
+                        levels[-1]['expect'] = 'alias'
+            elif token.ttype in T.Keyword.DML or token.ttype in T.Keyword.CTE:
+                level['query'] = True
+                level['clause'] = token.normalized
+                level['expect'] = 'table' if token.normalized == 'UPDATE' else None
+            elif self._identifier_at(position):
+                names, after = self._chain(position)
+                following = self.token(after)
+                if _is_punct(following, '(') and level['clause'] != 'INTO':
+                    if level['expect'] == 'table':
+                        level['expect'] = 'function'
+                elif following is not None and following.ttype in T.Keyword and following.normalized == 'AS' \
+                        and _is_punct(self.token(after + 1), '(') and len(names) == 1:
+                    self.ctes.add(names[0].value)
+                    self.defined.add(names[0].value)
+                elif level['expect'] == 'table':
+                    self._table(names)
+                    level['expect'] = 'alias'
+                elif level['expect'] == 'alias' and len(names) == 1:
+                    self._alias(names[0], level)
+                elif _is_punct(previous, '::'):
+                    pass
+                elif len(names) == 1 and level['clause'] == 'SELECT' and previous is not None and (
+                        _is_punct(previous, ')') or previous.ttype in T.Literal or previous.ttype in T.Name
+                        or previous.ttype in T.Literal.String.Symbol):
+                    # An output name given without AS, e.g. count(*) total
+                    self.defined.add(names[0].value)
+                else:
+                    self.columns.append(names)
+                position, previous = after, self.token(after - 1)
+                continue
+            elif token.ttype in T.Keyword:
+                word = token.normalized
+                if level['query'] and (word == 'FROM' or word.endswith('JOIN')):
+                    level['clause'], level['expect'] = 'FROM', 'table'
+                elif level['query'] and word == 'INTO':
+                    # INSERT INTO t (columns): the parenthesis is not a function call
+                    level['clause'], level['expect'] = 'INTO', 'table'
+                elif word == 'AS':
+                    if level['expect'] != 'table':
+                        level['expect'] = 'alias'
+                elif word in ('LATERAL', 'ONLY'):
+                    pass
+                else:
+                    if level['clause'] == 'SELECT' and word in ('DISTINCT', 'ALL'):
+                        pass
+                    else:
+                        level['clause'] = word
+                    level['expect'] = None
+            elif _is_punct(token, ','):
+                level['expect'] = 'table' if level['clause'] == 'FROM' else None
+            elif token.ttype in T.Error:
+                self.problems.append(f'Unterminated quote near: {token.value}')
+            previous = token
+            position += 1
+        if len(levels) > 1:
+            self.problems.append('Unbalanced parentheses: missing ")"')
+
+    def _alias(self, name, level):
+        self.defined.add(name.value)
+        if level['clause'] == 'FROM' and self.sources and self.sources[-1][0] is None:
+            self.sources[-1][0] = name.value
+        level['expect'] = None
+
+    def _replace(self, name, value, reason):
+        text = quote_identifier(value, name.quoted or name.backticked or reason != 'spelling' or name.keyword)
+        if reason is None and name.backticked:
+            reason = 'quoting'
+        if reason is None and name.keyword and value.lower() in RESERVED_COLUMNS:
+            reason = 'quoting'
+        if reason is None or text == name.raw:
+            return
+        self.replacements[name.index] = text
+        self.repairs.append({'from': name.raw, 'to': text, 'reason': reason})
+
+    def _table(self, names):
+        if len(names) == 1 and names[0].value in self.ctes:
+            self.sources.append([None, None, None])
+            return
+        if len(names) == 1:
+            schema_name, table = None, names[0]
+            candidates = list(self.catalog.tables)
+        else:
+            schema_part, table = names[-2], names[-1]
+            match = closest(schema_part.value, list(self.catalog.schemas), self.cutoff)
+            if match is None:
+                self.problems.append(f'Unknown schema {schema_part.raw}')
+                self.sources.append([None, None, None])
+                return
+            schema_name = match[0]
+            self._replace(schema_part, schema_name, match[1])
+            candidates = self.catalog.schemas[schema_name]
+        match = closest(table.value, candidates, self.cutoff)
+        if match is None:
+            self.problems.append(f'Unknown table {table.raw}' + _suggest(table.value, candidates))
+            self.sources.append([None, None, None])
+            return
+        self._replace(table, match[0], match[1])
+        self.sources.append([None, schema_name, match[0]])
+
+    def _source_for(self, qualifier):
+        """The source a column qualifier names (alias or table), repairing it when it is close"""
+        named = {}
+        for source in self.sources:
+            alias, _, table = source
+            if alias is not None:
+                named.setdefault(alias, source)
+            elif table is not None:
+                named.setdefault(table, source)
+        match = closest(qualifier.value, list(named), self.cutoff)
+        if match is None:
+            if qualifier.value in self.defined:
+                return [None, None, None]
+            self.problems.append(f'Unknown table or alias {qualifier.raw}')
+            return None
+        self._replace(qualifier, match[0], match[1])
+        return named[match[0]]
+
+    def check_columns(self):
+        if not self.sources:
+            # Nothing is selected from a table (e.g. SELECT now())
+            return
+        known = [source for source in self.sources if source[2] is not None]
+        open_scope = len(known) < len(self.sources)
+        in_scope = []
+        for _, schema_name, table in known:
+            in_scope.extend(name for name in self.catalog.table_columns(table, schema_name) if name not in in_scope)
+
+        for names in self.columns:
+            column = names[-1]
+            if column is None:
+                if len(names) == 2:
+                    self._source_for(names[0])
+                continue
+            if len(names) == 1:
+                if column.value in self.defined:
+                    continue
+                self._column(column, in_scope, open_scope, None)
+                continue
+            if len(names) == 2:
+                source = self._source_for(names[0])
+            else:
+                before = len(self.sources)
+                self._table(names[:-1])
+                source = self.sources.pop() if len(self.sources) > before else None
+            if source is None or source[2] is None:
+                continue
+            self._column(column, self.catalog.table_columns(source[2], source[1]), False, source[2])
+
+    def _column(self, column, candidates, open_scope, table):
+        if open_scope:
+            # Columns may come from a subquery or CTE: only fix case against the known tables
+            match = closest(column.value, candidates, 1.0)
+            if match is not None and match[1] != 'spelling':
+                self._replace(column, match[0], match[1])
+            return
+        match = closest(column.value, candidates, self.cutoff)
+        if match is None:
+            where = f' in table {table}' if table else ''
+            self.problems.append(f'Unknown column {column.raw}{where}' + _suggest(column.value, candidates))
+            return
+        self._replace(column, match[0], match[1])
+
+    def text(self):
+        return ''.join(self.replacements.get(index, token.value) for index, token in enumerate(self.flat))
+
+
+def _suggest(name, candidates, limit=3):
+    nearest = difflib.get_close_matches(name, candidates, n=limit, cutoff=0.5)
+    if nearest:
+        return ' (did you mean ' + ', '.join(f'"{candidate}"' for candidate in nearest) + '?)'
+    return ''
+
+
+def check_sql(query, schema_info, cutoff=None):
+    """
+    Check a generated query against the schema it was written for.
+
+    Unknown tables and columns, wrong case and MySQL-style backtick quoting
+    are repaired in place when one identifier in the schema is a clear match
+    (unquoted camelCase names get the double quotes PostgreSQL needs).
+    Returns SqlCheck(sql, repairs, problems): the repaired SQL, a list of
+    {'from', 'to', 'reason'} and the problems that could not be fixed here.
+    """
+    if cutoff is None:
+        cutoff = getattr(settings, 'INSIGHTS_SQL_VALIDATION', {}).get('MATCH_CUTOFF', 0.8)
+    catalog = Catalog(schema_info)
+    parts, repairs, problems = [], [], []
+    for statement in sqlparse.parse(query):
+        if not catalog.tables or statement.get_type() not in CHECKED_TYPES:
+            parts.append(str(statement))
+            continue
+        checked = _Statement(statement, catalog, cutoff)
+        if not checked.problems:
+            # Identifiers are only trustworthy once the statement tokenizes cleanly
+            checked.check_columns()
+        parts.append(checked.text())
+        repairs.extend(checked.repairs)
+        problems.extend(checked.problems)
+    return SqlCheck(''.join(parts), repairs, problems)
+
+
+def validation_options():
+    options = getattr(settings, 'INSIGHTS_SQL_VALIDATION', {})
+    return options.get('ENABLED', True), options.get('MODEL_RETRIES', 1)
+
+
+def problems_message(problems):
+    """The problems check_sql could not fix, phrased as the error sent back to the model"""
+    return 'The query does not match the database schema: ' + '; '.join(problems)
+
+
+def validation_info(check, model_retries):
+    return {'repairs': check.repairs, 'problems': check.problems, 'model_retries': model_retries}
@@ -0,0 +1,238 @@
+import uuid
+
+import psycopg2
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .explain import guard
+from .limits import set_statement_timeout
+from .metrics import stage
+from .pool import is_broken, pools
+from .renderers import as_text, dumps
+
+
+class RowStream:
+    """
+    Iterates over a SELECT through a named (server-side) cursor, fetching
+    batch_size rows at a time so only one batch is ever held in memory.
+
+    The pooled connection is returned (and on_close called) when the
+    stream is exhausted or when Django closes the response, whichever
+    comes first.
+    """
+
+    def __init__(self, pool, conn, cursor, batch_size, on_close=None):
+        self.pool = pool
+        self.conn = conn
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.on_close = on_close
+        self.columns = None
+        self.description = None
+        self._released = False
+
+    def batches(self):
+        try:
+            while True:
+                rows = self.cursor.fetchmany(self.batch_size)
+                if self.columns is None and self.cursor.description:
+                    self.description = self.cursor.description
+                    self.columns = [desc[0] for desc in self.description]
+                if not rows:
+                    break
+                yield rows
+            self.cursor.close()
+            self.conn.commit()
+        except psycopg2.Error as e:
+            self.close(discard=is_broken(e))
+            raise
+        finally:
+            self.close()
+
+    def close(self, discard=False):
+        if self._released:
+            return
+        self._released = True
+        self.pool.release(self.conn, discard=discard)
+        if self.on_close is not None:
+            self.on_close()
+
+
+class NDJSONStream(RowStream):
+    """One JSON object per row, newline delimited"""
+    content_type = 'application/x-ndjson'
+
+    def __iter__(self):
+        for rows in self.batches():
+            yield b''.join(dumps(dict(zip(self.columns, row))) + b'\n' for row in rows)
+
+
+class JSONArrayStream(RowStream):
+    """The same {"results": [...]} body as the buffered response, sent in chunks"""
+    content_type = 'application/json'
+
+    def __iter__(self):
+        yield b'{"results": ['
+        separator = b''
+        for rows in self.batches():
+            # One call per batch: the batch's rows are written as one array
+            # and the brackets dropped
+            yield separator + dumps([dict(zip(self.columns, row)) for row in rows])[1:-1]
+            separator = b','
+        yield b']}'
+
+
+def arrow_type(pa, column):
+    """
+    The Arrow type for a result column, from its Postgres type OID. numeric
+    declared with a precision Arrow can hold is a decimal, other numerics
+    are floats as in the JSON responses; types with no Arrow counterpart
+    (uuid, json, arrays, ...) are sent as text.
+    """
+    types = {
+        16: pa.bool_(),
+        17: pa.binary(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        26: pa.int64(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1082: pa.date32(),
+        1083: pa.time64('us'),
+        1114: pa.timestamp('us'),
+        1184: pa.timestamp('us', tz='UTC'),
+        1186: pa.duration('us'),
+    }
+    if column.type_code == 1700:
+        if column.precision and 0 < column.precision <= 38 and column.scale is not None:
+            return pa.decimal128(column.precision, column.scale)
+        return pa.float64()
+    return types.get(column.type_code, pa.string())
+
+
+class _Sink:
+    """Write-only file for pyarrow's writers; what was written is taken after each batch"""
+
+    def __init__(self):
+        self.closed = False
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self._parts = b''.join(self._parts), []
+        return data
+
+
+class ArrowBatchStream(RowStream):
+    """
+    Each batch of rows written as one Arrow record batch (or Parquet row
+    group), so no more than a batch is held in memory however large the
+    result. The column types come from the cursor's description.
+    """
+
+    def open_writer(self, pa, sink, schema):
+        raise NotImplementedError
+
+    def __iter__(self):
+        import pyarrow as pa
+
+        sink, writer, schema = _Sink(), None, None
+        for rows in self.batches():
+            if writer is None:
+                schema = pa.schema([(column.name, arrow_type(pa, column)) for column in self.description])
+                writer = self.open_writer(pa, sink, schema)
+            columns = zip(*rows)
+            arrays = [_arrow_array(pa, values, field.type) for values, field in zip(columns, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.take()
+        if writer is None:
+            # No rows: still a valid file, with the result's columns
+            schema = pa.schema([(column.name, arrow_type(pa, column)) for column in self.description or []])
+            writer = self.open_writer(pa, sink, schema)
+        writer.close()
+        yield sink.take()
+
+
+def _arrow_array(pa, values, arrow_type):
+    if arrow_type == pa.string():
+        values = [None if value is None else as_text(value) for value in values]
+    elif arrow_type == pa.binary():
+        values = [None if value is None else bytes(value) for value in values]
+    elif pa.types.is_floating(arrow_type):
+        values = [None if value is None else float(value) for value in values]
+    return pa.array(values, type=arrow_type)
+
+
+class ArrowStream(ArrowBatchStream):
+    """An Arrow IPC stream"""
+    content_type = 'application/vnd.apache.arrow.stream'
+
+    def open_writer(self, pa, sink, schema):
+        return pa.ipc.new_stream(sink, schema)
+
+
+class ParquetStream(ArrowBatchStream):
+    """A Parquet file with one row group per batch; the footer comes last"""
+    content_type = 'application/vnd.apache.parquet'
+
+    def open_writer(self, pa, sink, schema):
+        import pyarrow.parquet as pq
+
+        compression = getattr(settings, 'INSIGHTS_EXPORT', {}).get('PARQUET_COMPRESSION', 'snappy')
+        return pq.ParquetWriter(sink, schema, compression=compression)
+
+
+STREAM_FORMATS = {
+    'ndjson': NDJSONStream,
+    'json': JSONArrayStream,
+    'arrow': ArrowStream,
+    'parquet': ParquetStream,
+}
+
+
+def stream_select(params, query, stream_format='ndjson', statement_timeout_ms=None, on_close=None,
+                  batch_size=None):
+    """
+    Run a SELECT on a server-side cursor and return a StreamingHttpResponse.
+    The cost guard sees the statement first (raising CostRejected), and it
+    is executed before returning, so SQL errors still surface as a normal
+    error response rather than a truncated stream. Each fetch
+    of batch_size rows (INSIGHTS_STREAM_BATCH_SIZE by default) is bounded
+    by statement_timeout_ms, and on_close is called once the stream has
+    released its connection.
+    """
+    stream_class = STREAM_FORMATS.get(stream_format)
+    if stream_class is None:
+        raise ValueError(f'Unsupported stream format: {stream_format}')
+
+    pool = pools.get(params)
+    conn = pool.acquire()
+    try:
+        if statement_timeout_ms is not None:
+            set_statement_timeout(conn, statement_timeout_ms)
+        with conn.cursor() as plan_cursor, stage('plan'):
+            guard(plan_cursor, query)
+        cursor = conn.cursor(name=f'insights_stream_{uuid.uuid4().hex}')
+        cursor.execute(query)
+    except Exception as e:
+        pool.release(conn, discard=is_broken(e))
+        raise
+
+    batch_size = batch_size or getattr(settings, 'INSIGHTS_STREAM_BATCH_SIZE', 2000)
+    stream = stream_class(pool, conn, cursor, batch_size, on_close)
+    return StreamingHttpResponse(stream, content_type=stream.content_type)
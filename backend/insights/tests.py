@@ -1,6 +1,23 @@
+import asyncio
+import datetime
 import json
-from django.test import TestCase, RequestFactory
-from unittest.mock import patch
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from django.core.handlers.wsgi import LimitedStream
+from django.test import AsyncClient, Client, TestCase, RequestFactory, override_settings
+from unittest.mock import AsyncMock, MagicMock, patch
+import psycopg2
+from psycopg2 import sql
+import msgpack
+import numpy as np
+import pyarrow.ipc
+import pyarrow.parquet
 from rest_framework.response import Response
 
 # Import your view functions and viewset from insights/views.py
@@ -11,18 +28,87 @@ from insights.views import (
     generate_visualization_data,
     ConnectionViewSet
 )
+from insights.async_views import (
+    execute_raw_sql_async,
+    get_database_schema_async,
+    generate_sql_query_async,
+    generate_visualization_data_async,
+)
+from insights.pool import ConnectionPool, PoolExhausted, borrow, pools, resolve_db_config
+from insights.schema import SchemaSnapshot, schema_cache
+from insights.generation_cache import GenerationCache
+from insights.result_cache import is_read_only, referenced_tables, result_cache
+from insights.schema_index import prune_schema, tokenize
+from insights.rollups import add_rollups, question_grain
+from insights.prompts import describe_table, sql_messages
+from insights.limits import (
+    DisconnectWatch, QueryLimiter, TooManyQueries, client_socket, configured_timeouts, query_limiters, statement_timeout_ms,
+)
+from insights.models import Connection
+from insights.pipeline import ask
+from insights.export import export_limiters
+from insights.llm import Completion, GroqBackend, LLMGateway, llm_gateway
+from insights.sql_check import check_sql
+from insights.explain import trim_preview
+from insights.metrics import Histogram, registry
+from insights.renderers import FastJSONRenderer
+from insights.charts import build_charts, lttb, rule_based_specs
+from insights.profiling import Dataset, profile_dataset, sample_rows
+from psycopg2.extensions import Column, QueryCanceledError
 
 # ---------------------------------------------------------------------
 # Dummy/Fake Classes for External Dependencies
 # ---------------------------------------------------------------------
+def render_sql(query):
+    """Render a psycopg2.sql composition without a live connection"""
+    if isinstance(query, str):
+        return query
+    if isinstance(query, sql.Composed):
+        return ''.join(render_sql(part) for part in query)
+    if isinstance(query, sql.SQL):
+        return query.string
+    if isinstance(query, sql.Identifier):
+        return '.'.join(f'"{name}"' for name in query.strings)
+    if isinstance(query, sql.Placeholder):
+        return '%s'
+    return str(query.wrapped)
+
 class FakeDictCursor:
+    # Catalog fingerprint reported for the schema cache's revalidation query
+    fingerprint = 'fingerprint-1'
+    # Table write marker reported for the result cache's validation query
+    write_marker = 'marker-1'
+    # Top plan node returned for EXPLAIN (FORMAT JSON)
+    plan = {"Node Type": "Seq Scan", "Relation Name": "test_table", "Plan Rows": 1000, "Total Cost": 15.0}
+    # pg_class.reltuples reported for every table the cost guard asks about
+    table_rows = 1000
+    executed = []
+
     def __init__(self):
         self.rowcount = 0
         self._data = []
         self.description = None
 
-    def execute(self, query):
-        if "information_schema.columns" in query:
+    def execute(self, query, params=None):
+        query = render_sql(query)
+        FakeDictCursor.executed.append(query)
+        if query.startswith("EXPLAIN"):
+            self._data = [([{"Plan": dict(FakeDictCursor.plan)}],)]
+            self.rowcount = 1
+            self.description = [("QUERY PLAN",)]
+        elif "reltuples" in query:
+            self._data = [(name, FakeDictCursor.table_rows) for name in params[0]]
+            self.rowcount = len(self._data)
+            self.description = [("relname",), ("reltuples",)]
+        elif "pg_stat_user_tables" in query:
+            self._data = [{"marker": FakeDictCursor.write_marker}]
+            self.rowcount = 1
+            self.description = [("marker",)]
+        elif "pg_attribute" in query:
+            self._data = [{"fingerprint": FakeDictCursor.fingerprint}]
+            self.rowcount = 1
+            self.description = [("fingerprint",)]
+        elif "information_schema.columns" in query:
             # Simulate a schema query returning one dictionary row.
             self._data = [
                 {
@@ -58,6 +144,13 @@ class FakeDictCursor:
     def fetchall(self):
         return self._data
 
+    def fetchmany(self, size):
+        batch, self._data = self._data[:size], self._data[size:]
+        return batch
+
+    def close(self):
+        pass
+
     def __enter__(self):
         return self
 
@@ -65,12 +158,16 @@ class FakeDictCursor:
         pass
 
 class FakeDictConnection:
+    def __init__(self):
+        self.closed = 0
     def cursor(self, *args, **kwargs):
         return FakeDictCursor()
     def commit(self):
         pass
-    def close(self):
+    def rollback(self):
         pass
+    def close(self):
+        self.closed = 1
 
 class FakeGroqResponse:
     class FakeChoice:
@@ -90,15 +187,41 @@ class FakeGroqVisualizationResponse:
             message=type("Msg", (), {"content": json.dumps(visualization_json)})
         )]
 
+class DivisionByZero(psycopg2.DataError):
+    pgcode = '22012'
+
 # ---------------------------------------------------------------------
 # Dummy Test Cases (Using RequestFactory to call view functions directly)
 # ---------------------------------------------------------------------
 class DummyAPITest(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
+        # Keep generations from leaking between tests or onto disk
+        patcher = patch('insights.views.generation_cache', GenerationCache())
+        self.generation_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Completions come from a mocked Groq client behind the shared gateway
+        self.groq = MagicMock()
+        patcher = patch.object(llm_gateway, 'backend', GroqBackend(client=self.groq))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        pools.close_all()
+        schema_cache.clear()
+        result_cache.clear()
+        query_limiters.clear()
+        configured_timeouts.clear()
+        FakeDictCursor.fingerprint = 'fingerprint-1'
+        FakeDictCursor.write_marker = 'marker-1'
+        FakeDictCursor.executed = []
+
+    def last_statement(self):
+        """The last statement a view ran before its connection went back to the pool"""
+        return [query for query in FakeDictCursor.executed if query != 'DISCARD ALL'][-1]
 
     # --- execute_raw_sql ---
-    @patch('insights.views.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
     def test_execute_raw_sql_missing_query(self, mock_connect):
         # Create a dummy POST request without a "query"
         request = self.factory.post('/api/raw-sql/', data={}, content_type='application/json')
@@ -106,29 +229,248 @@ class DummyAPITest(TestCase):
         # Expecting a 400 error due to missing query parameter.
         self.assertEqual(response.status_code, 400)
 
-    @patch('insights.views.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
     def test_execute_raw_sql_select_query(self, mock_connect):
         request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json')
         response = execute_raw_sql(request)
         self.assertEqual(response.status_code, 200)
         # Dummy response should return our fake SELECT row.
-        self.assertEqual(response.data, {'results': [{'id': 1}]})
+        self.assertEqual(response.data['results'], [{'id': 1}])
+        self.assertEqual(response.data['plan'], {'total_cost': 15.0, 'estimated_rows': 1000, 'seq_scans': [], 'warnings': []})
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_stream_ndjson(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'stream': True}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{'id': 1}])
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_stream_json_array(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'stream': 'json'}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), {'results': [{'id': 1}]})
+        self.assertEqual(pools.get(resolve_db_config({})).idle_count, 1)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_sets_statement_timeout(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json')
+        execute_raw_sql(request)
+        self.assertIn("SELECT set_config('statement_timeout', %s, true)", FakeDictCursor.executed)
+        self.assertEqual(query_limiters.get(resolve_db_config({})).active, 0)
+
+    def test_statement_timeout_defaults_to_connection_record(self):
+        params = resolve_db_config({})
+        self.assertEqual(statement_timeout_ms(params, {}), 30000)
+        Connection.objects.create(connection_name='querydb', hostname='querydb', port=5432, dbname='querydb',
+                                  username='user', password='password', statement_timeout_ms=1500)
+        self.assertEqual(statement_timeout_ms(params, {}), 1500)
+        self.assertEqual(statement_timeout_ms(params, {'statement_timeout_ms': 200}), 200)
+        with self.assertRaises(ValueError):
+            statement_timeout_ms(params, {'statement_timeout_ms': 0})
+
+    def test_connection_record_timeout_is_cached_until_it_changes(self):
+        params = resolve_db_config({})
+        record = Connection.objects.create(connection_name='querydb', hostname='querydb', port=5432, dbname='querydb',
+                                           username='user', password='password', statement_timeout_ms=1500)
+        statement_timeout_ms(params, {})
+        with self.assertNumQueries(0):
+            self.assertEqual(statement_timeout_ms(params, {}), 1500)
+        record.statement_timeout_ms = 2500
+        record.save()
+        self.assertEqual(statement_timeout_ms(params, {}), 2500)
+        record.delete()
+        self.assertEqual(statement_timeout_ms(params, {}), 30000)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_timeout_returns_504(self, mock_connect):
+        with patch.object(FakeDictCursor, 'execute', side_effect=QueryCanceledError('canceling statement due to statement timeout')):
+            request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT pg_sleep(10)', 'statement_timeout_ms': 100}, content_type='application/json')
+            response = execute_raw_sql(request)
+        self.assertEqual(response.status_code, 504)
+        self.assertIn('100 ms', response.data['error'])
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_rejects_when_database_is_busy(self, mock_connect):
+        with self.settings(INSIGHTS_QUERY_LIMITS={'MAX_CONCURRENT': 1, 'MAX_QUEUED': 0, 'QUEUE_TIMEOUT': 2}):
+            limiter = query_limiters.get(resolve_db_config({}))
+        limiter.acquire()
+        self.addCleanup(limiter.release)
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_stream_releases_slot(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'stream': True}, content_type='application/json')
+        response = execute_raw_sql(request)
+        limiter = query_limiters.get(resolve_db_config({}))
+        self.assertEqual(limiter.active, 1)
+        b''.join(response.streaming_content)
+        self.assertEqual(limiter.active, 0)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_cached_select(self, mock_connect):
+        request = lambda: self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'cache': True}, content_type='application/json')
+        self.assertEqual(execute_raw_sql(request()).data['cache']['hit'], False)
+        response = execute_raw_sql(request())
+        self.assertEqual(response.data['results'], [{'id': 1}])
+        self.assertTrue(response.data['cache']['hit'])
+        self.assertEqual(FakeDictCursor.executed.count('SELECT id FROM test_table'), 1)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_cache_invalidated_by_writes(self, mock_connect):
+        request = lambda: self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'cache': True}, content_type='application/json')
+        execute_raw_sql(request())
+        FakeDictCursor.write_marker = 'marker-2'
+        self.assertFalse(execute_raw_sql(request()).data['cache']['hit'])
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_cache_invalidated_by_api_writes(self, mock_connect):
+        request = lambda query, **extra: self.factory.post('/api/raw-sql/', data=dict(query=query, **extra), content_type='application/json')
+        execute_raw_sql(request('SELECT id FROM test_table', cache=True))
+        execute_raw_sql(request('INSERT INTO test_table (id) VALUES (2)'))
+        self.assertFalse(execute_raw_sql(request('SELECT id FROM test_table', cache=True)).data['cache']['hit'])
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_offset_page(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'page_size': 50, 'page': 3}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [{'id': 1}])
+        self.assertEqual(response.data['page'], {'page_size': 50, 'page': 3, 'has_more': False, 'estimated_total': 1000})
+        self.assertIn('LIMIT 51', self.last_statement())
+        self.assertIn('OFFSET 100', self.last_statement())
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_keyset_page(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'page_size': 1, 'order_by': 'id', 'after': 0}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(response.data['page']['next_after'], None)
+        self.assertIn('WHERE ("id") > (%s) ORDER BY "id" LIMIT 2', self.last_statement())
+        self.assertNotIn('OFFSET', self.last_statement())
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_returns_every_row_by_default(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertNotIn('preview', response.data)
+        self.assertEqual(self.last_statement(), 'SELECT id FROM test_table')
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_previews_unbounded_selects(self, mock_connect):
+        request = lambda query: self.factory.post('/api/raw-sql/', data={'query': query, 'preview_limit': 1}, content_type='application/json')
+        response = execute_raw_sql(request('SELECT id FROM test_table'))
+        self.assertEqual(response.data['preview'], {'limit': 1, 'truncated': False})
+        self.assertTrue(self.last_statement().endswith(') AS _preview LIMIT 2'))
+        response = execute_raw_sql(request('SELECT id FROM test_table LIMIT 5'))
+        self.assertNotIn('preview', response.data)
+        self.assertEqual(self.last_statement(), 'SELECT id FROM test_table LIMIT 5')
+        self.assertEqual(trim_preview([(1,), (2,), (3,)], 2), ([(1,), (2,)], True))
+
+    @override_settings(INSIGHTS_COST_GUARD={'MAX_COST': 10, 'LARGE_TABLE_ROWS': 500})
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_rejects_expensive_plans(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['plan']['seq_scans'], [{'table': 'test_table', 'rows': 1000}])
+        self.assertEqual(response.data['plan']['warnings'], ['Sequential scan of test_table (about 1000 rows)'])
+        self.assertNotIn('SELECT id FROM test_table', FakeDictCursor.executed)
+
+    @override_settings(INSIGHTS_COST_GUARD={'MAX_COST': 10, 'LARGE_TABLE_ROWS': 500})
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_stream_rejects_expensive_plans(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'stream': True}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['plan']['seq_scans'], [{'table': 'test_table', 'rows': 1000}])
+        self.assertNotIn('SELECT id FROM test_table', FakeDictCursor.executed)
+        self.assertEqual(query_limiters.get(resolve_db_config({})).active, 0)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_page_rejects_writes(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'DELETE FROM test_table', 'page_size': 10}, content_type='application/json')
+        self.assertEqual(execute_raw_sql(request).status_code, 400)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_columnar_format(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'format': 'columnar'}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertEqual((response.data['columns'], response.data['data']), (['id'], [[1]]))
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_msgpack_format(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'format': 'msgpack'}, content_type='application/json')
+        response = execute_raw_sql(request).render()
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        body = msgpack.unpackb(response.content)
+        self.assertEqual((body['columns'], body['data']), (['id'], [[1]]))
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_arrow_negotiated_from_accept(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json',
+                                    HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+        response = execute_raw_sql(request).render()
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        self.assertEqual(table.to_pydict(), {'id': [1]})
+
+    def test_fast_json_renderer_types(self):
+        row = {
+            'amount': Decimal('12.50'),
+            'created_at': datetime.datetime(2024, 5, 1, 12, 30, 0, 250000, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2024, 5, 1),
+            'id': uuid.UUID(int=1),
+            'payload': memoryview(b'\x00\xff'),
+            'big': 2 ** 70,
+        }
+        body = FastJSONRenderer().render({'results': [row]})
+        self.assertEqual(json.loads(body)['results'][0], {
+            'amount': '12.50',
+            'created_at': '2024-05-01T12:30:00.250000Z',
+            'day': '2024-05-01',
+            'id': '00000000-0000-0000-0000-000000000001',
+            'payload': '\\x00ff',
+            'big': 2 ** 70,
+        })
+
+    def test_decimals_keep_their_precision(self):
+        row = {'amount': Decimal('12345678901234567.89')}
+        self.assertEqual(json.loads(FastJSONRenderer().render(row)), {'amount': '12345678901234567.89'})
+        with override_settings(INSIGHTS_DECIMAL_AS_FLOAT=True):
+            self.assertEqual(json.loads(FastJSONRenderer().render({'amount': Decimal('12.50')})), {'amount': 12.5})
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_renders_with_fast_json(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table'}, content_type='application/json')
+        response = execute_raw_sql(request)
+        self.assertIsInstance(response.accepted_renderer, FastJSONRenderer)
+        self.assertEqual(json.loads(response.render().content)['results'], [{'id': 1}])
 
-    @patch('insights.views.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_execute_raw_sql_unknown_format(self, mock_connect):
+        request = self.factory.post('/api/raw-sql/', data={'query': 'SELECT id FROM test_table', 'format': 'xml'}, content_type='application/json')
+        self.assertEqual(execute_raw_sql(request).status_code, 400)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
     def test_execute_raw_sql_non_select_query(self, mock_connect):
         request = self.factory.post('/api/raw-sql/', data={'query': 'INSERT INTO test_table (id) VALUES (1)'}, content_type='application/json')
         response = execute_raw_sql(request)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data, {'affected_rows': 1})
+        self.assertEqual(response.data['affected_rows'], 1)
 
     # --- get_database_schema ---
-    @patch('insights.views.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
     def test_get_database_schema_incomplete_credentials(self, mock_connect):
         request = self.factory.post('/api/get-database-schema/', data={'db_config': {'name': 'defaultdb', 'user': 'avnadmin'}}, content_type='application/json')
         response = get_database_schema(request)
         self.assertEqual(response.status_code, 400)
 
-    @patch('insights.views.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
     def test_get_database_schema_success(self, mock_connect):
         request = self.factory.post('/api/get-database-schema/', data={
             'db_config': {
@@ -146,8 +488,24 @@ class DummyAPITest(TestCase):
         self.assertIn('public', response.data['schema'])
         self.assertIn('test_table', response.data['schema']['public'])
 
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_get_database_schema_served_from_cache(self, mock_connect):
+        request = lambda: self.factory.post('/api/get-database-schema/', data={}, content_type='application/json')
+        self.assertFalse(get_database_schema(request()).data['schema_cache_hit'])
+        response = get_database_schema(request())
+        self.assertTrue(response.data['schema_cache_hit'])
+        self.assertIn('test_table', response.data['schema']['public'])
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_get_database_schema_refetched_after_ddl(self, mock_connect):
+        request = lambda: self.factory.post('/api/get-database-schema/', data={}, content_type='application/json')
+        get_database_schema(request())
+        FakeDictCursor.fingerprint = 'fingerprint-2'
+        self.assertFalse(get_database_schema(request()).data['schema_cache_hit'])
+        self.assertTrue(get_database_schema(request()).data['schema_cache_hit'])
+
     # --- generate_sql_query ---
-    @patch('insights.views.get_db_schema', return_value={
+    @patch('insights.views.get_db_schema', return_value=SchemaSnapshot({
         'public': {
             'test_table': [{
                 'column_name': 'id',
@@ -156,11 +514,10 @@ class DummyAPITest(TestCase):
                 'column_default': None
             }]
         }
-    })
-    @patch('insights.views.Groq')
-    def test_generate_sql_query_success(self, mock_groq, mock_get_db_schema):
+    }, 'fingerprint-1', False))
+    def test_generate_sql_query_success(self, mock_get_db_schema):
         fake_sql = 'SELECT "id" FROM "test_table";'
-        instance = mock_groq.return_value
+        instance = self.groq
         instance.chat.completions.create.return_value = FakeGroqResponse(fake_sql)
         request = self.factory.post('/api/generate-sql-query/', data={'natural_language': 'Get the id from test_table'}, content_type='application/json')
         response = generate_sql_query(request)
@@ -168,15 +525,69 @@ class DummyAPITest(TestCase):
         self.assertIn('sql_query', response.data)
         self.assertEqual(response.data['sql_query'], fake_sql)
 
-    @patch('insights.views.Groq')
-    def test_generate_sql_query_missing_natural_language(self, mock_groq):
+    @patch('insights.views.get_db_schema', return_value=SchemaSnapshot({'public': {}}, 'fingerprint-1', True))
+    def test_generate_sql_query_reuses_cached_generation(self, mock_get_db_schema):
+        instance = self.groq
+        instance.chat.completions.create.return_value = FakeGroqResponse('SELECT 1;')
+        first = self.factory.post('/api/generate-sql-query/', data={'natural_language': 'How many users?'}, content_type='application/json')
+        second = self.factory.post('/api/generate-sql-query/', data={'natural_language': '  how many  USERS '}, content_type='application/json')
+        self.assertFalse(generate_sql_query(first).data['generation_cache_hit'])
+        response = generate_sql_query(second)
+        self.assertTrue(response.data['generation_cache_hit'])
+        self.assertEqual(response.data['sql_query'], 'SELECT 1;')
+        self.assertEqual(instance.chat.completions.create.call_count, 1)
+
+    @patch('insights.views.get_db_schema', return_value=SchemaSnapshot({'public': {
+        'UserWorkspace': [{'column_name': 'userId', 'data_type': 'integer', 'is_nullable': 'NO', 'column_default': None}],
+    }}, 'fingerprint-1', True))
+    def test_generate_sql_query_repairs_identifiers_locally(self, mock_get_db_schema):
+        self.groq.chat.completions.create.return_value = FakeGroqResponse('SELECT userId FROM UserWorkspace;')
+        request = self.factory.post('/api/generate-sql-query/', data={'natural_language': 'workspace users'}, content_type='application/json')
+        response = generate_sql_query(request)
+        self.assertEqual(response.data['sql_query'], 'SELECT "userId" FROM "UserWorkspace";')
+        self.assertEqual(len(response.data['validation']['repairs']), 2)
+        self.assertEqual(self.groq.chat.completions.create.call_count, 1)
+
+    @patch('insights.views.get_db_schema', return_value=SchemaSnapshot({'public': {
+        'test_table': [{'column_name': 'id', 'data_type': 'integer', 'is_nullable': 'NO', 'column_default': None}],
+    }}, 'fingerprint-1', True))
+    def test_generate_sql_query_sends_unresolvable_problems_to_the_model(self, mock_get_db_schema):
+        self.groq.chat.completions.create.side_effect = [
+            FakeGroqResponse('SELECT salary FROM test_table'),
+            FakeGroqResponse('SELECT id FROM test_table'),
+        ]
+        request = self.factory.post('/api/generate-sql-query/', data={'natural_language': 'salaries'}, content_type='application/json')
+        response = generate_sql_query(request)
+        self.assertEqual(response.data['sql_query'], 'SELECT id FROM test_table')
+        self.assertEqual(response.data['validation'], {'repairs': [], 'problems': [], 'model_retries': 1})
+        retry_prompt = self.groq.chat.completions.create.call_args.kwargs['messages'][1]['content']
+        self.assertIn('Unknown column salary', retry_prompt)
+
+    @patch('insights.views.get_db_schema', return_value=SchemaSnapshot({'public': {
+        'test_table': [{'column_name': 'id', 'data_type': 'integer', 'is_nullable': 'NO', 'column_default': None}],
+    }}, 'fingerprint-1', True))
+    def test_generate_sql_query_does_not_cache_invalid_sql(self, mock_get_db_schema):
+        self.groq.chat.completions.create.side_effect = [
+            FakeGroqResponse('SELECT salary FROM test_table'),
+            FakeGroqResponse('SELECT wage FROM test_table'),
+            FakeGroqResponse('SELECT id FROM test_table'),
+        ]
+        request = lambda: self.factory.post('/api/generate-sql-query/', data={'natural_language': 'salaries'}, content_type='application/json')
+        first = generate_sql_query(request())
+        self.assertEqual(first.data['validation']['problems'], ['Unknown column wage'])
+        second = generate_sql_query(request())
+        self.assertFalse(second.data['generation_cache_hit'])
+        self.assertEqual(second.data['sql_query'], 'SELECT id FROM test_table')
+        self.assertEqual(self.groq.chat.completions.create.call_count, 3)
+        self.assertTrue(generate_sql_query(request()).data['generation_cache_hit'])
+
+    def test_generate_sql_query_missing_natural_language(self):
         request = self.factory.post('/api/generate-sql-query/', data={}, content_type='application/json')
         response = generate_sql_query(request)
         self.assertEqual(response.status_code, 400)
 
     # --- generate_visualization_data ---
-    @patch('insights.views.Groq')
-    def test_generate_visualization_data_success(self, mock_groq):
+    def test_generate_visualization_data_success(self):
         visualization_output = [
             {
                 "type": "bar",
@@ -188,20 +599,945 @@ class DummyAPITest(TestCase):
                 }
             }
         ]
-        instance = mock_groq.return_value
-        instance.chat.completions.create.return_value = FakeGroqVisualizationResponse(visualization_output)
-        request = self.factory.post('/api/generate-visualization-data/', data={'dataset': 'some dataset'}, content_type='application/json')
+        instance = self.groq
+        instance.chat.completions.create.return_value = FakeGroqVisualizationResponse([{"type": "bar", "x": "x", "y": "y", "aggregate": "sum"}])
+        dataset = [{'x': 1, 'y': 4}, {'x': 2, 'y': 5}, {'x': 3, 'y': 6}]
+        request = self.factory.post('/api/generate-visualization-data/', data={'dataset': dataset}, content_type='application/json')
         response = generate_visualization_data(request)
         self.assertEqual(response.status_code, 200)
         self.assertIn('visualizations', response.data)
         self.assertEqual(response.data['visualizations'], visualization_output)
 
-    @patch('insights.views.Groq')
-    def test_generate_visualization_data_missing_dataset(self, mock_groq):
+    def test_generate_visualization_data_sends_profile_not_dataset(self):
+        instance = self.groq
+        instance.chat.completions.create.return_value = FakeGroqVisualizationResponse([{"type": "pie", "x": "genre", "y": None, "aggregate": "count"}])
+        dataset = [{'genre': f'genre-{n % 3}', 'title': f'movie number {n}'} for n in range(5000)]
+        request = self.factory.post('/api/generate-visualization-data/', data={'dataset': dataset}, content_type='application/json')
+        response = generate_visualization_data(request)
+        prompt = instance.chat.completions.create.call_args.kwargs['messages'][1]['content']
+        self.assertLess(len(prompt), 5000)
+        self.assertNotIn('movie number 2500', prompt)
+        self.assertEqual(response.data['visualizations'][0]['data']['values'][0], {'label': 'genre-0', 'value': 1667})
+
+    def test_generate_visualization_data_charts_common_shapes_by_rule(self):
+        dataset = [{'genre': 'drama', 'revenue': 10}, {'genre': 'comedy', 'revenue': 30}, {'genre': 'drama', 'revenue': 5}]
+        request = self.factory.post('/api/generate-visualization-data/', data={'dataset': dataset}, content_type='application/json')
+        response = generate_visualization_data(request)
+        self.groq.chat.completions.create.assert_not_called()
+        self.assertEqual(response.data['source'], 'rules')
+        bar, pie = response.data['visualizations']
+        self.assertEqual(bar['data'], {'xlabel': 'genre', 'ylabel': 'revenue', 'xvalues': ['comedy', 'drama'], 'yvalues': [30, 15]})
+        self.assertEqual(pie['data']['values'], [{'label': 'comedy', 'value': 30}, {'label': 'drama', 'value': 15}])
+
+    def test_generate_visualization_data_rejects_bad_max_points(self):
+        request = self.factory.post('/api/generate-visualization-data/', data={'dataset': [{'a': 1}], 'max_points': 1}, content_type='application/json')
+        self.assertEqual(generate_visualization_data(request).status_code, 400)
+
+    def test_generate_visualization_data_missing_dataset(self):
         request = self.factory.post('/api/generate-visualization-data/', data={}, content_type='application/json')
         response = generate_visualization_data(request)
         self.assertEqual(response.status_code, 400)
 
+    # --- ask (one-shot pipeline) ---
+    def ask_events(self, data):
+        request = self.factory.post('/api/ask/', data=data, content_type='application/json')
+        response = ask(request)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = []
+        for block in b''.join(response.streaming_content).decode().strip().split('\n\n'):
+            event, payload = block.split('\n')
+            events.append((event[len('event: '):], json.loads(payload[len('data: '):])))
+        return events
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.views.generate_sql', return_value='```sql\nSELECT id FROM test_table\n```')
+    def test_ask_streams_each_stage(self, mock_generate_sql, mock_connect):
+        events = self.ask_events({'natural_language': 'ids of test_table'})
+        self.assertEqual([event for event, _ in events], ['sql', 'rows', 'charts', 'done'])
+        self.assertEqual(events[0][1]['sql_query'], 'SELECT id FROM test_table')
+        self.assertEqual(events[1][1]['results'], [{'id': 1}])
+        self.assertEqual(events[1][1]['plan']['estimated_rows'], 1000)
+        self.assertEqual(events[2][1]['source'], 'rules')
+        self.assertEqual(events[2][1]['row_count'], 1)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.views.generate_sql', side_effect=['SELECT id / 0 FROM test_table', 'SELECT id FROM test_table'])
+    def test_ask_retries_query_the_database_rejects(self, mock_generate_sql, mock_connect):
+        execute = FakeDictCursor.execute
+        def failing_execute(cursor, query, params=None):
+            if '/ 0' in render_sql(query):
+                raise DivisionByZero('division by zero')
+            return execute(cursor, query, params)
+        with patch.object(FakeDictCursor, 'execute', failing_execute):
+            events = self.ask_events({'natural_language': 'ids of test_table'})
+        self.assertEqual([event for event, _ in events], ['sql', 'sql', 'rows', 'charts', 'done'])
+        self.assertEqual(mock_generate_sql.call_args.args[2], 'division by zero')
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.views.generate_sql', return_value='SELECT id FROM test_table')
+    def test_ask_does_not_retry_once_rows_were_sent(self, mock_generate_sql, mock_connect):
+        fetchmany = FakeDictCursor.fetchmany
+        calls = []
+        def failing_fetchmany(cursor, size):
+            calls.append(size)
+            if len(calls) > 1:
+                raise DivisionByZero('division by zero')
+            return fetchmany(cursor, size)
+        with patch.object(FakeDictCursor, 'fetchmany', failing_fetchmany):
+            events = self.ask_events({'natural_language': 'ids of test_table'})
+        self.assertEqual([event for event, _ in events], ['sql', 'rows', 'error'])
+        self.assertEqual(events[-1][1], {'stage': 'fetch', 'error': 'division by zero'})
+        self.assertEqual(mock_generate_sql.call_count, 1)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.views.generate_sql', return_value='SELECT id FROM test_table')
+    def test_ask_does_not_retry_errors_outside_the_query(self, mock_generate_sql, mock_connect):
+        execute = FakeDictCursor.execute
+        def failing_execute(cursor, query, params=None):
+            if render_sql(query) == 'SELECT id FROM test_table':
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+            return execute(cursor, query, params)
+        with patch.object(FakeDictCursor, 'execute', failing_execute):
+            events = self.ask_events({'natural_language': 'ids of test_table'})
+        self.assertEqual([event for event, _ in events], ['sql', 'error'])
+        self.assertEqual(mock_generate_sql.call_count, 1)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    @patch('insights.views.generate_sql', return_value='DELETE FROM test_table')
+    def test_ask_does_not_run_writes(self, mock_generate_sql, mock_connect):
+        events = self.ask_events({'natural_language': 'remove everything'})
+        self.assertEqual(events[-1][0], 'error')
+        self.assertEqual(events[-1][1]['stage'], 'execute')
+        self.assertNotIn('DELETE FROM test_table', FakeDictCursor.executed)
+
+    def test_ask_missing_natural_language(self):
+        request = self.factory.post('/api/ask/', data={}, content_type='application/json')
+        self.assertEqual(ask(request).status_code, 400)
+
+# ---------------------------------------------------------------------
+# Async views (asyncpg connection and AsyncGroq client replaced by fakes)
+# ---------------------------------------------------------------------
+class FakeAsyncStatement:
+    def get_attributes(self):
+        return [type("Attribute", (), {"name": "id"})]
+
+    async def fetch(self):
+        return [(1,)]
+
+class FakeAsyncConnection:
+    async def prepare(self, query):
+        return FakeAsyncStatement()
+
+    async def execute(self, query, *args):
+        return 'SELECT 1' if 'set_config' in query else 'INSERT 0 1'
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchval(self, query):
+        if query.startswith('EXPLAIN'):
+            return json.dumps([{'Plan': FakeDictCursor.plan}])
+        return FakeDictCursor.fingerprint
+
+    async def fetch(self, query, *args):
+        cursor = FakeDictCursor()
+        cursor.execute(query, args)
+        if 'reltuples' in query:
+            return [{'relname': name, 'reltuples': rows} for name, rows in cursor.fetchall()]
+        return cursor.fetchall()
+
+@asynccontextmanager
+async def fake_borrow_async(params):
+    yield FakeAsyncConnection()
+
+@patch('insights.async_views.borrow_async', fake_borrow_async)
+class AsyncViewsTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        patcher = patch('insights.async_views.generation_cache', GenerationCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.groq = MagicMock()
+        self.groq.chat.completions.create = AsyncMock()
+        patcher = patch.object(llm_gateway, 'backend', GroqBackend(async_client=self.groq))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        schema_cache.clear()
+
+    def post(self, path, data):
+        return self.factory.post(path, data=data, content_type='application/json')
+
+    async def test_execute_raw_sql_select_query(self):
+        response = await execute_raw_sql_async(self.post('/api/async/raw-sql/', {'query': 'SELECT id FROM test_table'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'], [{'id': 1}])
+
+    async def test_execute_raw_sql_non_select_query(self):
+        response = await execute_raw_sql_async(self.post('/api/async/raw-sql/', {'query': 'INSERT INTO test_table (id) VALUES (1)'}))
+        self.assertEqual(json.loads(response.content)['affected_rows'], 1)
+
+    async def test_execute_raw_sql_missing_query(self):
+        response = await execute_raw_sql_async(self.post('/api/async/raw-sql/', {}))
+        self.assertEqual(response.status_code, 400)
+
+    async def test_execute_raw_sql_refuses_sync_only_options(self):
+        request = {'query': 'SELECT id FROM test_table', 'page_size': 10, 'cache': True, 'format': 'columnar'}
+        response = await execute_raw_sql_async(self.post('/api/async/raw-sql/', request))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['error'], 'cache, page_size, format not supported here; use /api/raw-sql/')
+        request = {'query': 'SELECT id FROM test_table', 'format': 'records'}
+        self.assertEqual((await execute_raw_sql_async(self.post('/api/async/raw-sql/', request))).status_code, 200)
+
+    async def test_get_database_schema_shares_cache(self):
+        first = await get_database_schema_async(self.post('/api/async/database-schema/', {}))
+        second = await get_database_schema_async(self.post('/api/async/database-schema/', {}))
+        self.assertIn('test_table', json.loads(first.content)['schema']['public'])
+        self.assertFalse(json.loads(first.content)['schema_cache_hit'])
+        self.assertTrue(json.loads(second.content)['schema_cache_hit'])
+
+    async def test_generate_sql_query(self):
+        fake_sql = 'SELECT "id" FROM "test_table";'
+        self.groq.chat.completions.create.return_value = FakeGroqResponse(fake_sql)
+        response = await generate_sql_query_async(self.post('/api/async/generate-sql/', {'natural_language': 'Get the id from test_table'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['sql_query'], fake_sql)
+
+    async def test_generate_sql_query_follows_the_sync_steps(self):
+        self.groq.chat.completions.create.side_effect = [
+            FakeGroqResponse('SELECT salary FROM test_table'),
+            FakeGroqResponse('SELECT id FROM test_table'),
+        ]
+        request = lambda: self.post('/api/async/generate-sql/', {'natural_language': 'salaries'})
+        body = json.loads((await generate_sql_query_async(request())).content)
+        self.assertEqual(body['sql_query'], 'SELECT id FROM test_table')
+        self.assertEqual(body['validation'], {'repairs': [], 'problems': [], 'model_retries': 1})
+        self.assertTrue(json.loads((await generate_sql_query_async(request())).content)['generation_cache_hit'])
+        self.assertEqual(self.groq.chat.completions.create.call_count, 2)
+
+    async def test_generate_visualization_data(self):
+        visualization_output = [{"type": "line", "data": {"xlabel": "x", "ylabel": "y", "xvalues": [1, 2], "yvalues": [3, 4]}}]
+        specs = [{"type": "line", "x": "x", "y": "y"}]
+        self.groq.chat.completions.create.return_value = FakeGroqVisualizationResponse(specs)
+        dataset = {'columns': ['x', 'y'], 'data': [[1, 2], [3, 4]]}
+        response = await generate_visualization_data_async(self.post('/api/async/generate-visualizations/', {'dataset': dataset}))
+        self.assertEqual(json.loads(response.content), {'visualizations': visualization_output, 'source': 'model'})
+
+    async def test_rejects_get(self):
+        response = await execute_raw_sql_async(self.factory.get('/api/async/raw-sql/'))
+        self.assertEqual(response.status_code, 405)
+
+# ---------------------------------------------------------------------
+# LLM gateway
+# ---------------------------------------------------------------------
+class RateLimited(Exception):
+    pass
+
+class FakeLLMBackend:
+    """Answers from a script; RateLimited entries are raised, as a 429 would be"""
+
+    def __init__(self, *answers, delay=0):
+        self.answers = list(answers)
+        self.delay = delay
+        self.calls = 0
+
+    def complete(self, messages, model, temperature, max_tokens):
+        self.calls += 1
+        time.sleep(self.delay)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return Completion(answer, 10, 2)
+
+    async def acomplete(self, messages, model, temperature, max_tokens):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return Completion(self.answers.pop(0), 10, 2)
+
+    @staticmethod
+    def retry_after(error):
+        return 0 if isinstance(error, RateLimited) else None
+
+
+class LLMGatewayTest(TestCase):
+    messages = [{'role': 'user', 'content': 'hi'}]
+
+    def test_retries_rate_limits(self):
+        gateway = LLMGateway(FakeLLMBackend(RateLimited(), RateLimited(), 'SELECT 1'), backoff_base=0)
+        self.assertEqual(gateway.complete(self.messages, 'model'), 'SELECT 1')
+        stats = gateway.stats()['model']
+        self.assertEqual((stats['calls'], stats['retries'], stats['errors']), (1, 2, 0))
+        self.assertEqual((stats['prompt_tokens'], stats['completion_tokens']), (10, 2))
+
+    def test_gives_up_after_max_retries_and_on_other_errors(self):
+        gateway = LLMGateway(FakeLLMBackend(RateLimited(), RateLimited()), max_retries=1, backoff_base=0)
+        with self.assertRaises(RateLimited):
+            gateway.complete(self.messages, 'model')
+        gateway = LLMGateway(FakeLLMBackend(ValueError('bad request')))
+        with self.assertRaises(ValueError):
+            gateway.complete(self.messages, 'model')
+        self.assertEqual(gateway.backend.calls, 1)
+
+    def test_identical_concurrent_prompts_share_one_call(self):
+        backend = FakeLLMBackend('SELECT 1', delay=0.05)
+        gateway = LLMGateway(backend)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(gateway.complete(self.messages, 'model'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['SELECT 1'] * 5)
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual(gateway.stats()['model']['coalesced'], 4)
+
+    async def test_identical_concurrent_async_prompts_share_one_call(self):
+        backend = FakeLLMBackend('SELECT 1', delay=0.01)
+        gateway = LLMGateway(backend)
+        results = await asyncio.gather(*(gateway.acomplete(self.messages, 'model') for _ in range(3)))
+        self.assertEqual(results, ['SELECT 1'] * 3)
+        self.assertEqual(backend.calls, 1)
+
+    async def test_cancelled_caller_leaves_coalesced_callers_waiting(self):
+        backend = FakeLLMBackend('SELECT 1', 'SELECT 2', delay=0.05)
+        gateway = LLMGateway(backend)
+        leader = asyncio.ensure_future(gateway.acomplete(self.messages, 'model'))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(gateway.acomplete(self.messages, 'model'))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        self.assertEqual(await follower, 'SELECT 1')
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(backend.calls, 1)
+
+    async def test_upstream_call_is_cancelled_once_nobody_waits(self):
+        backend = FakeLLMBackend('SELECT 1', delay=0.05)
+        gateway = LLMGateway(backend)
+        callers = [asyncio.ensure_future(gateway.acomplete(self.messages, 'model')) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        self.assertEqual(gateway._async_flights, {})
+        # The cancelled call never answered; the next identical call goes upstream again
+        self.assertEqual(await gateway.acomplete(self.messages, 'model'), 'SELECT 1')
+        self.assertEqual(backend.calls, 2)
+
+# ---------------------------------------------------------------------
+# Local SQL validation
+# ---------------------------------------------------------------------
+def schema_columns(*names):
+    return [{'column_name': name, 'data_type': 'text', 'is_nullable': 'YES', 'column_default': None} for name in names]
+
+
+class SqlCheckTest(TestCase):
+    schema = {'public': {
+        'User': schema_columns('id', 'firstName', 'user'),
+        'UserWorkspace': schema_columns('userId', 'workspaceId'),
+        'orders': schema_columns('id', 'user_id', 'total'),
+    }}
+
+    def check(self, query):
+        return check_sql(query, self.schema)
+
+    def test_quotes_camel_case_and_fixes_case(self):
+        check = self.check('SELECT u.firstname, uw.workspaceId FROM UserWorkspace uw JOIN "user" u ON uw.userId = u.id')
+        self.assertEqual(check.sql, 'SELECT u."firstName", uw."workspaceId" FROM "UserWorkspace" uw '
+                                    'JOIN "User" u ON uw."userId" = u.id')
+        self.assertEqual({repair['reason'] for repair in check.repairs}, {'case'})
+        self.assertEqual(check.problems, [])
+
+    def test_backticks_and_reserved_words_are_requoted(self):
+        check = self.check('SELECT `firstName`, user FROM `User`')
+        self.assertEqual(check.sql, 'SELECT "firstName", "user" FROM "User"')
+
+    def test_fixes_near_misses_and_reports_the_rest(self):
+        self.assertEqual(self.check('SELECT totl FROM ordrs').sql, 'SELECT total FROM orders')
+        self.assertEqual(self.check('SELECT salary FROM orders').problems, ['Unknown column salary'])
+        # Columns are not second-guessed once a table is unknown
+        check = self.check('SELECT salary FROM orders o JOIN payments p ON p.id = o.id')
+        self.assertEqual(check.problems, ['Unknown table payments'])
+
+    def test_leaves_valid_queries_alone(self):
+        for query in [
+            'WITH t AS (SELECT user_id, sum(total) AS s FROM orders GROUP BY user_id) '
+            'SELECT t.s, u."firstName" FROM t JOIN "User" u ON u.id = t.user_id ORDER BY s DESC',
+            'SELECT count(*) n, EXTRACT(YEAR FROM now()) FROM (SELECT id FROM orders) a GROUP BY 2 ORDER BY n',
+            'SELECT public.orders.total, o2.* FROM public.orders JOIN orders o2 ON o2.id = orders.id',
+            'SELECT now()',
+            'CREATE TABLE anything (x int)',
+        ]:
+            check = self.check(query)
+            self.assertEqual((check.sql, check.repairs, check.problems), (query, [], []), query)
+
+
+# ---------------------------------------------------------------------
+# Export (COPY to CSV, Arrow and Parquet)
+# ---------------------------------------------------------------------
+class FakeExportCursor(FakeDictCursor):
+    """FakeDictCursor with COPY TO STDOUT and typed column descriptions"""
+
+    def execute(self, query, params=None):
+        super().execute(query, params)
+        if self.description == [("id",)]:
+            self.description = [Column(name="id", type_code=23)]
+
+    def copy_expert(self, statement, file):
+        FakeDictCursor.executed.append(statement)
+        if 'stalled' in statement:
+            FakeExportConnection.cancelled.wait()
+            raise QueryCanceledError('canceling statement due to user request')
+        if 'missing' in statement:
+            raise psycopg2.ProgrammingError('relation "missing" does not exist')
+        file.write(b'id\n')
+        file.write(b'1\n')
+
+class FakeExportConnection(FakeDictConnection):
+    cancelled = threading.Event()
+
+    def cursor(self, *args, **kwargs):
+        return FakeExportCursor()
+    def cancel(self):
+        FakeExportConnection.cancelled.set()
+
+
+class ExportTest(TestCase):
+    def tearDown(self):
+        pools.close_all()
+        export_limiters.clear()
+        FakeDictCursor.executed = []
+        FakeExportConnection.cancelled.clear()
+
+    def export(self, **body):
+        return Client().post('/api/export/', body, content_type='application/json')
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_csv_is_copied_out(self, mock_connect):
+        response = self.export(query='SELECT id FROM test_table;')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="export.csv"')
+        self.assertEqual(b''.join(response.streaming_content), b'id\n1\n')
+        self.assertIn('COPY (\nSELECT id FROM test_table\n) TO STDOUT WITH (FORMAT csv, HEADER true)', FakeDictCursor.executed)
+        self.assertEqual(export_limiters.get(resolve_db_config({})).active, 0)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_copy_errors_are_reported_before_streaming(self, mock_connect):
+        response = self.export(query='SELECT id FROM missing')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('does not exist', response.json()['error'])
+        self.assertEqual(export_limiters.get(resolve_db_config({})).active, 0)
+        self.assertEqual(pools.get(resolve_db_config({})).idle_count, 1)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_parquet_and_arrow_exports(self, mock_connect):
+        body = b''.join(self.export(query='SELECT id FROM test_table', format='parquet').streaming_content)
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(body))
+        self.assertEqual((str(table.schema.field('id').type), table.to_pydict()), ('int32', {'id': [1]}))
+        body = b''.join(self.export(query='SELECT id FROM test_table', format='arrow').streaming_content)
+        self.assertEqual(pyarrow.ipc.open_stream(body).read_all().to_pydict(), {'id': [1]})
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_exports_use_the_export_timeout(self, mock_connect):
+        with patch('insights.export.set_statement_timeout') as set_timeout:
+            b''.join(self.export(query='SELECT id FROM test_table', statement_timeout_ms=5).streaming_content)
+        self.assertEqual(set_timeout.call_args[0][1], 600000)
+        with self.settings(INSIGHTS_EXPORT={'STATEMENT_TIMEOUT_MS': 900000}), \
+                patch('insights.streaming.set_statement_timeout') as set_timeout:
+            b''.join(self.export(query='SELECT id FROM test_table', format='arrow').streaming_content)
+        self.assertEqual(set_timeout.call_args[0][1], 900000)
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_exports_take_slots_of_their_own(self, mock_connect):
+        params = resolve_db_config({})
+        response = self.export(query='SELECT id FROM test_table')
+        self.assertEqual((export_limiters.get(params).active, query_limiters.get(params).active), (1, 0))
+        b''.join(response.streaming_content)
+        self.assertEqual(export_limiters.get(params).active, 0)
+        query_limiters.clear()
+
+    @override_settings(INSIGHTS_EXPORT={'FIRST_CHUNK_TIMEOUT_SECONDS': 0.05})
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_stalled_copy_is_cancelled(self, mock_connect):
+        response = self.export(query='SELECT id FROM stalled')
+        self.assertEqual(response.status_code, 504)
+        self.assertTrue(FakeExportConnection.cancelled.is_set())
+        self.assertEqual(export_limiters.get(resolve_db_config({})).active, 0)
+        self.assertEqual(pools.get(resolve_db_config({})).idle_count, 1)
+
+    @override_settings(INSIGHTS_COST_GUARD={'MAX_COST': 10})
+    @patch('insights.pool.psycopg2.connect', return_value=FakeExportConnection())
+    def test_exports_go_through_the_cost_guard(self, mock_connect):
+        for export_format in ('csv', 'parquet'):
+            response = self.export(query='SELECT id FROM test_table', format=export_format)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('estimated cost', response.json()['error'])
+        self.assertFalse([query for query in FakeDictCursor.executed if 'COPY' in query])
+        self.assertEqual(export_limiters.get(resolve_db_config({})).active, 0)
+
+    def test_only_reads_are_exported(self):
+        self.assertEqual(self.export(query='DELETE FROM test_table').status_code, 400)
+        self.assertEqual(self.export(query='SELECT 1', format='xlsx').status_code, 400)
+
+
+# ---------------------------------------------------------------------
+# Stage timings and /metrics
+# ---------------------------------------------------------------------
+class MetricsTest(TestCase):
+    def setUp(self):
+        registry.clear()
+
+    def tearDown(self):
+        pools.close_all()
+        schema_cache.clear()
+        registry.clear()
+
+    @patch('insights.pool.psycopg2.connect', return_value=FakeDictConnection())
+    def test_stages_are_timed_and_exposed(self, mock_connect):
+        response = Client().post('/api/raw-sql/', {'query': 'SELECT id FROM test_table'}, content_type='application/json')
+        stages = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['connect', 'plan', 'execute', 'fetch', 'serialize', 'total'])
+
+        metrics = Client().get('/metrics').content.decode()
+        self.assertIn('insights_stage_seconds_count{view="execute_raw_sql",stage="execute"} 1', metrics)
+        self.assertIn('insights_request_seconds_bucket{view="execute_raw_sql",status="200",le="+Inf"} 1', metrics)
+        self.assertIn('insights_rows_returned_total{view="execute_raw_sql"} 1', metrics)
+        self.assertIn(f'insights_bytes_serialized_total{{view="execute_raw_sql"}} {len(response.content)}', metrics)
+
+    @patch('insights.async_views.borrow_async', fake_borrow_async)
+    async def test_async_views_are_timed(self):
+        response = await AsyncClient().post('/api/async/database-schema/', {}, content_type='application/json')
+        self.assertTrue(response['Server-Timing'].startswith('schema;dur='))
+        self.assertIn('insights_cache_lookups_total{cache="schema",result="miss"} 1', registry.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('example_seconds', 'Example', ('stage',), buckets=[0.1, 1])
+        for seconds in (0.05, 0.5, 5):
+            histogram.observe(seconds, stage='llm')
+        self.assertEqual(histogram.collect()[2:], [
+            'example_seconds_bucket{stage="llm",le="0.1"} 1',
+            'example_seconds_bucket{stage="llm",le="1"} 2',
+            'example_seconds_bucket{stage="llm",le="+Inf"} 3',
+            'example_seconds_sum{stage="llm"} 5.55',
+            'example_seconds_count{stage="llm"} 3',
+        ])
+
+
+# ---------------------------------------------------------------------
+# Benchmarks (built on the fakes above, so imported here as a module)
+# ---------------------------------------------------------------------
+from insights import benchmarks
+
+
+class BenchmarkTest(TestCase):
+    def test_every_case_runs_on_synthetic_data(self):
+        for name in benchmarks.CASES:
+            result = benchmarks.run_case(name, 30, repeat=1)
+            self.assertGreater(result.best, 0, name)
+        self.assertEqual(len({row['table_name'] for row in benchmarks.synthetic_schema(30)}), 2)
+        self.assertEqual(len(benchmarks.synthetic_rows(2000)), 2000)
+
+    def test_regressions_are_measured_against_baselines(self):
+        results = [benchmarks.Result('schema', 10, 0.003, 0.002, 5), benchmarks.Result('schema', 1000, 0.05, 0.04, 5)]
+        slower = benchmarks.regressions(results, {'schema:10': 0.001, 'schema:1000': 0.03}, threshold=0.5)
+        self.assertEqual([(regression.key, regression.ratio) for regression in slower], [('schema:10', 2.0)])
+
+
+# ---------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.params = resolve_db_config({})
+
+    def tearDown(self):
+        pools.close_all()
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_connection_is_reused(self, mock_connect):
+        pool = ConnectionPool(self.params)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(mock_connect.call_count, 1)
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_released_connection_is_reset(self, mock_connect):
+        pool = ConnectionPool(self.params)
+        conn = pool.acquire()
+        FakeDictCursor.executed = []
+        pool.release(conn)
+        self.assertEqual(FakeDictCursor.executed, ['DISCARD ALL'])
+        self.assertFalse(conn.autocommit)
+        self.assertIs(pool.acquire(), conn)
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_connection_that_cannot_be_reset_is_dropped(self, mock_connect):
+        pool = ConnectionPool(self.params)
+        conn = pool.acquire()
+        with patch.object(FakeDictCursor, 'execute', side_effect=psycopg2.OperationalError('server closed the connection')):
+            pool.release(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.size, 0)
+        self.assertIsNot(pool.acquire(), conn)
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_exhausted_pool_times_out(self, mock_connect):
+        pool = ConnectionPool(self.params, max_size=1, acquire_timeout=0.01)
+        pool.acquire()
+        with self.assertRaises(PoolExhausted):
+            pool.acquire()
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_closed_connection_is_replaced(self, mock_connect):
+        pool = ConnectionPool(self.params)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.close()
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.size, 1)
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_idle_connections_are_evicted(self, mock_connect):
+        pool = ConnectionPool(self.params, min_size=0, max_idle=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertTrue(conn.closed)
+
+    @patch('insights.pool.psycopg2.connect', side_effect=lambda **kwargs: FakeDictConnection())
+    def test_cancelled_statement_keeps_its_connection(self, mock_connect):
+        # QueryCanceledError is an OperationalError, but the connection is fine
+        with self.assertRaises(QueryCanceledError):
+            with borrow(self.params) as conn:
+                raise QueryCanceledError('canceling statement due to statement timeout')
+        self.assertFalse(conn.closed)
+        with borrow(self.params) as reused:
+            self.assertIs(reused, conn)
+
+        with self.assertRaises(psycopg2.OperationalError):
+            with borrow(self.params) as conn:
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.assertTrue(conn.closed)
+        self.assertEqual(pools.get(self.params).size, 0)
+
+    def test_pools_are_keyed_by_credentials(self):
+        other = dict(self.params, password='other')
+        self.assertIs(pools.get(self.params), pools.get(dict(self.params)))
+        self.assertIsNot(pools.get(self.params), pools.get(other))
+
+    def test_incomplete_credentials(self):
+        with self.assertRaises(ValueError):
+            resolve_db_config({'name': 'defaultdb', 'user': 'avnadmin'})
+
+# ---------------------------------------------------------------------
+# Dataset profiling and chart building
+# ---------------------------------------------------------------------
+class ProfilingTest(TestCase):
+    def setUp(self):
+        rows = [('drama', '2024-01-01T00:00:00Z', '9.50'), ('comedy', '2024-01-02T00:00:00Z', None), ('drama', '2024-01-02T00:00:00Z', '7.5')]
+        self.dataset = Dataset.from_payload([{'genre': g, 'released': r, 'price': p} for g, r, p in rows * 10])
+
+    def test_column_roles_and_statistics(self):
+        profile = {column['name']: column for column in profile_dataset(self.dataset)['columns']}
+        self.assertEqual(profile['genre']['role'], 'categorical')
+        self.assertEqual(profile['genre']['top'], [['drama', 20], ['comedy', 10]])
+        self.assertEqual(profile['released']['role'], 'temporal')
+        self.assertEqual(profile['released']['distinct'], 2)
+        self.assertEqual(profile['price']['role'], 'numeric')
+        self.assertEqual((profile['price']['nulls'], profile['price']['max']), (10, 9.5))
+
+    def test_sample_covers_every_category(self):
+        sample = sample_rows(self.dataset, size=4)
+        self.assertLessEqual(len(sample), 4)
+        self.assertEqual({row['genre'] for row in sample}, {'drama', 'comedy'})
+
+    def test_build_charts(self):
+        specs = [
+            {'type': 'bar', 'x': 'genre', 'y': 'price', 'aggregate': 'mean'},
+            {'type': 'line', 'x': 'released', 'y': 'price', 'aggregate': 'max'},
+            {'type': 'line', 'x': 'genre', 'y': 'price'},
+            {'type': 'bar', 'x': 'missing', 'y': 'price'},
+        ]
+        bar, line = build_charts(self.dataset, specs)
+        self.assertEqual(bar['data'], {'xlabel': 'genre', 'ylabel': 'mean of price', 'xvalues': ['drama'], 'yvalues': [8.5]})
+        self.assertEqual(line['data']['xvalues'], ['2024-01-01', '2024-01-02'])
+        self.assertEqual(line['data']['yvalues'], [9.5, 7.5])
+
+    def test_rules_cover_common_shapes_only(self):
+        shapes = {
+            'line': [{'day': '2024-01-01', 'total': 3}, {'day': '2024-01-02', 'total': 4}],
+            'histogram': [{'score': n} for n in range(50)],
+            'ambiguous': [{'a': 1, 'b': 2, 'c': 'x'}],
+        }
+        line = rule_based_specs(Dataset.from_payload(shapes['line']))
+        self.assertEqual(line, [{'type': 'line', 'x': 'day', 'y': 'total', 'aggregate': 'sum'}])
+        histogram, = build_charts(Dataset.from_payload(shapes['histogram']), rule_based_specs(Dataset.from_payload(shapes['histogram'])))
+        self.assertEqual(sum(histogram['data']['yvalues']), 50)
+        self.assertEqual(histogram['data']['xvalues'][0], '0–4.9')
+        self.assertIsNone(rule_based_specs(Dataset.from_payload(shapes['ambiguous'])))
+
+    def test_lttb_keeps_ends_and_peaks(self):
+        x = np.arange(1000, dtype=float)
+        y = np.zeros(1000)
+        y[500] = 100
+        keep = lttb(x, y, 10)
+        self.assertEqual(len(keep), 10)
+        self.assertEqual((keep[0], keep[-1]), (0, 999))
+        self.assertIn(500, keep)
+
+    def test_large_charts_are_reduced_to_max_points(self):
+        dataset = Dataset.from_payload({'columns': ['n', 'genre'], 'data': [list(range(100)), [f'g{n % 20}' for n in range(100)]]})
+        line, bar = build_charts(dataset, [{'type': 'line', 'x': 'n', 'y': 'n'}, {'type': 'bar', 'x': 'genre', 'y': 'n'}], max_points=5)
+        self.assertEqual(len(line['data']['xvalues']), 5)
+        self.assertEqual(line['original_points'], 100)
+        self.assertEqual(bar['data']['xvalues'][-1], 'Other')
+        self.assertEqual(sum(bar['data']['yvalues']), sum(range(100)))
+
+# ---------------------------------------------------------------------
+# Per-database query limits
+# ---------------------------------------------------------------------
+class QueryLimiterTest(TestCase):
+    def test_queued_request_gets_freed_slot(self):
+        limiter = QueryLimiter('db', max_concurrent=1, max_queued=1, queue_timeout=5)
+        limiter.acquire()
+        waiter = threading.Thread(target=limiter.acquire)
+        waiter.start()
+        while not limiter.waiting:
+            time.sleep(0.001)
+        limiter.release()
+        waiter.join()
+        self.assertEqual((limiter.active, limiter.waiting), (1, 0))
+
+    def test_queued_async_request_gets_freed_slot(self):
+        limiter = QueryLimiter('db', max_concurrent=1, max_queued=1, queue_timeout=5)
+        limiter.acquire()
+
+        async def wait_for_slot():
+            waiter = asyncio.ensure_future(limiter.acquire_async())
+            while not limiter.waiting:
+                await asyncio.sleep(0.001)
+            # Released from another thread, as a sync view would
+            threading.Thread(target=limiter.release).start()
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(wait_for_slot())
+        self.assertEqual((limiter.active, limiter.waiting), (1, 0))
+
+    def test_queued_requests_are_served_in_order(self):
+        limiter = QueryLimiter('db', max_concurrent=1, max_queued=2, queue_timeout=5)
+        limiter.acquire()
+        served = []
+
+        async def queue_two():
+            async def acquire(name):
+                await limiter.acquire_async()
+                served.append(name)
+            first = asyncio.ensure_future(acquire('first'))
+            while limiter.waiting < 1:
+                await asyncio.sleep(0.001)
+            second = asyncio.ensure_future(acquire('second'))
+            while limiter.waiting < 2:
+                await asyncio.sleep(0.001)
+            limiter.release()
+            await first
+            self.assertEqual(limiter.waiting, 1)
+            limiter.release()
+            await second
+
+        asyncio.run(queue_two())
+        self.assertEqual(served, ['first', 'second'])
+
+    def test_full_queue_is_rejected_immediately(self):
+        limiter = QueryLimiter('db', max_concurrent=1, max_queued=0, queue_timeout=5)
+        limiter.acquire()
+        started = time.monotonic()
+        with self.assertRaises(TooManyQueries):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_queue_wait_times_out(self):
+        limiter = QueryLimiter('db', max_concurrent=1, max_queued=1, queue_timeout=0.05)
+        limiter.acquire()
+        with self.assertRaises(TooManyQueries):
+            limiter.acquire()
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_disconnect_cancels_running_statement(self):
+        client, server = socket.socketpair()
+        conn = type('Conn', (), {'cancel': lambda self: setattr(self, 'cancelled', True)})()
+        request = RequestFactory().post('/api/raw-sql/', **{'gunicorn.socket': server})
+        with DisconnectWatch(request, conn) as watch:
+            client.close()
+            while not watch.cancelled:
+                time.sleep(0.001)
+        server.close()
+        self.assertTrue(conn.cancelled)
+
+    def test_disconnect_watch_ends_with_the_request(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        conn = MagicMock()
+        request = RequestFactory().post('/api/raw-sql/', **{'gunicorn.socket': server})
+        watch = DisconnectWatch(request, conn)
+        with watch:
+            time.sleep(0.01)
+            started = time.monotonic()
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertFalse(watch._thread.is_alive())
+        conn.cancel.assert_not_called()
+
+    def test_client_socket_is_found_without_gunicorn(self):
+        # runserver passes a LimitedStream over the socket's buffered reader as wsgi.input
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        rfile = server.makefile('rb')
+        self.addCleanup(rfile.close)
+        request = RequestFactory().post('/api/raw-sql/', **{'wsgi.input': LimitedStream(rfile, 0)})
+        self.assertIs(client_socket(request), server)
+        self.assertIs(client_socket(RequestFactory().post('/api/raw-sql/', **{'gunicorn.socket': server})), server)
+        self.assertIsNone(client_socket(RequestFactory().post('/api/raw-sql/')))
+
+# ---------------------------------------------------------------------
+# Result cache statement analysis
+# ---------------------------------------------------------------------
+class ResultCacheAnalysisTest(TestCase):
+    def test_read_only_detection(self):
+        self.assertTrue(is_read_only('SELECT * FROM "Movie"'))
+        self.assertTrue(is_read_only('WITH x AS (SELECT 1) SELECT * FROM x'))
+        self.assertFalse(is_read_only('SELECT * FROM "Movie" FOR UPDATE'))
+        self.assertFalse(is_read_only('SELECT * INTO copy FROM "Movie"'))
+        self.assertFalse(is_read_only('WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d'))
+        self.assertFalse(is_read_only('SELECT 1; DROP TABLE t'))
+        self.assertFalse(is_read_only("SELECT nextval('seq')"))
+
+    def test_referenced_tables(self):
+        query = 'SELECT * FROM "User" u JOIN public.orders o ON o.uid = u.id WHERE u.id IN (SELECT uid FROM ratings)'
+        self.assertEqual(referenced_tables(query), ['User', 'orders', 'ratings'])
+
+# ---------------------------------------------------------------------
+# NL-to-SQL generation cache
+# ---------------------------------------------------------------------
+class GenerationCacheTest(TestCase):
+    def test_key_depends_on_schema_model_and_error(self):
+        key = GenerationCache.make_key('Top movies', 'fp', 'model', False)
+        self.assertEqual(key, GenerationCache.make_key('top movies?', 'fp', 'model', False))
+        self.assertNotEqual(key, GenerationCache.make_key('Top movies', 'fp2', 'model', False))
+        self.assertNotEqual(key, GenerationCache.make_key('Top movies', 'fp', 'model2', False))
+        self.assertNotEqual(key, GenerationCache.make_key('Top movies', 'fp', 'model', 'relation does not exist'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = GenerationCache(max_entries=2)
+        cache.put('a', 'SELECT 1')
+        cache.put('b', 'SELECT 2')
+        cache.get('a')
+        cache.put('c', 'SELECT 3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'SELECT 1')
+
+    def test_entries_expire(self):
+        cache = GenerationCache(ttl=-1)
+        cache.put('a', 'SELECT 1')
+        self.assertIsNone(cache.get('a'))
+
+    def test_entries_survive_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite3')
+            GenerationCache(path=path).put('a', 'SELECT 1')
+            self.assertEqual(GenerationCache(path=path).get('a'), 'SELECT 1')
+
+# ---------------------------------------------------------------------
+# Schema pruning for NL-to-SQL prompts
+# ---------------------------------------------------------------------
+def schema_with_tables(count):
+    columns = lambda *names: [{'column_name': name, 'data_type': 'text', 'is_nullable': 'YES', 'comment': None} for name in names]
+    schema = {f'filler_{n}': columns('id', 'label', 'created_at') for n in range(count)}
+    schema['Movie'] = columns('id', 'title', 'releaseYear')
+    schema['ratings'] = columns('movie_id', 'user_id', 'score')
+    schema['payments'] = columns('id', 'amount') + [{'column_name': 'region', 'data_type': 'text', 'is_nullable': 'YES', 'comment': 'sales territory'}]
+    return SchemaSnapshot({'public': schema}, f'fp-{count}', False)
+
+
+class SchemaPruningTest(TestCase):
+    def test_tokenize_splits_identifiers(self):
+        self.assertEqual(tokenize('releaseYear movie_ratings'), ['release', 'year', 'movie', 'rating'])
+
+    def test_small_schema_is_sent_whole(self):
+        snapshot = schema_with_tables(0)
+        schema, tables, pruned = prune_schema(snapshot, 'top movies')
+        self.assertFalse(pruned)
+        self.assertEqual(schema, snapshot.schema)
+
+    def test_large_schema_keeps_relevant_tables(self):
+        with self.settings(INSIGHTS_SCHEMA_PROMPT={'MAX_TABLES': 2, 'TOKEN_BUDGET': 100}):
+            schema, tables, pruned = prune_schema(schema_with_tables(200), 'Average score of movies by release year')
+        self.assertTrue(pruned)
+        self.assertEqual(sorted(tables), ['public.Movie', 'public.ratings'])
+        self.assertEqual(set(schema['public']), {'Movie', 'ratings'})
+
+    def test_table_sizes_are_computed_once_per_schema(self):
+        snapshot = schema_with_tables(50)._replace(fingerprint='fp-sizes')
+        with patch('insights.schema_index.describe_table', wraps=describe_table) as describe:
+            prune_schema(snapshot, 'top movies')
+            prune_schema(snapshot, 'payments per region')
+        self.assertEqual(describe.call_count, 53)
+
+    def test_column_comments_are_searched(self):
+        with self.settings(INSIGHTS_SCHEMA_PROMPT={'MAX_TABLES': 1, 'TOKEN_BUDGET': 100}):
+            schema, tables, pruned = prune_schema(schema_with_tables(200), 'revenue per sales territory')
+        self.assertEqual(tables, ['public.payments'])
+
+
+def schema_with_rollups():
+    snapshot = schema_with_tables(200)
+    columns = lambda *names: [{'column_name': name, 'data_type': 'bigint', 'is_nullable': 'NO', 'comment': None} for name in names]
+    snapshot.schema['public']['quering_payment_monthly'] = columns('month', 'plan_id', 'status', 'payments', 'revenue', 'payers')
+    snapshot.schema['public']['quering_movie_watch_daily'] = columns('day', 'movie_id', 'views', 'completions', 'viewers')
+    return snapshot
+
+
+class RollupHintTest(TestCase):
+    def test_question_grain(self):
+        self.assertEqual(question_grain('Revenue per month by plan'), 'month')
+        self.assertEqual(question_grain('Weekly views of each movie'), 'week')
+        self.assertEqual(question_grain('Payers per quarter and year'), 'quarter')
+        self.assertEqual(question_grain('Events per hour yesterday'), 'hour')
+        self.assertIsNone(question_grain('Revenue by plan'))
+
+    def test_matching_rollup_is_added_to_the_prompt(self):
+        snapshot = schema_with_rollups()
+        with self.settings(INSIGHTS_SCHEMA_PROMPT={'MAX_TABLES': 1, 'TOKEN_BUDGET': 100}):
+            schema, tables, pruned = prune_schema(snapshot, 'Total payment revenue per month')
+            schema, tables, rollups = add_rollups(snapshot, 'Total payment revenue per month', schema, tables)
+        self.assertEqual([rollup['table'] for rollup in rollups], ['public.quering_payment_monthly'])
+        self.assertIn('public.quering_payment_monthly', tables)
+        self.assertIn('quering_payment_monthly', schema['public'])
+        prompt = sql_messages(schema, 'Total payment revenue per month', False, rollups)[1]['content']
+        self.assertIn('Prefer a rollup table', prompt)
+        self.assertIn('public.quering_payment_monthly', prompt)
+
+    def test_finer_grain_than_the_rollup_gets_no_hint(self):
+        snapshot = schema_with_rollups()
+        _, _, rollups = add_rollups(snapshot, 'Payment revenue per day', {}, [])
+        self.assertEqual(rollups, [])
+        _, _, rollups = add_rollups(snapshot, 'Movie views per hour', {}, [])
+        self.assertEqual(rollups, [])
+        _, _, rollups = add_rollups(snapshot, 'Movie views per week', {}, [])
+        self.assertEqual([rollup['table'] for rollup in rollups], ['public.quering_movie_watch_daily'])
+
+    def test_distinct_counts_are_not_rolled_up_to_a_coarser_period(self):
+        snapshot = schema_with_rollups()
+        for question in ('Yearly payers by plan', 'Unique movie viewers per month', 'Distinct payers by plan'):
+            _, _, rollups = add_rollups(snapshot, question, {}, [])
+            self.assertEqual(rollups, [], question)
+        _, _, rollups = add_rollups(snapshot, 'Monthly payers by plan', {}, [])
+        self.assertEqual([rollup['table'] for rollup in rollups], ['public.quering_payment_monthly'])
+        _, _, rollups = add_rollups(snapshot, 'Payment revenue per year', {}, [])
+        prompt = sql_messages({}, 'Payment revenue per year', False, rollups)[1]['content']
+        self.assertIn('exact for a single row only: payers', prompt)
+
 # --- Dummy Tests for the ConnectionViewSet ---
 # (We use RequestFactory to call the viewset directly.)
 from rest_framework.test import APIRequestFactory
@@ -1,6 +1,9 @@
 from django.urls import path
 from rest_framework import routers
 from .views import ConnectionViewSet, execute_raw_sql, get_database_schema, generate_sql_query, generate_visualization_data
+from .pipeline import ask
+from .export import export_query
+from .async_views import execute_raw_sql_async, get_database_schema_async, generate_sql_query_async, generate_visualization_data_async
 
 router = routers.DefaultRouter()
 router.register(r'connections', ConnectionViewSet)
@@ -10,4 +13,10 @@ urlpatterns = [
     path('database-schema/', get_database_schema, name='get_database_schema'),
     path('generate-sql/', generate_sql_query, name='generate_sql_query'),
     path('generate-visualizations/', generate_visualization_data, name='generate_visualization_data'),
+    path('ask/', ask, name='ask'),
+    path('export/', export_query, name='export_query'),
+    path('async/raw-sql/', execute_raw_sql_async, name='execute_raw_sql_async'),
+    path('async/database-schema/', get_database_schema_async, name='get_database_schema_async'),
+    path('async/generate-sql/', generate_sql_query_async, name='generate_sql_query_async'),
+    path('async/generate-visualizations/', generate_visualization_data_async, name='generate_visualization_data_async'),
 ] + router.urls
@@ -1,15 +1,45 @@
-from django.shortcuts import render
 from rest_framework import viewsets
 from rest_framework.response import Response
 from rest_framework import status
 from .models import Connection
 from .serializers import ConnectionSerializer
-from rest_framework.decorators import api_view
-import psycopg2
-import psycopg2.extras
-import json
-import os
-from groq import Groq
+from .pool import borrow, pool_key, resolve_db_config
+from .schema import fetch_schema
+from .generation import generation_key, generation_steps, run_generation, should_cache
+from .generation_cache import generation_cache
+from .explain import CostRejected, guard, limit_for, preview_limit_from, trim_preview, with_limit
+from .llm import llm_gateway
+from .metrics import count_cache, count_rows, stage
+from .limits import (
+    DisconnectWatch,
+    TooManyQueries,
+    query_limiters,
+    set_statement_timeout,
+    statement_timeout_ms,
+)
+from .prompts import (
+    SQL_MODEL,
+    VISUALIZATION_MODEL,
+    VisualizationParseError,
+    extract_visualizations,
+    sql_messages,
+    visualization_messages,
+)
+from .pagination import PageRequest, fetch_page
+from .renderers import (
+    RENDERERS_BY_FORMAT,
+    RESULT_FORMATS,
+    ArrowStreamRenderer,
+    MessagePackRenderer,
+    shape_results,
+)
+from .charts import build_charts, max_points_from, rule_based_specs
+from .profiling import Dataset, profile_dataset, sample_rows
+from .result_cache import cache_info, is_read_only, result_cache
+from .streaming import stream_select
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.settings import api_settings
+from psycopg2.extensions import QueryCanceledError
 
 # Create your views here.
 
@@ -17,7 +47,25 @@ class ConnectionViewSet(viewsets.ModelViewSet):
     queryset = Connection.objects.all()
     serializer_class = ConnectionSerializer
 
+def select_result_format(request):
+    """
+    The result layout asked for through the body's format field, falling
+    back to the renderer negotiated from the Accept header.
+    """
+    result_format = request.data.get('format')
+    if result_format is None:
+        negotiated = request.accepted_renderer.format
+        return negotiated if negotiated in RENDERERS_BY_FORMAT else 'records'
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f'Unsupported format: {result_format}')
+    if result_format in RENDERERS_BY_FORMAT:
+        renderer = RENDERERS_BY_FORMAT[result_format]()
+        request.accepted_renderer, request.accepted_media_type = renderer, renderer.media_type
+    return result_format
+
+
 @api_view(['POST'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [MessagePackRenderer, ArrowStreamRenderer])
 def execute_raw_sql(request):
     try:
         # Extract query and database credentials from request
@@ -27,56 +75,126 @@ def execute_raw_sql(request):
         if not query:
             return Response({'error': 'Query parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # If no db_config provided, use default querydb credentials
-        if not db_config:
-            db_config = {
-                'name': 'querydb',
-                'user': 'user',
-                'password': 'password',
-                'host': 'querydb',
-                'port': '5432'
-            }
-
-        # Extract credentials
-        dbname = db_config.get('name')
-        user = db_config.get('user')
-        password = db_config.get('password')
-        host = db_config.get('host')
-        port = db_config.get('port', '5432')
-
-        if not all([dbname, user, password, host]):
-            return Response({'error': 'Incomplete database credentials'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Create connection
-        conn = psycopg2.connect(
-            dbname=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port
-        )
-
+        # If no db_config provided, the default querydb credentials are used
         try:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute(query)
-                conn.commit()
-
-                # If the query is a SELECT statement
-                if query.strip().upper().startswith('SELECT'):
-                    rows = cursor.fetchall()
-                    if cursor.description:
-                        columns = [desc[0] for desc in cursor.description]
-                        results = [dict(zip(columns, row)) for row in rows]
-                        return Response({'results': results})
-                    return Response({'results': []})
-
-                # For other queries (INSERT, UPDATE, DELETE)
-                affected_rows = cursor.rowcount
-                return Response({'affected_rows': affected_rows})
-
+            params = resolve_db_config(db_config)
+            timeout_ms = statement_timeout_ms(params, request.data)
+            preview_limit = preview_limit_from(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Only a limited number of queries run against one database at once;
+        # the rest queue briefly and are then turned away
+        limiter = query_limiters.get(params)
+        try:
+            limiter.acquire()
+        except TooManyQueries as e:
+            return Response({'error': str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                            headers={'Retry-After': str(e.retry_after)})
+        slot_held = True
+        try:
+            # Opt-in streaming of SELECT results through a server-side cursor;
+            # the stream gives the slot back when it is closed
+            stream_format = request.data.get('stream')
+            if stream_format and query.strip().upper().startswith('SELECT'):
+                response = stream_select(params, query, 'ndjson' if stream_format is True else stream_format,
+                                         statement_timeout_ms=timeout_ms, on_close=limiter.release)
+                slot_held = False
+                return response
+
+            # Server-side pagination: only the requested page is fetched
+            if request.data.get('page_size') is not None:
+                if not is_read_only(query):
+                    return Response({'error': 'Pagination is only supported for read-only SELECT statements'}, status=status.HTTP_400_BAD_REQUEST)
+                page = PageRequest.from_data(request.data)
+                result_format = select_result_format(request)
+                with borrow(params) as conn:
+                    set_statement_timeout(conn, timeout_ms)
+                    with DisconnectWatch(request, conn):
+                        with conn.cursor() as cursor, stage('plan'):
+                            _, plan, _ = guard(cursor, query)
+                        with stage('execute'):
+                            columns, rows, page_info = fetch_page(
+                                conn, query, page, total=plan['estimated_rows'] if plan else None)
+                count_rows(len(rows))
+                body = shape_results(result_format, columns, rows)
+                body['page'] = page_info
+                if plan is not None:
+                    body['plan'] = plan
+                return Response(body)
+
+            # Read-only statements may be answered from the result cache when
+            # the tables they read have not been written to since
+            use_cache = request.data.get('cache', False) and is_read_only(query)
+            result_format = select_result_format(request)
+            # Unbounded SELECTs only return a preview of preview_limit rows
+            limit = limit_for(query, preview_limit)
+
+            # Borrow a pooled connection
+            with borrow(params) as conn:
+                if use_cache:
+                    lookup = result_cache.lookup(conn, pool_key(params), with_limit(query, limit) if limit else query)
+                    count_cache('result', lookup.entry is not None)
+                    if lookup.entry is not None:
+                        rows, truncated = trim_preview(lookup.entry['rows'], limit)
+                        count_rows(len(rows))
+                        body = shape_results(result_format, lookup.entry['columns'], rows)
+                        body['cache'] = cache_info(lookup.entry)
+                        if limit:
+                            body['preview'] = {'limit': limit, 'truncated': truncated}
+                        return Response(body)
+
+                # The timeout lasts until commit; the statement is cancelled
+                # early if the client hangs up
+                set_statement_timeout(conn, timeout_ms)
+
+                # Rows stay plain tuples until they are laid out for the response
+                with conn.cursor() as cursor, DisconnectWatch(request, conn):
+                    # The planner's estimate is checked before anything runs
+                    with stage('plan'):
+                        statement, plan, limit = guard(cursor, query, limit)
+                    with stage('execute'):
+                        cursor.execute(statement)
+                        conn.commit()
+
+                    # Writes made through the API drop this connection's cached
+                    # results straight away; other writers are caught by the marker
+                    if not use_cache and not is_read_only(query):
+                        result_cache.invalidate(pool_key(params))
+
+                    # If the query is a SELECT statement
+                    if query.strip().upper().startswith('SELECT'):
+                        with stage('fetch'):
+                            rows = cursor.fetchall()
+                        columns = [desc[0] for desc in cursor.description] if cursor.description else []
+                        if use_cache:
+                            result_cache.store(lookup, columns, rows)
+                        rows, truncated = trim_preview(rows, limit)
+                        count_rows(len(rows))
+                        body = shape_results(result_format, columns, rows)
+                        if use_cache:
+                            body['cache'] = cache_info(None)
+                        if plan is not None:
+                            body['plan'] = plan
+                        if limit:
+                            body['preview'] = {'limit': limit, 'truncated': truncated}
+                        return Response(body)
+
+                    # For other queries (INSERT, UPDATE, DELETE)
+                    affected_rows = cursor.rowcount
+                    body = {'affected_rows': affected_rows}
+                    if plan is not None:
+                        body['plan'] = plan
+                    return Response(body)
         finally:
-            conn.close()
-
+            if slot_held:
+                limiter.release()
+
+    except CostRejected as e:
+        return Response({'error': str(e), 'plan': e.plan}, status=status.HTTP_400_BAD_REQUEST)
+    except QueryCanceledError:
+        return Response({'error': f'Query cancelled: it ran longer than the {timeout_ms} ms statement timeout'},
+                        status=status.HTTP_504_GATEWAY_TIMEOUT)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -86,75 +204,18 @@ def get_database_schema(request):
     try:
         db_config = request.data.get('db_config', {})
 
-        # If no db_config provided, use default querydb credentials
-        if not db_config:
-            db_config = {
-                'name': 'querydb',
-                'user': 'user',
-                'password': 'password',
-                'host': 'querydb',
-                'port': '5432'
-            }
-
-        # Extract credentials
-        dbname = db_config.get('name')
-        user = db_config.get('user')
-        password = db_config.get('password')
-        host = db_config.get('host')
-        port = db_config.get('port', '5432')
-
-        if not all([dbname, user, password, host]):
-            return Response({'error': 'Incomplete database credentials'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Create connection
-        conn = psycopg2.connect(
-            dbname=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port
-        )
-
+        # If no db_config provided, the default querydb credentials are used
         try:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute("""
-                    SELECT 
-                        table_schema,
-                        table_name,
-                        column_name,
-                        data_type,
-                        is_nullable,
-                        column_default
-                    FROM 
-                        information_schema.columns
-                    WHERE 
-                        table_schema NOT IN ('information_schema', 'pg_catalog')
-                    ORDER BY
-                        table_schema,
-                        table_name,
-                        ordinal_position;
-                """)
-                columns_data = cursor.fetchall()
-
-                schema_info = {}
-                for column in columns_data:
-                    table_schema = column['table_schema']
-                    table_name = column['table_name']
-                    if table_schema not in schema_info:
-                        schema_info[table_schema] = {}
-                    if table_name not in schema_info[table_schema]:
-                        schema_info[table_schema][table_name] = []
-                    schema_info[table_schema][table_name].append({
-                        'column_name': column['column_name'],
-                        'data_type': column['data_type'],
-                        'is_nullable': column['is_nullable'],
-                        'column_default': column['column_default']
-                    })
-
-                return Response({'schema': schema_info})
+            params = resolve_db_config(db_config)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        finally:
-            conn.close()
+        # Borrow a pooled connection; the schema itself is served from the
+        # fingerprinted cache when the catalog has not changed
+        with borrow(params) as conn:
+            snapshot = fetch_schema(conn, pool_key(params))
+
+        return Response({'schema': snapshot.schema, 'schema_cache_hit': snapshot.cache_hit})
 
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -172,143 +233,45 @@ def generate_sql_query(request):
 
         # Get database schema for context
         db_config = request.data.get('db_config', {})
-        if not db_config:
-            db_config = {
-                'name': 'querydb',
-                'user': 'user',
-                'password': 'password',
-                'host': 'querydb',
-                'port': '5432'
-            }
-
-        # Get schema information
-        schema_info = get_db_schema(db_config)
-
-        # Format schema for prompt
-        schema_description = "Database Schema:\n"
-        for schema_name, tables in schema_info.items():
-            schema_description += f"Schema: {schema_name}\n"
-            for table_name, columns in tables.items():
-                schema_description += f"Table: {table_name}\n"
-                for column in columns:
-                    schema_description += f"  - {column['column_name']} ({column['data_type']})"
-                    if column['is_nullable'] == 'YES':
-                        schema_description += " NULL"
-                    schema_description += "\n"
-            schema_description += "\n"
-
-        # Initialize Groq client
-        client = Groq(api_key=os.environ.get('GROQ_API_KEY'))
-
-        # Create the base prompt
-        base_prompt = f"""Given the following database schema:
-        {schema_description}
-        Convert this natural language query to SQL: "{natural_language}"
-        Respond with ONLY the SQL query, no explanations or additional text.
-        Ensure that both table names and column names are properly quoted with double quotes. 
-        For example, generate queries like:
-        SELECT * FROM "UserWorkspace" INNER JOIN "User" ON "UserWorkspace"."userId" = "User"."id";
-        This guarantees the query is valid PostgreSQL syntax.
-        """
-
-        # Modify prompt for error handling if requested
-        if error_handling_requested:
-            prompt = base_prompt + """\n\nWhen generating the SQL query, please be extra careful to avoid potential errors. Ensure that the query is robust and handles cases where data might be missing or inconsistent. Focus on generating a query that is less likely to fail, even if it means being slightly less precise in perfectly capturing the natural language intent. prioritize correctness and stability over aggressive data retrieval.Check for upper case or lower case values issue. Check for proper or similar column names. The error message is: {error_handling_requested}"""
-        else:
-            prompt = base_prompt
-
-        # Generate SQL query using Groq
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a SQL expert that converts natural language to SQL queries. Only respond with the SQL query, no explanations."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            model="llama3-8b-8192",
-            temperature=0,
-            max_tokens=1000,
-        )
-
-        # Extract the generated SQL query
-        sql_query = chat_completion.choices[0].message.content.strip()
 
-        return Response({
-            'sql_query': sql_query,
-            'schema': schema_info
-        })
+        return Response(generate_sql_for(db_config, natural_language, error_handling_requested))
 
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-         
+
+
+def generate_sql_for(db_config, natural_language, error_handling_requested=False):
+    """Generate SQL for a question against a database; returns generate_sql_query's response body"""
+    snapshot = get_db_schema(db_config)
+    cache_key = generation_key(snapshot, natural_language, error_handling_requested)
+    steps = generation_steps(snapshot, natural_language, error_handling_requested, generation_cache.get(cache_key))
+    body = run_generation(steps, generate_sql)
+    if should_cache(body):
+        generation_cache.put(cache_key, body['sql_query'])
+    return body
+
+
+def generate_sql(schema_info, natural_language, error_handling_requested, rollups=None):
+    """Ask the LLM to translate a natural language question into SQL"""
+    with stage('prompt'):
+        messages = sql_messages(schema_info, natural_language, error_handling_requested, rollups)
+    return llm_gateway.complete(
+        messages,
+        model=SQL_MODEL,
+        temperature=0,
+        max_tokens=1000,
+    )
+
+
 def get_db_schema(db_config):
 
-    """Helper function to get database schema"""
+    """Helper function to get database schema as a SchemaSnapshot"""
     try:
-        # Extract credentials
-        dbname = db_config.get('name')
-        user = db_config.get('user')
-        password = db_config.get('password')
-        host = db_config.get('host')
-        port = db_config.get('port', '5432')
-
-        if not all([dbname, user, password, host]):
-            raise ValueError('Incomplete database credentials')
-
-        print(db_config)
-        # Create connection
-        conn = psycopg2.connect(
-            dbname=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port
-        )
+        params = resolve_db_config(db_config)
 
-        try:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute("""
-                    SELECT 
-                        table_schema,
-                        table_name,
-                        column_name,
-                        data_type,
-                        is_nullable,
-                        column_default
-                    FROM 
-                        information_schema.columns
-                    WHERE 
-                        table_schema NOT IN ('information_schema', 'pg_catalog')
-                    ORDER BY
-                        table_schema,
-                        table_name,
-                        ordinal_position;
-                """)
-                columns_data = cursor.fetchall()
-
-                schema_info = {}
-                for column in columns_data:
-                    table_schema = column['table_schema']
-                    table_name = column['table_name']
-                    if table_schema not in schema_info:
-                        schema_info[table_schema] = {}
-                    if table_name not in schema_info[table_schema]:
-                        schema_info[table_schema][table_name] = []
-                    schema_info[table_schema][table_name].append({
-                        'column_name': column['column_name'],
-                        'data_type': column['data_type'],
-                        'is_nullable': column['is_nullable'],
-                        'column_default': column['column_default']
-                    })
-
-                return schema_info
-
-        finally:
-            conn.close()
+        # Borrow a pooled connection
+        with borrow(params) as conn:
+            return fetch_schema(conn, pool_key(params))
 
     except Exception as e:
         raise Exception(f'Error getting database schema: {str(e)}')
@@ -320,54 +283,47 @@ def generate_visualization_data(request):
         if not dataset:
             return Response({'error': 'Dataset is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        client = Groq(api_key=os.environ.get('GROQ_API_KEY'))
-
-        prompt = f"""Analyze the provided dataset and determine the appropriate visualizations.
-            If a certain type of graph (bar, pie, line) is not possible, return null data for it.
-            If multiple graphs of the same type are possible, return multiple objects.
-            Provide ONLY the JSON output in the following format:
-            [
-                {{ "type": "bar", "data": {{ "xlabel": "", "ylabel": "", "xvalues": [], "yvalues": [] }} }},
-                {{ "type": "pie", "data": {{ "xlabel": "", "values": [] }} }},
-                {{ "type": "line", "data": {{ "xlabel": "", "ylabel": "", "xvalues": [], "yvalues": [] }} }}
-            ]
-
-            Here is the dataset: {dataset}
-            Generate the most relevant and meaningful visualizations based on the dataset, and output ONLY valid JSON without any extra commentary or explanations."""
-        
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a data visualization expert. Output ONLY valid JSON for visualizations in the requested format, without any commentary or extra text."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            model="mixtral-8x7b-32768",
-            temperature=0,
-            max_tokens=1500,
-        )
-
-        raw_output = chat_completion.choices[0].message.content.strip()
-
-        # Attempt to extract only the JSON array from the response
-        start_index = raw_output.find('[')
-        end_index = raw_output.rfind(']')
-        if start_index != -1 and end_index != -1:
-            json_str = raw_output[start_index:end_index+1]
-            try:
-                visualization_json = json.loads(json_str)
-            except Exception as e:
-                return Response({'error': f'Failed to parse JSON: {e}', 'raw': raw_output}, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            return Response({'error': 'No JSON array found in response', 'raw': raw_output}, status=status.HTTP_400_BAD_REQUEST)
+        # The model picks charts from a profile and a small sample; the
+        # charts are then computed from the full dataset here and reduced
+        # to at most max_points points each
+        try:
+            result_set = Dataset.from_payload(dataset)
+            max_points = max_points_from(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            specs, source = chart_specs(result_set)
+        except VisualizationParseError as e:
+            return Response({'error': str(e), 'raw': e.raw}, status=status.HTTP_400_BAD_REQUEST)
 
+        with stage('charts'):
+            visualizations = build_charts(result_set, specs, max_points)
         return Response({
-            'visualizations': visualization_json,
+            'visualizations': visualizations,
+            'source': source,
         })
 
     except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+def chart_specs(result_set):
+    """
+    The charts to draw for a Dataset and who chose them: by rule for the
+    common shapes, otherwise by the model from the dataset's profile.
+    Raises VisualizationParseError when the model's answer is unusable.
+    """
+    # Common shapes are charted by rule without asking the model
+    specs = rule_based_specs(result_set)
+    if specs is not None:
+        return specs, 'rules'
+
+    with stage('profile'):
+        messages = visualization_messages(profile_dataset(result_set), sample_rows(result_set))
+    raw_output = llm_gateway.complete(
+        messages,
+        model=VISUALIZATION_MODEL,
+        temperature=0,
+        max_tokens=1500,
+    )
+    return extract_visualizations(raw_output), 'model'
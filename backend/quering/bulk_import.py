@@ -0,0 +1,375 @@
+"""
+Bulk loading of the streaming catalog (movies, shows, seasons, episodes,
+genres, actors and cast) from NDJSON or CSV.
+
+Records are read as a stream and handled in batches. Each batch is
+validated field by field on unsaved model instances; foreign keys, unique
+values and explicit ids are checked with one query per field rather than
+one per row. Valid rows are written with COPY on PostgreSQL (ids are
+reserved from the table's sequence first, so many-to-many links can be
+written in the same pass) and with bulk_create elsewhere. ``genres`` are
+resolved by name or id for the whole batch at once: genres named but
+missing are created, rows with genre ids that do not exist are rejected,
+then the link rows are inserted together.
+
+A record's ``genres`` is a list in NDJSON and a ``|``-separated string in
+CSV. Foreign keys are given by id, as ``show`` or ``show_id``.
+"""
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import DatabaseError, connections, router, transaction
+
+from .models import Actor, Episode, Genre, Movie, MovieCast, Season, ShowCast, TVShow
+
+IMPORT_MODELS = {
+    model._meta.model_name: model
+    for model in (Genre, Actor, Movie, TVShow, Season, Episode, MovieCast, ShowCast)
+}
+
+IMPORT_FORMATS = ('ndjson', 'csv')
+
+# Separator of the genres in a CSV cell
+CSV_LIST_SEPARATOR = '|'
+
+
+def _options():
+    return getattr(settings, 'QUERING_IMPORT', {})
+
+
+@dataclass
+class ImportResult:
+    model: str
+    received: int = 0
+    created: int = 0
+    skipped: int = 0
+    failed: int = 0
+    genre_links: int = 0
+    genres_created: int = 0
+    errors: list = field(default_factory=list)
+    max_errors: int = 100
+
+    def error(self, line, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'model': self.model,
+            'received': self.received,
+            'created': self.created,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'genres_created': self.genres_created,
+            'genre_links': self.genre_links,
+            'errors': self.errors,
+        }
+
+
+def read_records(stream, import_format):
+    """
+    (line number, record) pairs from a text stream; a record that cannot be
+    parsed is given as a ValueError. Empty CSV cells are left out, so the
+    field's default applies.
+    """
+    if import_format == 'ndjson':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'Invalid JSON: {e}')
+                continue
+            if not isinstance(record, dict):
+                yield line_number, ValueError('Each line must be a JSON object')
+                continue
+            yield line_number, record
+    elif import_format == 'csv':
+        # The header is line 1
+        for line_number, row in enumerate(csv.DictReader(stream), start=2):
+            record = {key: value for key, value in row.items() if key and value not in ('', None)}
+            if 'genres' in record:
+                record['genres'] = [name.strip() for name in record['genres'].split(CSV_LIST_SEPARATOR) if name.strip()]
+            yield line_number, record
+    else:
+        raise ValueError(f'Unsupported import format: {import_format}')
+
+
+def _batches(records, size):
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class CatalogImporter:
+    """
+    Imports records of one catalog model. method is 'copy' (PostgreSQL
+    through psycopg2 only) or 'bulk_create'; by default COPY is used
+    wherever it is available.
+    """
+
+    def __init__(self, model, batch_size=None, method=None, using=None):
+        self.model = model
+        self.opts = model._meta
+        self.using = using or router.db_for_write(model)
+        self.connection = connections[self.using]
+        self.batch_size = batch_size or _options().get('BATCH_SIZE', 5000)
+        if method is None:
+            method = 'copy' if self._can_copy() else 'bulk_create'
+        elif method == 'copy' and not self._can_copy():
+            raise ValueError('COPY needs PostgreSQL through psycopg2')
+        self.method = method
+        self.foreign_keys = [f for f in self.opts.concrete_fields if f.is_relation]
+        self.unique_fields = [f for f in self.opts.concrete_fields if f.unique]
+        self.has_genres = any(f.name == 'genres' for f in self.opts.many_to_many)
+        self.fields_by_name = {}
+        for f in self.opts.concrete_fields:
+            self.fields_by_name[f.name] = f
+            self.fields_by_name[f.attname] = f
+
+    def _can_copy(self):
+        if self.connection.vendor != 'postgresql':
+            return False
+        with self.connection.cursor() as cursor:
+            return hasattr(cursor.cursor, 'copy_expert')
+
+    def run(self, records):
+        result = ImportResult(self.opts.model_name, max_errors=_options().get('MAX_ERRORS', 100))
+        explicit_ids = False
+        for batch in _batches(records, self.batch_size):
+            result.received += len(batch)
+            rows = self.validate(batch, result)
+            explicit_ids |= any(instance.pk is not None for _, instance, _ in rows)
+            if not rows:
+                continue
+            try:
+                with transaction.atomic(using=self.using):
+                    self.write(rows, result)
+            except DatabaseError as e:
+                # The whole batch is rolled back; later batches still run
+                for line_number, _, _ in rows:
+                    result.error(line_number, {'__all__': [str(e).strip()]})
+        if explicit_ids:
+            self._reset_sequences()
+        return result
+
+    # --- validation ---
+
+    def validate(self, batch, result):
+        """Valid (line number, unsaved instance, genres) of a batch; the rest go into result"""
+        rows = []
+        for line_number, record in batch:
+            if isinstance(record, Exception):
+                result.error(line_number, {'__all__': [str(record)]})
+                continue
+            try:
+                rows.append((line_number,) + self.build(record))
+            except ValidationError as e:
+                result.error(line_number, e.message_dict if hasattr(e, 'error_dict') else {'__all__': e.messages})
+        rows = self._check_foreign_keys(rows, result)
+        if self.has_genres:
+            rows = self._check_genre_ids(rows, result)
+        return self._check_unique(rows, result)
+
+    def build(self, record):
+        """An unsaved, field-validated instance and its genres (or None) for a record"""
+        record = dict(record)
+        genres = record.pop('genres', None) if self.has_genres else None
+        unknown = [name for name in record if name not in self.fields_by_name]
+        if unknown:
+            raise ValidationError({name: ['Unknown field'] for name in unknown})
+        instance = self.model()
+        for name, value in record.items():
+            setattr(instance, self.fields_by_name[name].attname, value)
+        # Foreign keys are checked for the whole batch afterwards
+        instance.clean_fields(exclude=[f.name for f in self.foreign_keys])
+        for f in self.foreign_keys:
+            value = getattr(instance, f.attname)
+            if value is None:
+                if not f.null:
+                    raise ValidationError({f.name: ['This field is required']})
+                continue
+            setattr(instance, f.attname, f.target_field.clean(value, instance))
+        if genres is not None and not isinstance(genres, list):
+            raise ValidationError({'genres': ['Must be a list of genre names or ids']})
+        return instance, genres
+
+    def _check_foreign_keys(self, rows, result):
+        for f in self.foreign_keys:
+            ids = {getattr(instance, f.attname) for _, instance, _ in rows} - {None}
+            if not ids:
+                continue
+            found = set(
+                f.related_model._default_manager.using(self.using)
+                .filter(pk__in=ids).values_list('pk', flat=True)
+            )
+            kept = []
+            for row in rows:
+                value = getattr(row[1], f.attname)
+                if value is None or value in found:
+                    kept.append(row)
+                else:
+                    result.error(row[0], {f.name: [f'{f.related_model.__name__} {value} does not exist']})
+            rows = kept
+        return rows
+
+    def _check_genre_ids(self, rows, result):
+        """Rows linking to genre ids that do not exist are errors; genre names are created as needed"""
+        ids = {genre for _, _, genres in rows if genres for genre in genres if isinstance(genre, int)}
+        if not ids:
+            return rows
+        found = set(Genre._default_manager.using(self.using).filter(pk__in=ids).values_list('pk', flat=True))
+        kept = []
+        for row in rows:
+            missing = [genre for genre in row[2] or () if isinstance(genre, int) and genre not in found]
+            if missing:
+                result.error(row[0], {'genres': [f'Genre {genre} does not exist' for genre in missing]})
+            else:
+                kept.append(row)
+        return kept
+
+    def _check_unique(self, rows, result):
+        """
+        Explicit ids already taken are errors; rows repeating a unique value
+        (e.g. a genre name) already in the table or the batch are skipped.
+        """
+        manager = self.model._default_manager.using(self.using)
+        for f in self.unique_fields:
+            values = {getattr(instance, f.attname) for _, instance, _ in rows} - {None}
+            if not values:
+                continue
+            taken = set(manager.filter(**{f'{f.name}__in': values}).values_list(f.attname, flat=True))
+            kept = []
+            for row in rows:
+                value = getattr(row[1], f.attname)
+                if value is not None and value in taken:
+                    if f.primary_key:
+                        result.error(row[0], {f.name: [f'{value} already exists']})
+                    else:
+                        result.skipped += 1
+                    continue
+                taken.add(value)
+                kept.append(row)
+            rows = kept
+        return rows
+
+    # --- writing ---
+
+    def write(self, rows, result):
+        instances = [instance for _, instance, _ in rows]
+        if self.method == 'copy':
+            self._reserve_ids(instances)
+            self._copy(instances)
+        else:
+            self.model._default_manager.using(self.using).bulk_create(instances, batch_size=self.batch_size)
+        result.created += len(instances)
+        if self.has_genres:
+            self._link_genres(rows, result)
+
+    def _reserve_ids(self, instances):
+        """Take ids for rows without one from the table's sequence, in one query"""
+        missing = [instance for instance in instances if instance.pk is None]
+        if not missing:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                [self.opts.db_table, self.opts.pk.column, len(missing)],
+            )
+            for instance, (pk,) in zip(missing, cursor.fetchall()):
+                instance.pk = pk
+
+    def _copy(self, instances):
+        fields = self.opts.concrete_fields
+        rows = ([f.get_db_prep_save(getattr(instance, f.attname), self.connection) for f in fields]
+                for instance in instances)
+        self._copy_rows(self.opts.db_table, [f.column for f in fields], rows)
+
+    def _copy_rows(self, table, columns, rows):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(_copy_text(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        quote = self.connection.ops.quote_name
+        statement = f'COPY {quote(table)} ({", ".join(quote(column) for column in columns)}) FROM STDIN'
+        with self.connection.cursor() as cursor:
+            cursor.cursor.copy_expert(statement, buffer)
+
+    def _link_genres(self, rows, result):
+        """Resolve every genre named in the batch at once, creating missing ones, then link them"""
+        links = [(instance.pk, genres) for _, instance, genres in rows if genres]
+        if not links:
+            return
+        names = {genre for _, genres in links for genre in genres if isinstance(genre, str)}
+        genres = Genre._default_manager.using(self.using)
+        by_name = dict(genres.filter(name__in=names).values_list('name', 'pk'))
+        missing = names - set(by_name)
+        if missing:
+            # ignore_conflicts leaves out rows another import created meanwhile,
+            # and bulk_create does not say which, so the table is counted
+            before = genres.count()
+            genres.bulk_create([Genre(name=name) for name in missing], ignore_conflicts=True)
+            result.genres_created += genres.count() - before
+            by_name.update(genres.filter(name__in=missing).values_list('name', 'pk'))
+
+        through = self.opts.get_field('genres').remote_field.through
+        owner = f'{self.opts.model_name}_id'
+        # Genre ids were checked in validate()
+        link_rows = {
+            (pk, by_name[genre] if isinstance(genre, str) else genre)
+            for pk, names_or_ids in links
+            for genre in names_or_ids
+        }
+        if self.method == 'copy':
+            # The rows being linked were only just written, so no link can exist yet
+            through_opts = through._meta
+            columns = [through_opts.get_field(owner).column, through_opts.get_field('genre_id').column]
+            self._copy_rows(through_opts.db_table, columns, link_rows)
+        else:
+            through._default_manager.using(self.using).bulk_create(
+                [through(**{owner: pk, 'genre_id': genre_id}) for pk, genre_id in link_rows],
+                batch_size=self.batch_size, ignore_conflicts=True,
+            )
+        result.genre_links += len(link_rows)
+
+    def _reset_sequences(self):
+        """Move the id sequence past explicit ids that were imported"""
+        statements = self.connection.ops.sequence_reset_sql(no_style(), [self.model])
+        if statements:
+            with self.connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+
+
+def _copy_text(value):
+    """A value in COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def import_catalog(model_name, stream, import_format='ndjson', batch_size=None, method=None):
+    """Import the records of a text stream into model_name's table; returns an ImportResult"""
+    model = IMPORT_MODELS.get(model_name.lower())
+    if model is None:
+        raise ValueError(f'Unknown model: {model_name} (one of {", ".join(IMPORT_MODELS)})')
+    if import_format not in IMPORT_FORMATS:
+        raise ValueError(f'Unsupported import format: {import_format}')
+    importer = CatalogImporter(model, batch_size=batch_size, method=method)
+    return importer.run(read_records(stream, import_format))
@@ -0,0 +1,93 @@
+import datetime
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections
+
+from quering.partitions import maintain
+from quering.synthetic import BASE_ROWS, END, START, TABLES, drop_constraints, load, table_sizes, total_rows
+
+
+def _rows(value):
+    name, _, rows = value.partition('=')
+    try:
+        return name, int(rows)
+    except ValueError:
+        raise CommandError(f'--rows takes table=count, not {value}')
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the querydb schema with referentially consistent synthetic data, generated in '
+        'columnar chunks and loaded with COPY by parallel workers. Scale 1 is about 10M rows; '
+        f'analytics grows by {BASE_ROWS["analytics"]:,} rows per unit of scale.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0, help='Multiplier of the base row counts')
+        parser.add_argument('--rows', type=_rows, action='append', default=[], metavar='TABLE=COUNT',
+                            help=f'Row count of one of {", ".join(BASE_ROWS)}, overriding the scale')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Parallel COPY workers')
+        parser.add_argument('--chunk-rows', type=int, default=250_000, help='Rows generated and copied per chunk')
+        parser.add_argument('--seed', type=int, default=0, help='The same seed and sizes give the same data')
+        parser.add_argument('--database', default='querydb', help='Database alias to load')
+        parser.add_argument('--truncate', action='store_true', help='Empty the tables first')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = table_sizes(options['scale'], dict(options['rows']))
+        except ValueError as e:
+            raise CommandError(str(e))
+        connection = connections[options['database']]
+        if connection.vendor != 'postgresql':
+            raise CommandError('Synthetic data is loaded with COPY and needs PostgreSQL')
+
+        tables = [spec.model._meta.db_table for spec in TABLES]
+        quoted = ', '.join(connection.ops.quote_name(table) for table in tables)
+        total = total_rows(sizes)
+        started = time.perf_counter()
+        loaded = {'rows': 0}
+
+        def report(table, rows):
+            loaded['rows'] += rows
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'{table:<18} +{rows:>9,}   {loaded["rows"] / total:6.1%}   '
+                              f'{loaded["rows"] / elapsed:>12,.0f} rows/s')
+
+        with connection.cursor() as cursor:
+            if options['truncate']:
+                cursor.execute(f'TRUNCATE {quoted} RESTART IDENTITY CASCADE')
+            else:
+                # Ids are explicit, so existing rows would collide with them
+                for table in tables:
+                    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {connection.ops.quote_name(table)})')
+                    if cursor.fetchone()[0]:
+                        raise CommandError(f'{table} is not empty; use --truncate to replace its rows')
+        # Rows are copied straight into the monthly partitions of the generated period
+        maintain(months_ahead=0, start=datetime.datetime.fromtimestamp(START, datetime.timezone.utc),
+                 now=datetime.datetime.fromtimestamp(END - 1, datetime.timezone.utc), using=options['database'])
+        with connection.cursor() as cursor:
+            recreate = drop_constraints(cursor, tables)
+        # Workers are forked processes, which must not inherit an open connection
+        connection.close()
+
+        self.stdout.write(f'Loading {total:,} rows with {options["workers"]} workers')
+        try:
+            load(connection.get_connection_params(), sizes, workers=options['workers'],
+                 chunk_rows=options['chunk_rows'], seed=options['seed'], report=report)
+        finally:
+            self.stdout.write(f'Recreating {len(recreate)} indexes and constraints')
+            with connection.cursor() as cursor:
+                for statement in recreate:
+                    cursor.execute(statement)
+
+        with connection.cursor() as cursor:
+            # Later inserts continue after the generated ids
+            for statement in connection.ops.sequence_reset_sql(no_style(), [spec.model for spec in TABLES]):
+                cursor.execute(statement)
+            cursor.execute(f'ANALYZE {quoted}')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {total:,} rows in {elapsed:.1f} s ({total / elapsed:,.0f} rows/s)'))
@@ -0,0 +1,49 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from quering.bulk_import import IMPORT_FORMATS, IMPORT_MODELS, import_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk import NDJSON or CSV records into a catalog table (movies, shows, seasons, '
+        'episodes, genres, actors, cast), validated and written in batches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=list(IMPORT_MODELS), help='Catalog model the records are for')
+        parser.add_argument('path', help='File to import, or - for standard input')
+        parser.add_argument('--format', choices=IMPORT_FORMATS,
+                            help='Record format (default: csv for .csv files, otherwise ndjson)')
+        parser.add_argument('--batch-size', type=int, help='Records validated and written together')
+        parser.add_argument('--method', choices=('copy', 'bulk_create'),
+                            help='How rows are written (default: COPY on PostgreSQL, bulk_create elsewhere)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        import_format = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        try:
+            if path == '-':
+                result = self._import(sys.stdin, import_format, options)
+            else:
+                with open(path, newline='', encoding='utf-8') as f:
+                    result = self._import(f, import_format, options)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for error in result.errors:
+            self.stderr.write(f'line {error["line"]}: {error["errors"]}')
+        if result.failed > len(result.errors):
+            self.stderr.write(f'... and {result.failed - len(result.errors)} more')
+        summary = (f'{result.model}: {result.created} created, {result.skipped} skipped, '
+                   f'{result.failed} failed of {result.received}')
+        if result.genre_links:
+            summary += f'; {result.genre_links} genre links ({result.genres_created} new genres)'
+        if result.failed:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def _import(self, stream, import_format, options):
+        return import_catalog(options['model'], stream, import_format,
+                              batch_size=options['batch_size'], method=options['method'])
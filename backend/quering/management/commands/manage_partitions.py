@@ -0,0 +1,50 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from quering.partitions import maintain
+
+
+def _month(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        raise CommandError(f'Months are given as YYYY-MM, not {value}')
+
+
+class Command(BaseCommand):
+    help = (
+        'Create the monthly partitions of quering_analytics and quering_watchhistory ahead of time '
+        'and drop those past the retention period. Run it from cron, e.g. daily. After migrating, '
+        'run it once with --backfill: rows of a month are written to the default partition until '
+        'that month has a partition, and each partition created scans what is left there.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int,
+                            help='Months to create after the current one (default: QUERING_PARTITIONS)')
+        parser.add_argument('--retention-months', type=int,
+                            help='Drop partitions entirely older than this many months (default: QUERING_PARTITIONS)')
+        parser.add_argument('--from', dest='start', type=_month, metavar='YYYY-MM',
+                            help='Also create partitions from this month on')
+        parser.add_argument('--backfill', action='store_true',
+                            help='Also create partitions back to the oldest row of the default partition, moving rows into them')
+        parser.add_argument('--dry-run', action='store_true', help='Only list what would be created and dropped')
+
+    def handle(self, *args, **options):
+        def report(action, table, name, rows):
+            line = f'{"Would " + action if options["dry_run"] else action.capitalize() + "d"} {name}'
+            if rows:
+                line += f' ({rows:,} rows moved from {table}_default)'
+            self.stdout.write(line)
+
+        actions = maintain(
+            months_ahead=options['months_ahead'],
+            retention_months=options['retention_months'],
+            start=options['start'],
+            backfill=options['backfill'],
+            dry_run=options['dry_run'],
+            report=report,
+        )
+        if not actions:
+            self.stdout.write('Partitions are up to date')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from quering.rollups import ROLLUPS, refresh_all
+
+
+class Command(BaseCommand):
+    help = (
+        'Fold the analytics, payment and watch history rows added since the last refresh into '
+        'the rollup tables. Run it from cron, e.g. every few minutes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('rollups', nargs='*', metavar='rollup', help=f'Rollups to refresh (default: all of {", ".join(ROLLUPS)})')
+        parser.add_argument('--rebuild', action='store_true', help='Recompute every period from scratch')
+
+    def handle(self, *args, **options):
+        def report(result):
+            periods = 'all periods' if result.periods is None else f'{result.periods} period(s)'
+            self.stdout.write(f'{result.name:<20} {periods}, {result.rows:,} rows, up to id {result.last_id} '
+                              f'in {result.seconds:.2f} s')
+
+        try:
+            refresh_all(options['rollups'], rebuild=options['rebuild'], report=report)
+        except ValueError as e:
+            raise CommandError(str(e))
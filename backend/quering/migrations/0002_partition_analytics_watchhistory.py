@@ -0,0 +1,112 @@
+# Range-partitions quering_analytics and quering_watchhistory by month.
+#
+# The existing table becomes the DEFAULT partition of a new partitioned table
+# of the same name, so no rows are copied; the manage_partitions command then
+# creates the monthly partitions and moves rows out of the default one (run it
+# once with --backfill after migrating, to move all the history). The
+# primary key becomes (id, <timestamp>), as PostgreSQL requires the partition
+# key in it; ids still come from the same, continued identity sequence.
+# Foreign keys and indexes keep their names. Django's model state is
+# unchanged. Reversing copies every partition's rows back into a plain table
+# with the original primary key (id) and the same sequence.
+
+from django.db import migrations
+
+PARTITIONED = (
+    ('quering_analytics', 'event_timestamp'),
+    ('quering_watchhistory', 'watched_on'),
+)
+
+
+def _definitions(cursor, table):
+    """The foreign keys and (non-constraint) indexes of table, as statements recreating them"""
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f' ORDER BY conname",
+        [table],
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(
+        "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+        "WHERE indrelid = %s::regclass "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid) ORDER BY 1",
+        [table],
+    )
+    indexes = cursor.fetchall()
+    for name, _ in foreign_keys:
+        cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+    for name, _ in indexes:
+        cursor.execute(f'DROP INDEX {name}')
+    return [definition for _, definition in indexes] + [
+        f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}' for name, definition in foreign_keys
+    ]
+
+
+def _last_id(cursor, table):
+    cursor.execute(f"SELECT last_value, is_called FROM {_sequence(cursor, table)}")
+    return cursor.fetchone()
+
+
+def _sequence(cursor, table):
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+    return cursor.fetchone()[0]
+
+
+def _swap(cursor, table, old, create):
+    """Rename table to old, run create for the new table and carry the id sequence over"""
+    recreate = _definitions(cursor, table)
+    last_value, is_called = _last_id(cursor, table)
+    cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {table}_pkey')
+    cursor.execute(f'ALTER TABLE {table} ALTER COLUMN id DROP IDENTITY')
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {old}')
+    create()
+    cursor.execute(f'ALTER TABLE {table} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY')
+    cursor.execute('SELECT setval(%s, %s, %s)', [_sequence(cursor, table), last_value, is_called])
+    return recreate
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in PARTITIONED:
+            default = f'{table}_default'
+
+            def create():
+                cursor.execute(f'CREATE TABLE {table} (LIKE {default} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})')
+                cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, {column})')
+
+            recreate = _swap(cursor, table, default, create)
+            cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT')
+            # Created on the parent, indexes and foreign keys cascade to every partition
+            for statement in recreate:
+                cursor.execute(statement)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table, _ in PARTITIONED:
+            partitioned = f'{table}_partitioned'
+
+            def create():
+                cursor.execute(f'CREATE TABLE {table} (LIKE {partitioned} INCLUDING DEFAULTS)')
+                cursor.execute(f'INSERT INTO {table} SELECT * FROM {partitioned}')
+                cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id)')
+
+            recreate = _swap(cursor, table, partitioned, create)
+            cursor.execute(f'DROP TABLE {partitioned}')
+            for statement in recreate:
+                cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quering', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:35
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quering', '0002_partition_analytics_watchhistory'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analytics',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['event_timestamp'], name='analytics_timestamp_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='analytics',
+            index=models.Index(fields=['user', 'event_timestamp'], name='analytics_user_timestamp'),
+        ),
+        migrations.AddIndex(
+            model_name='analytics',
+            index=models.Index(fields=['event_type', 'event_timestamp'], name='analytics_type_timestamp'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['payment_date'], name='payment_date_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'payment_date'], name='payment_status_date'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', 'payment_date'], name='payment_user_date'),
+        ),
+        migrations.AddIndex(
+            model_name='watchhistory',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['watched_on'], name='watchhistory_watched_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='watchhistory',
+            index=models.Index(fields=['user', 'watched_on'], name='watchhistory_user_watched'),
+        ),
+    ]
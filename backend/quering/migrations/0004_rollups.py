@@ -0,0 +1,77 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quering', '0003_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('last_id', models.BigIntegerField(db_comment='Highest source id folded into the rollup', null=True)),
+                ('refreshed_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'quering_rollup_state',
+            },
+        ),
+        migrations.CreateModel(
+            name='AnalyticsDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_comment='UTC day of the events')),
+                ('event_type', models.CharField(choices=[('Play', 'Play'), ('Pause', 'Pause'), ('Stop', 'Stop'), ('Skip', 'Skip'), ('Rewind', 'Rewind')], max_length=100)),
+                ('events', models.BigIntegerField(db_comment='Number of events')),
+                ('users', models.BigIntegerField(db_comment='Distinct users with an event of this type that day')),
+                ('movie_events', models.BigIntegerField(db_comment='Events on movies')),
+                ('episode_events', models.BigIntegerField(db_comment='Events on episodes')),
+            ],
+            options={
+                'db_table': 'quering_analytics_daily',
+                'db_table_comment': 'Rollup of quering_analytics: events per day and event type',
+                'constraints': [models.UniqueConstraint(fields=('day', 'event_type'), name='analytics_daily_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MovieWatchDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_comment='UTC day of the views')),
+                ('views', models.BigIntegerField(db_comment='Watch history entries')),
+                ('completions', models.BigIntegerField(db_comment='Views watched to completion; completion rate is completions / views')),
+                ('viewers', models.BigIntegerField(db_comment='Distinct users who watched the movie that day')),
+                ('movie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='quering.movie')),
+            ],
+            options={
+                'db_table': 'quering_movie_watch_daily',
+                'db_table_comment': 'Rollup of quering_watchhistory: movie views and completions per day and movie',
+                'indexes': [models.Index(fields=['movie', 'day'], name='movie_watch_daily_movie')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'movie'), name='movie_watch_daily_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentMonthly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(db_comment='First day of the UTC month of the payments')),
+                ('status', models.CharField(max_length=20)),
+                ('payments', models.BigIntegerField(db_comment='Number of payments')),
+                ('revenue', models.DecimalField(db_comment='Sum of the payment amounts', decimal_places=2, max_digits=14)),
+                ('payers', models.BigIntegerField(db_comment='Distinct paying users')),
+                ('plan', models.ForeignKey(blank=True, db_comment="Plan of the payer's subscription at the time of payment", null=True, on_delete=django.db.models.deletion.SET_NULL, to='quering.subscriptionplan')),
+            ],
+            options={
+                'db_table': 'quering_payment_monthly',
+                'db_table_comment': 'Rollup of quering_payment: payments and revenue per month, plan and status',
+                'indexes': [models.Index(fields=['month', 'plan', 'status'], name='payment_monthly_key')],
+            },
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.contrib.postgres.indexes import BrinIndex
 from django.db import models
 from django.utils import timezone
 
@@ -165,6 +166,13 @@ class WatchHistory(models.Model):
     def __str__(self):
         return f"{self.user.username} watched {self.movie or self.episode}"
 
+    class Meta:
+        # Partitioned by month on watched_on (migration 0002)
+        indexes = [
+            BrinIndex(fields=['watched_on'], name='watchhistory_watched_brin'),
+            models.Index(fields=['user', 'watched_on'], name='watchhistory_user_watched'),
+        ]
+
 
 # User Ratings
 class UserRating(models.Model):
@@ -198,6 +206,13 @@ class Payment(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.amount}"
 
+    class Meta:
+        indexes = [
+            BrinIndex(fields=['payment_date'], name='payment_date_brin'),
+            models.Index(fields=['status', 'payment_date'], name='payment_status_date'),
+            models.Index(fields=['user', 'payment_date'], name='payment_user_date'),
+        ]
+
 
 # Recommendations Model
 class Recommendation(models.Model):
@@ -228,3 +243,85 @@ class Analytics(models.Model):
 
     def __str__(self):
         return f"{self.user.username} {self.event_type}"
+
+    class Meta:
+        # Partitioned by month on event_timestamp (migration 0002)
+        indexes = [
+            BrinIndex(fields=['event_timestamp'], name='analytics_timestamp_brin'),
+            models.Index(fields=['user', 'event_timestamp'], name='analytics_user_timestamp'),
+            models.Index(fields=['event_type', 'event_timestamp'], name='analytics_type_timestamp'),
+        ]
+
+
+# Rollups: pre-aggregated copies of the largest tables, refreshed
+# incrementally by the refresh_rollups command (see quering/rollups.py)
+class AnalyticsDaily(models.Model):
+    day = models.DateField(db_comment="UTC day of the events")
+    event_type = models.CharField(max_length=100, choices=Analytics.EVENT_TYPES)
+    events = models.BigIntegerField(db_comment="Number of events")
+    users = models.BigIntegerField(db_comment="Distinct users with an event of this type that day")
+    movie_events = models.BigIntegerField(db_comment="Events on movies")
+    episode_events = models.BigIntegerField(db_comment="Events on episodes")
+
+    def __str__(self):
+        return f"{self.day} {self.event_type}: {self.events}"
+
+    class Meta:
+        db_table = 'quering_analytics_daily'
+        db_table_comment = "Rollup of quering_analytics: events per day and event type"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'event_type'], name='analytics_daily_unique'),
+        ]
+
+
+class PaymentMonthly(models.Model):
+    month = models.DateField(db_comment="First day of the UTC month of the payments")
+    plan = models.ForeignKey(SubscriptionPlan, on_delete=models.SET_NULL, null=True, blank=True,
+                             db_comment="Plan of the payer's subscription at the time of payment")
+    status = models.CharField(max_length=20)
+    payments = models.BigIntegerField(db_comment="Number of payments")
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, db_comment="Sum of the payment amounts")
+    payers = models.BigIntegerField(db_comment="Distinct paying users")
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.plan_id} {self.status}: {self.revenue}"
+
+    class Meta:
+        db_table = 'quering_payment_monthly'
+        db_table_comment = "Rollup of quering_payment: payments and revenue per month, plan and status"
+        indexes = [
+            models.Index(fields=['month', 'plan', 'status'], name='payment_monthly_key'),
+        ]
+
+
+class MovieWatchDaily(models.Model):
+    day = models.DateField(db_comment="UTC day of the views")
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE)
+    views = models.BigIntegerField(db_comment="Watch history entries")
+    completions = models.BigIntegerField(db_comment="Views watched to completion; completion rate is completions / views")
+    viewers = models.BigIntegerField(db_comment="Distinct users who watched the movie that day")
+
+    def __str__(self):
+        return f"{self.day} {self.movie_id}: {self.completions}/{self.views}"
+
+    class Meta:
+        db_table = 'quering_movie_watch_daily'
+        db_table_comment = "Rollup of quering_watchhistory: movie views and completions per day and movie"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'movie'], name='movie_watch_daily_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['movie', 'day'], name='movie_watch_daily_movie'),
+        ]
+
+
+class RollupState(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.BigIntegerField(null=True, db_comment="Highest source id folded into the rollup")
+    refreshed_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.name} up to {self.last_id}"
+
+    class Meta:
+        db_table = 'quering_rollup_state'
@@ -0,0 +1,200 @@
+"""
+Monthly partitions of the tables range-partitioned by migration 0002.
+
+Each table has one partition per calendar month, named
+``<table>_pYYYY_MM``, and a DEFAULT partition catching rows outside them.
+Creating a month's partition moves that month's rows out of the default
+partition in the same transaction, so partitions can be added for months
+that already hold data. Retention detaches and drops whole months, which
+is instant where a DELETE would rewrite the table.
+
+ATTACH PARTITION would scan the whole default partition, under an ACCESS
+EXCLUSIVE lock, to check that it holds none of the new month's rows; after
+migration 0002 the default partition holds all history. A CHECK
+constraint excluding the month is therefore added to the default
+partition first (NOT VALID, which is instant) and validated under a lock
+that lets reads and writes go on, and the ATTACH relies on it instead.
+Until the partition is attached, writes of rows in that month fail the
+constraint, so months are best created ahead of time; a one-time
+``--backfill`` moves the history out of the default partition.
+
+Month boundaries are UTC.
+"""
+import datetime
+import re
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from .models import Analytics, WatchHistory
+
+# Partitioned model and the timestamp column it is partitioned on
+PARTITIONED = {
+    Analytics: 'event_timestamp',
+    WatchHistory: 'watched_on',
+}
+
+
+def _options():
+    return getattr(settings, 'QUERING_PARTITIONS', {})
+
+
+def month_start(value):
+    """The first instant (UTC) of the month value falls in"""
+    if isinstance(value, datetime.datetime):
+        value = value.astimezone(datetime.timezone.utc)
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def months(start, end):
+    """Month starts from start's month to end's month, both included"""
+    month, last = month_start(start), month_start(end)
+    while month <= last:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_name(table, month):
+    return f'{table}_p{month:%Y_%m}'
+
+
+def partitions(cursor, table):
+    """{month start: partition name} of table's monthly partitions"""
+    cursor.execute(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE pg_inherits.inhparent = %s::regclass',
+        [table],
+    )
+    pattern = re.compile(rf'^{re.escape(table)}_p(\d{{4}})_(\d{{2}})$')
+    found = {}
+    for (name,) in cursor.fetchall():
+        match = pattern.match(name)
+        if match:
+            found[datetime.datetime(int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc)] = name
+    return found
+
+
+def exclusion_name(table, month):
+    return f'{table}_default_{month:%Y_%m}_excluded'
+
+
+def exclude_month(cursor, table, column, month):
+    """
+    Keep month's rows out of table's default partition from now on, without
+    checking those already there. Commit it before create_partition.
+    """
+    cursor.execute(
+        f'ALTER TABLE {table}_default ADD CONSTRAINT {exclusion_name(table, month)} '
+        f'CHECK (NOT ({column} >= %s AND {column} < %s)) NOT VALID',
+        [month, add_months(month, 1)],
+    )
+
+
+def include_month(cursor, table, month):
+    """Undo exclude_month, when creating the partition failed"""
+    cursor.execute(f'ALTER TABLE {table}_default DROP CONSTRAINT IF EXISTS {exclusion_name(table, month)}')
+
+
+def create_partition(cursor, table, column, month):
+    """
+    Create table's partition for month, moving the month's rows out of the
+    default partition. Run it inside a transaction, after exclude_month.
+    """
+    name = partition_name(table, month)
+    bounds = [month, add_months(month, 1)]
+    cursor.execute(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM {table}_default WHERE {column} >= %s AND {column} < %s RETURNING *) '
+        f'INSERT INTO {name} SELECT * FROM moved',
+        bounds,
+    )
+    moved = cursor.rowcount
+    # Validating scans the default partition but only takes a SHARE UPDATE
+    # EXCLUSIVE lock; the two CHECKs then let ATTACH PARTITION skip its scans
+    # of the default and the new partition
+    cursor.execute(f'ALTER TABLE {table}_default VALIDATE CONSTRAINT {exclusion_name(table, month)}')
+    cursor.execute(f'ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK ({column} >= %s AND {column} < %s)', bounds)
+    cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', bounds)
+    cursor.execute(f'ALTER TABLE {name} DROP CONSTRAINT {name}_bounds')
+    include_month(cursor, table, month)
+    return moved
+
+
+def drop_partition(cursor, table, name):
+    cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+    cursor.execute(f'DROP TABLE {name}')
+
+
+def oldest_default_row(cursor, table, column):
+    """Timestamp of the oldest row in table's default partition, or None"""
+    cursor.execute(f'SELECT min({column}) FROM {table}_default')
+    return cursor.fetchone()[0]
+
+
+def maintain(months_ahead=None, retention_months=None, start=None, backfill=False, now=None, dry_run=False,
+             using=None, report=None):
+    """
+    Create the monthly partitions of every partitioned table up to
+    months_ahead months after now's month, from start's month, the oldest
+    row in the default partition (backfill) or now's month, and drop those
+    entirely older than retention_months months (None keeps them all).
+    Each partition is created or dropped in a transaction of its own;
+    report(action, table, name, rows) is called for each. using overrides
+    the database the models are routed to.
+    """
+    options = _options()
+    if months_ahead is None:
+        months_ahead = options.get('MONTHS_AHEAD', 3)
+    if retention_months is None:
+        retention_months = options.get('RETENTION_MONTHS')
+    now = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    cutoff = add_months(now, -retention_months) if retention_months is not None else None
+    actions = []
+
+    for model, column in PARTITIONED.items():
+        table = model._meta.db_table
+        connection = connections[using or router.db_for_write(model)]
+        with connection.cursor() as cursor:
+            existing = partitions(cursor, table)
+            first = month_start(start) if start is not None else now
+            if backfill:
+                oldest = oldest_default_row(cursor, table, column)
+                if oldest is not None:
+                    first = min(first, month_start(oldest))
+            if cutoff is not None:
+                first = max(first, cutoff)
+
+            for month in months(first, add_months(now, months_ahead)):
+                if month in existing:
+                    continue
+                rows = 0
+                if not dry_run:
+                    with transaction.atomic(using=connection.alias):
+                        exclude_month(cursor, table, column, month)
+                    try:
+                        with transaction.atomic(using=connection.alias):
+                            rows = create_partition(cursor, table, column, month)
+                    except Exception:
+                        with transaction.atomic(using=connection.alias):
+                            include_month(cursor, table, month)
+                        raise
+                actions.append(('create', table, partition_name(table, month), rows))
+                if report is not None:
+                    report(*actions[-1])
+
+            for month, name in sorted(existing.items()):
+                if cutoff is None or add_months(month, 1) > cutoff:
+                    continue
+                if not dry_run:
+                    with transaction.atomic(using=connection.alias):
+                        drop_partition(cursor, table, name)
+                actions.append(('drop', table, name, None))
+                if report is not None:
+                    report(*actions[-1])
+    return actions
@@ -0,0 +1,184 @@
+"""
+Rollup tables: daily and monthly aggregates of analytics, payments and
+watch history that analytics questions can read instead of re-aggregating
+the source tables.
+
+A rollup is refreshed from a high-water mark: the highest source id it has
+seen, kept in quering_rollup_state. A refresh finds the periods (days or
+months) of the rows added since then and recomputes those periods whole,
+with a DELETE and an INSERT ... SELECT over the period's time range (one
+pair per run of consecutive periods), so partition pruning and the time
+indexes keep the work proportional to what changed. Periods are always
+recomputed whole, which keeps distinct counts exact and a refresh
+idempotent.
+
+Rows committed late with ids below the mark (a long transaction) or
+updated in place are picked up when their period is next recomputed: the
+last SETTLE_DAYS days are recomputed on every refresh. Older changes need
+a rebuild.
+"""
+import datetime
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import AnalyticsDaily, MovieWatchDaily, PaymentMonthly, RollupState
+
+# sql selects the rollup's columns, in order, from the source aliased src
+# and filtered by {where}; the first column is the period
+Rollup = namedtuple('Rollup', ['name', 'model', 'source', 'time_column', 'grain', 'columns', 'sql'])
+
+
+def _period(grain, column):
+    if grain == 'month':
+        return f"date_trunc('month', src.{column} AT TIME ZONE 'UTC')::date"
+    return f"(src.{column} AT TIME ZONE 'UTC')::date"
+
+
+ROLLUPS = {
+    rollup.name: rollup for rollup in (
+        Rollup(
+            'analytics_daily', AnalyticsDaily, 'quering_analytics', 'event_timestamp', 'day',
+            ('day', 'event_type', 'events', 'users', 'movie_events', 'episode_events'),
+            f"""
+            SELECT {_period('day', 'event_timestamp')}, src.event_type, count(*), count(DISTINCT src.user_id),
+                   count(src.movie_id), count(src.episode_id)
+            FROM quering_analytics src
+            WHERE {{where}}
+            GROUP BY 1, 2
+            """,
+        ),
+        Rollup(
+            'payment_monthly', PaymentMonthly, 'quering_payment', 'payment_date', 'month',
+            ('month', 'plan_id', 'status', 'payments', 'revenue', 'payers'),
+            # The plan is that of the payer's latest subscription started by the payment date
+            f"""
+            SELECT {_period('month', 'payment_date')}, subscription.plan_id, src.status, count(*),
+                   sum(src.amount), count(DISTINCT src.user_id)
+            FROM quering_payment src
+            LEFT JOIN LATERAL (
+                SELECT s.plan_id FROM quering_usersubscription s
+                WHERE s.user_id = src.user_id AND s.start_date <= (src.payment_date AT TIME ZONE 'UTC')::date
+                ORDER BY s.start_date DESC
+                LIMIT 1
+            ) subscription ON true
+            WHERE {{where}}
+            GROUP BY 1, 2, 3
+            """,
+        ),
+        Rollup(
+            'movie_watch_daily', MovieWatchDaily, 'quering_watchhistory', 'watched_on', 'day',
+            ('day', 'movie_id', 'views', 'completions', 'viewers'),
+            f"""
+            SELECT {_period('day', 'watched_on')}, src.movie_id, count(*), count(*) FILTER (WHERE src.completed),
+                   count(DISTINCT src.user_id)
+            FROM quering_watchhistory src
+            WHERE src.movie_id IS NOT NULL AND {{where}}
+            GROUP BY 1, 2
+            """,
+        ),
+    )
+}
+
+RefreshResult = namedtuple('RefreshResult', ['name', 'periods', 'rows', 'last_id', 'seconds'])
+
+
+def _options():
+    return getattr(settings, 'QUERING_ROLLUPS', {})
+
+
+def next_period(period, grain):
+    if grain == 'month':
+        return (period.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return period + datetime.timedelta(days=1)
+
+
+def period_of(value, grain):
+    day = value.astimezone(datetime.timezone.utc).date() if isinstance(value, datetime.datetime) else value
+    return day.replace(day=1) if grain == 'month' else day
+
+
+def runs(periods, grain):
+    """Consecutive periods merged into [start, end) ranges"""
+    ranges = []
+    for period in sorted(periods):
+        if ranges and ranges[-1][1] == period:
+            ranges[-1][1] = next_period(period, grain)
+        else:
+            ranges.append([period, next_period(period, grain)])
+    return [tuple(r) for r in ranges]
+
+
+def _midnight(day):
+    return datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc)
+
+
+def _recompute(cursor, rollup, start=None, end=None):
+    """Replace the rollup's rows for [start, end) (everything when start is None); returns rows written"""
+    table = rollup.model._meta.db_table
+    period_column = rollup.columns[0]
+    columns = ', '.join(rollup.columns)
+    if start is None:
+        cursor.execute(f'DELETE FROM {table}')
+        cursor.execute(f'INSERT INTO {table} ({columns}) {rollup.sql.format(where="true")}')
+        return cursor.rowcount
+    cursor.execute(f'DELETE FROM {table} WHERE {period_column} >= %s AND {period_column} < %s', [start, end])
+    where = f'src.{rollup.time_column} >= %s AND src.{rollup.time_column} < %s'
+    cursor.execute(f'INSERT INTO {table} ({columns}) {rollup.sql.format(where=where)}',
+                   [_midnight(start), _midnight(end)])
+    return cursor.rowcount
+
+
+def refresh(rollup, rebuild=False, now=None):
+    """
+    Bring rollup up to date with its source, in one transaction. Concurrent
+    refreshes of the same rollup wait for each other.
+    """
+    started = time.perf_counter()
+    using = router.db_for_write(rollup.model)
+    now = now or timezone.now()
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        RollupState.objects.using(using).get_or_create(name=rollup.name)
+        state = RollupState.objects.using(using).select_for_update().get(name=rollup.name)
+        cursor.execute(f'SELECT max(id) FROM {rollup.source}')
+        last_id = cursor.fetchone()[0]
+
+        if rebuild or state.last_id is None:
+            ranges = [(None, None)]
+            periods = None
+        else:
+            periods = set()
+            if last_id is not None and last_id > state.last_id:
+                period = _period(rollup.grain, rollup.time_column)
+                cursor.execute(f'SELECT DISTINCT {period} FROM {rollup.source} src WHERE src.id > %s AND src.id <= %s',
+                               [state.last_id, last_id])
+                periods.update(row[0] for row in cursor.fetchall())
+            settle = now - datetime.timedelta(days=_options().get('SETTLE_DAYS', 2))
+            period = period_of(settle, rollup.grain)
+            while period <= period_of(now, rollup.grain):
+                periods.add(period)
+                period = next_period(period, rollup.grain)
+            ranges = runs(periods, rollup.grain)
+
+        rows = sum(_recompute(cursor, rollup, start, end) for start, end in ranges)
+        state.last_id = last_id
+        state.refreshed_at = now
+        state.save(using=using)
+    return RefreshResult(rollup.name, None if periods is None else len(periods), rows, last_id,
+                         time.perf_counter() - started)
+
+
+def refresh_all(names=None, rebuild=False, report=None):
+    """Refresh the rollups named (all by default); report(result) is called after each"""
+    results = []
+    for name in names or ROLLUPS:
+        if name not in ROLLUPS:
+            raise ValueError(f'Unknown rollup: {name} (one of {", ".join(ROLLUPS)})')
+        result = refresh(ROLLUPS[name], rebuild=rebuild)
+        results.append(result)
+        if report is not None:
+            report(result)
+    return results
@@ -0,0 +1,546 @@
+"""
+Synthetic data for the querydb schema, for load-testing NL-to-SQL and the
+query endpoints at production scale.
+
+Every table is generated in chunks of columns (numpy arrays turned into an
+Arrow table) and loaded with ``COPY ... FROM STDIN (FORMAT csv)``. Chunks
+run in parallel worker processes, each with its own connection; tables are
+loaded level by level so a chunk's foreign keys always point at rows that
+are already committed.
+
+While loading, the tables' foreign keys, unique constraints and secondary
+indexes are dropped and then recreated in one pass each, as pg_restore
+does: checking and indexing row by row is most of the cost of a COPY.
+
+Rows are referentially consistent without lookups because ids are explicit
+and derived: user n joined at a time that only depends on n, season s
+belongs to show (s - 1) // SEASONS_PER_SHOW + 1, and so on. Activity is
+skewed the way real catalogs are: a few users and titles account for most
+events, and recent events outnumber old ones. The same seed and scale give
+the same data.
+"""
+import io
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+
+from .models import (
+    Actor,
+    Analytics,
+    Episode,
+    Genre,
+    Movie,
+    MovieCast,
+    Payment,
+    Recommendation,
+    Season,
+    ShowCast,
+    SubscriptionPlan,
+    TVShow,
+    User,
+    UserRating,
+    UserSubscription,
+    WatchHistory,
+)
+
+# Rows at scale 1, multiplied by the scale; the other tables follow from these
+BASE_ROWS = {
+    'user': 100_000,
+    'movie': 10_000,
+    'tvshow': 2_000,
+    'actor': 50_000,
+    'watchhistory': 2_000_000,
+    'userrating': 500_000,
+    'payment': 1_000_000,
+    'recommendation': 1_000_000,
+    'analytics': 5_000_000,
+}
+
+SEASONS_PER_SHOW = 4
+EPISODES_PER_SEASON = 10
+CAST_PER_MOVIE = 8
+CAST_PER_SHOW = 12
+GENRES_PER_TITLE = 2
+
+GENRES = (
+    'Drama', 'Comedy', 'Action', 'Thriller', 'Documentary', 'Romance', 'Horror', 'Sci-Fi',
+    'Animation', 'Crime', 'Fantasy', 'Adventure', 'Family', 'Mystery', 'Biography',
+    'History', 'Music', 'War', 'Western', 'Sport',
+)
+
+# name, price, resolution, max_screens
+PLANS = (
+    ('Basic', 7.99, 'SD', 1),
+    ('Standard', 12.99, 'HD', 2),
+    ('Premium', 17.99, '4K', 4),
+    ('Family', 22.99, '4K', 6),
+)
+PLAN_WEIGHTS = (0.35, 0.4, 0.2, 0.05)
+
+# Weights of categorical values, in the order of the model's choices where it has them
+LANGUAGES = (('English', 0.6), ('Spanish', 0.1), ('French', 0.06), ('Korean', 0.06), ('Japanese', 0.05),
+             ('Hindi', 0.05), ('German', 0.04), ('Italian', 0.04))
+AGE_RESTRICTION_WEIGHTS = (0.15, 0.25, 0.35, 0.2, 0.05)
+EVENT_WEIGHTS = (0.45, 0.25, 0.15, 0.1, 0.05)
+PAYMENT_METHOD_WEIGHTS = (0.55, 0.25, 0.1, 0.1)
+PAYMENT_STATUS_WEIGHTS = (0.03, 0.94, 0.03)
+
+_WORDS = (
+    'Silent', 'Last', 'Dark', 'Golden', 'Broken', 'Hidden', 'Lost', 'Crimson', 'Endless', 'Wild',
+    'River', 'City', 'Night', 'Empire', 'Garden', 'Storm', 'Shadow', 'Kingdom', 'Road', 'Signal',
+    'Winter', 'Summer', 'Ocean', 'Fire', 'Glass', 'Echo', 'Star', 'Harbor', 'Machine', 'Dream',
+)
+_FIRST_NAMES = ('Ana', 'Ben', 'Chen', 'Dara', 'Eli', 'Fatima', 'Gus', 'Hana', 'Ivan', 'Jo', 'Kai', 'Lena',
+                'Mateo', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Tariq', 'Uma', 'Vera', 'Wei', 'Yuki')
+_LAST_NAMES = ('Smith', 'Garcia', 'Kim', 'Nguyen', 'Rossi', 'Müller', 'Silva', 'Khan', 'Cohen', 'Okafor',
+               'Larsen', 'Dubois', 'Tanaka', 'Novak', 'Reyes', 'Patel', 'Walsh', 'Ivanova')
+_NATIONALITIES = ('American', 'British', 'Canadian', 'French', 'Spanish', 'Korean', 'Japanese', 'Indian',
+                  'German', 'Italian', 'Brazilian', 'Nigerian', 'Australian', 'Mexican')
+
+# The dataset ends at this time (UTC seconds, 2025-01-01) and starts YEARS earlier
+END = 1735689600
+END_YEAR = 2024
+YEARS = 5
+_SPAN = YEARS * 365 * 86400
+START = END - _SPAN
+
+# Multiplier spreading skewed ranks over the whole id range, so popular rows
+# are not all low ids; a prime larger than any table is coprime with its size
+_SCRAMBLE = 2_147_483_647
+
+
+# ---------------------------------------------------------------------
+# Column helpers
+# ---------------------------------------------------------------------
+def skewed_ids(rng, n, size, skew):
+    """
+    size ids in 1..n drawn with a power-law skew: 1 is uniform, and with
+    skew k the most popular 1% of ids get about 1% ** (1 / k) of the draws
+    """
+    ranks = np.floor(n * rng.random(size) ** skew).astype(np.int64)
+    return (ranks * _SCRAMBLE) % n + 1
+
+
+def joined_at(user_ids, users):
+    """Sign-up time (UTC seconds) of each user; later ids joined later, with sign-ups speeding up"""
+    return START + (_SPAN * np.sqrt(user_ids / users)).astype(np.int64) - 2 * 86400
+
+
+def recent_after(rng, start, size, scale_days):
+    """Times between start and END, most of them within the last scale_days"""
+    age = rng.exponential(scale_days * 86400, size).astype(np.int64)
+    return END - age % np.maximum(END - start, 1)
+
+
+def _choice(rng, values, weights, size):
+    return pa.array(np.asarray(values, dtype=object)[rng.choice(len(values), size, p=weights)], pa.string())
+
+
+def _words(rng, words, size, count=2):
+    pool = pa.array(words)
+    parts = [pc.take(pool, rng.integers(0, len(words), size)) for _ in range(count)]
+    return pc.binary_join_element_wise(*parts, ' ')
+
+
+def _numbered(prefix, ids, suffix=''):
+    return pc.binary_join_element_wise(prefix, pc.cast(pa.array(ids), pa.string()), suffix, '')
+
+
+def _timestamps(seconds):
+    # Written without a zone, which is many times faster; loading sessions run in UTC
+    return pa.array(seconds, pa.timestamp('s'))
+
+
+def _dates(seconds):
+    return pa.array((seconds // 86400).astype(np.int32), pa.date32())
+
+
+def _either(rng, first_ids, second_ids, first_share):
+    """Two nullable id columns of which exactly one is set per row"""
+    first = rng.random(len(first_ids)) < first_share
+    return pa.array(first_ids, pa.int64(), mask=~first), pa.array(second_ids, pa.int64(), mask=first)
+
+
+def _rounded(values, digits):
+    return pc.round(pa.array(values, pa.float64()), digits)
+
+
+# ---------------------------------------------------------------------
+# Tables: each generator returns {attname: column} for ids start..start+count-1
+# ---------------------------------------------------------------------
+def _users(rng, ids, sizes):
+    return {
+        'username': _numbered('user', ids),
+        'email': _numbered('user', ids, '@example.com'),
+        'first_name': _choice(rng, _FIRST_NAMES, None, len(ids)),
+        'last_name': _choice(rng, _LAST_NAMES, None, len(ids)),
+        'date_joined': _timestamps(joined_at(ids, sizes['user']) + rng.integers(0, 86400, len(ids))),
+        'is_active': pa.array(rng.random(len(ids)) < 0.92),
+    }
+
+
+def _plans(rng, ids, sizes):
+    rows = [PLANS[i - 1] for i in ids]
+    return {
+        'name': pa.array([row[0] for row in rows]),
+        'price': pa.array([row[1] for row in rows]),
+        'resolution': pa.array([row[2] for row in rows]),
+        'max_screens': pa.array([row[3] for row in rows]),
+    }
+
+
+def _subscriptions(rng, ids, sizes):
+    # One subscription per user, subscription n belonging to user n
+    start = joined_at(ids, sizes['user']) + 86400
+    months = 1 + rng.geometric(0.08, len(ids))
+    end = start + months * 30 * 86400
+    cancelled = rng.random(len(ids)) < 0.15
+    status = np.where(end > END, 'Active', np.where(cancelled, 'Cancelled', 'Expired'))
+    return {
+        'user_id': pa.array(ids),
+        'plan_id': pa.array(rng.choice(len(PLANS), len(ids), p=PLAN_WEIGHTS) + 1),
+        'start_date': _dates(start),
+        'end_date': _dates(end),
+        'status': pa.array(status.astype(object), pa.string()),
+    }
+
+
+def _genres(rng, ids, sizes):
+    return {'name': pa.array([GENRES[i - 1] for i in ids])}
+
+
+def _title_columns(rng, ids):
+    size = len(ids)
+    return {
+        'title': _words(rng, _WORDS, size, 2 + (int(ids[0]) % 2)),
+        'description': _words(rng, _WORDS, size, 8),
+        'release_year': pa.array(END_YEAR + 1 - rng.geometric(0.08, size).clip(max=60)),
+        'language': _choice(rng, *zip(*LANGUAGES), size),
+        'rating': _rounded(np.clip(rng.normal(6.5, 1.4, size), 1, 10), 1),
+        'age_restriction': _choice(rng, [code for code, _ in Movie.AGE_RESTRICTIONS], AGE_RESTRICTION_WEIGHTS, size),
+        'added_at': _timestamps(START + (rng.random(size) * _SPAN).astype(np.int64)),
+    }
+
+
+def _movies(rng, ids, sizes):
+    columns = _title_columns(rng, ids)
+    columns['duration'] = pa.array(np.clip(rng.normal(105, 20, len(ids)), 60, 240).astype(np.int64))
+    return columns
+
+
+def _shows(rng, ids, sizes):
+    columns = _title_columns(rng, ids)
+    columns['total_seasons'] = pa.array(np.full(len(ids), SEASONS_PER_SHOW))
+    return columns
+
+
+def _seasons(rng, ids, sizes):
+    return {
+        'show_id': pa.array((ids - 1) // SEASONS_PER_SHOW + 1),
+        'season_number': pa.array((ids - 1) % SEASONS_PER_SHOW + 1),
+        'release_year': pa.array(END_YEAR + 1 - SEASONS_PER_SHOW + (ids - 1) % SEASONS_PER_SHOW),
+    }
+
+
+def _episodes(rng, ids, sizes):
+    season = (ids - 1) // EPISODES_PER_SEASON + 1
+    return {
+        'show_id': pa.array((season - 1) // SEASONS_PER_SHOW + 1),
+        'season_id': pa.array(season),
+        'title': _words(rng, _WORDS, len(ids), 2),
+        'episode_number': pa.array((ids - 1) % EPISODES_PER_SEASON + 1),
+        'duration': pa.array(np.clip(rng.normal(45, 12, len(ids)), 20, 90).astype(np.int64)),
+        'release_date': _dates(END - (rng.random(len(ids)) * _SPAN).astype(np.int64)),
+    }
+
+
+def _actors(rng, ids, sizes):
+    names = pc.binary_join_element_wise(
+        pc.take(pa.array(_FIRST_NAMES), rng.integers(0, len(_FIRST_NAMES), len(ids))),
+        pc.take(pa.array(_LAST_NAMES), rng.integers(0, len(_LAST_NAMES), len(ids))),
+        ' ',
+    )
+    born = END - (rng.uniform(18, 85, len(ids)) * 365.25 * 86400).astype(np.int64)
+    return {
+        'full_name': names,
+        'date_of_birth': pa.array((born // 86400).astype(np.int32), pa.date32(), mask=rng.random(len(ids)) < 0.05),
+        'nationality': _choice(rng, _NATIONALITIES, None, len(ids)),
+    }
+
+
+def _cast(owner, per_title):
+    def generate(rng, ids, sizes):
+        # A few actors appear in many titles
+        return {
+            f'{owner}_id': pa.array((ids - 1) // per_title + 1),
+            'actor_id': pa.array(skewed_ids(rng, sizes['actor'], len(ids), 2.5)),
+            'role': _choice(rng, ('Lead', 'Supporting', 'Cameo', 'Voice', 'Guest'), (0.15, 0.45, 0.15, 0.1, 0.15), len(ids)),
+        }
+
+    return generate
+
+
+def _title_genres(owner):
+    def generate(rng, ids, sizes):
+        # A title's links can fall in two chunks, so its genres depend on the title id
+        # alone: a skewed first genre, then steps of a per-title stride that keep them distinct
+        title = (ids - 1) // GENRES_PER_TITLE + 1
+        offset = (ids - 1) % GENRES_PER_TITLE
+        spread = (title * 0.6180339887) % 1
+        first = (np.floor(len(GENRES) * spread ** 2).astype(np.int64) * _SCRAMBLE) % len(GENRES) + 1
+        stride = 1 + title % (len(GENRES) - 1)
+        return {f'{owner}_id': pa.array(title), 'genre_id': pa.array((first - 1 + offset * stride) % len(GENRES) + 1)}
+
+    return generate
+
+
+def _activity_users(rng, sizes, size):
+    """Users of size events: heavy users dominate"""
+    users = skewed_ids(rng, sizes['user'], size, 2)
+    # A day after joining, past the jitter of date_joined
+    return users, joined_at(users, sizes['user']) + 86400
+
+
+def _watch_history(rng, ids, sizes):
+    size = len(ids)
+    users, joined = _activity_users(rng, sizes, size)
+    movie, episode = _either(rng, skewed_ids(rng, sizes['movie'], size, 4),
+                             skewed_ids(rng, sizes['episode'], size, 4), 0.45)
+    progress = np.where(rng.random(size) < 0.6, 100, rng.integers(1, 100, size))
+    return {
+        'user_id': pa.array(users),
+        'movie_id': movie,
+        'episode_id': episode,
+        'watched_on': _timestamps(recent_after(rng, joined, size, 240)),
+        'progress_percentage': pa.array(progress),
+        'completed': pa.array(progress >= 90),
+    }
+
+
+def _ratings(rng, ids, sizes):
+    size = len(ids)
+    users, joined = _activity_users(rng, sizes, size)
+    movie, episode = _either(rng, skewed_ids(rng, sizes['movie'], size, 4),
+                             skewed_ids(rng, sizes['episode'], size, 4), 0.6)
+    return {
+        'user_id': pa.array(users),
+        'movie_id': movie,
+        'episode_id': episode,
+        'rating': pa.array(rng.choice(5, size, p=(0.05, 0.08, 0.2, 0.37, 0.3)) + 1),
+        'review': pa.array(_words(rng, _WORDS, size, 6), mask=rng.random(size) < 0.7),
+        'created_at': _timestamps(recent_after(rng, joined, size, 365)),
+    }
+
+
+def _payments(rng, ids, sizes):
+    size = len(ids)
+    # Payments follow subscribers rather than viewing, so they are only mildly skewed
+    users = skewed_ids(rng, sizes['user'], size, 1.3)
+    plan = rng.choice(len(PLANS), size, p=PLAN_WEIGHTS)
+    return {
+        'user_id': pa.array(users),
+        'amount': pa.array(np.asarray([p[1] for p in PLANS])[plan]),
+        'payment_method': _choice(rng, [m for m, _ in Payment.PAYMENT_METHODS], PAYMENT_METHOD_WEIGHTS, size),
+        'transaction_id': _numbered('txn_', ids),
+        'status': _choice(rng, ('Pending', 'Completed', 'Failed'), PAYMENT_STATUS_WEIGHTS, size),
+        'payment_date': _timestamps(recent_after(rng, joined_at(users, sizes['user']) + 86400, size, 540)),
+    }
+
+
+def _recommendations(rng, ids, sizes):
+    size = len(ids)
+    movie, show = _either(rng, skewed_ids(rng, sizes['movie'], size, 2),
+                          skewed_ids(rng, sizes['tvshow'], size, 2), 0.7)
+    return {
+        'user_id': pa.array(skewed_ids(rng, sizes['user'], size, 1.5)),
+        'movie_id': movie,
+        'show_id': show,
+        'recommendation_score': _rounded(rng.beta(2, 5, size) * 100, 2),
+    }
+
+
+def _analytics(rng, ids, sizes):
+    size = len(ids)
+    users, joined = _activity_users(rng, sizes, size)
+    movie, episode = _either(rng, skewed_ids(rng, sizes['movie'], size, 4),
+                             skewed_ids(rng, sizes['episode'], size, 4), 0.45)
+    return {
+        'user_id': pa.array(users),
+        'event_type': _choice(rng, [e for e, _ in Analytics.EVENT_TYPES], EVENT_WEIGHTS, size),
+        'movie_id': movie,
+        'episode_id': episode,
+        'event_timestamp': _timestamps(recent_after(rng, joined, size, 180)),
+    }
+
+
+# name: the key in sizes; level: tables of a level only reference lower levels
+SyntheticTable = namedtuple('SyntheticTable', ['name', 'model', 'level', 'generate'])
+
+TABLES = (
+    SyntheticTable('user', User, 0, _users),
+    SyntheticTable('subscriptionplan', SubscriptionPlan, 0, _plans),
+    SyntheticTable('genre', Genre, 0, _genres),
+    SyntheticTable('movie', Movie, 0, _movies),
+    SyntheticTable('tvshow', TVShow, 0, _shows),
+    SyntheticTable('actor', Actor, 0, _actors),
+    SyntheticTable('usersubscription', UserSubscription, 1, _subscriptions),
+    SyntheticTable('season', Season, 1, _seasons),
+    SyntheticTable('moviecast', MovieCast, 1, _cast('movie', CAST_PER_MOVIE)),
+    SyntheticTable('showcast', ShowCast, 1, _cast('show', CAST_PER_SHOW)),
+    SyntheticTable('movie_genres', Movie.genres.through, 1, _title_genres('movie')),
+    SyntheticTable('tvshow_genres', TVShow.genres.through, 1, _title_genres('tvshow')),
+    SyntheticTable('episode', Episode, 2, _episodes),
+    SyntheticTable('watchhistory', WatchHistory, 3, _watch_history),
+    SyntheticTable('userrating', UserRating, 3, _ratings),
+    SyntheticTable('payment', Payment, 3, _payments),
+    SyntheticTable('recommendation', Recommendation, 3, _recommendations),
+    SyntheticTable('analytics', Analytics, 3, _analytics),
+)
+
+TABLES_BY_NAME = {table.name: table for table in TABLES}
+
+
+def table_sizes(scale=1.0, overrides=None):
+    """
+    Rows per table at scale. overrides (name: rows) replace counts of
+    BASE_ROWS tables; the other tables follow from those.
+    """
+    unknown = set(overrides or ()) - set(BASE_ROWS)
+    if unknown:
+        raise ValueError(f'Only the rows of {", ".join(BASE_ROWS)} can be set, not {", ".join(sorted(unknown))}')
+    sizes = {name: max(1, int(rows * scale)) for name, rows in BASE_ROWS.items()}
+    sizes.update(overrides or {})
+    sizes.update({
+        'subscriptionplan': len(PLANS),
+        'genre': len(GENRES),
+        'usersubscription': sizes['user'],
+        'season': sizes['tvshow'] * SEASONS_PER_SHOW,
+        'episode': sizes['tvshow'] * SEASONS_PER_SHOW * EPISODES_PER_SEASON,
+        'moviecast': sizes['movie'] * CAST_PER_MOVIE,
+        'showcast': sizes['tvshow'] * CAST_PER_SHOW,
+        'movie_genres': sizes['movie'] * GENRES_PER_TITLE,
+        'tvshow_genres': sizes['tvshow'] * GENRES_PER_TITLE,
+    })
+    return sizes
+
+
+# ---------------------------------------------------------------------
+# Loading
+# ---------------------------------------------------------------------
+def generate_chunk(table, start, count, sizes, seed=0):
+    """An Arrow table of rows start..start+count-1 of table, its columns in the database's order"""
+    spec = TABLES_BY_NAME[table]
+    ids = np.arange(start, start + count, dtype=np.int64)
+    rng = np.random.default_rng([seed, TABLES.index(spec), start])
+    columns = spec.generate(rng, ids, sizes)
+    fields = spec.model._meta.concrete_fields
+    arrays = [pa.array(ids) if f.primary_key else columns[f.attname] for f in fields]
+    return pa.Table.from_arrays(arrays, names=[f.column for f in fields])
+
+
+def copy_chunk(connection, table, data):
+    """COPY an Arrow table into table through a psycopg2 connection and commit"""
+    buffer = io.BytesIO()
+    pyarrow.csv.write_csv(data, buffer, pyarrow.csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    columns = ', '.join(f'"{name}"' for name in data.column_names)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY "{table}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+    connection.commit()
+
+
+def drop_constraints(cursor, tables):
+    """
+    Drop the foreign keys, unique constraints and indexes (not primary keys)
+    of tables; returns the statements that recreate them, indexes and
+    unique constraints first so foreign keys are checked against them.
+    """
+    cursor.execute(
+        """
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = ANY(%s::regclass[]) AND contype IN ('f', 'u')
+        ORDER BY contype = 'f' DESC, conrelid::regclass::text, conname
+        """,
+        [list(tables)],
+    )
+    constraints = cursor.fetchall()
+    cursor.execute(
+        """
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid = ANY(%s::regclass[])
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid AND contype IN ('p', 'u', 'x'))
+        ORDER BY 1
+        """,
+        [list(tables)],
+    )
+    indexes = cursor.fetchall()
+
+    # Foreign keys go first: a unique constraint may be what one of them refers to
+    for table, name, _ in constraints:
+        cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+    for index, _ in indexes:
+        cursor.execute(f'DROP INDEX {index}')
+    # Indexes of partitioned tables are defined ON ONLY the parent; recreated without it, they cascade
+    return [definition.replace(' ON ONLY ', ' ON ', 1) for _, definition in indexes] + [
+        f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}' for table, name, definition in reversed(constraints)
+    ]
+
+
+_worker_connection = None
+
+
+def _connect(params):
+    global _worker_connection
+    _worker_connection = psycopg2.connect(**params)
+    with _worker_connection.cursor() as cursor:
+        cursor.execute("SET TIME ZONE 'UTC'")
+    _worker_connection.commit()
+
+
+def _load(table, start, count, sizes, seed):
+    data = generate_chunk(table, start, count, sizes, seed)
+    copy_chunk(_worker_connection, TABLES_BY_NAME[table].model._meta.db_table, data)
+    return table, count
+
+
+Chunk = namedtuple('Chunk', ['table', 'start', 'count'])
+
+
+def plan_chunks(sizes, chunk_rows):
+    """Chunks of each table by level: {level: [Chunk]}"""
+    levels = {}
+    for spec in TABLES:
+        rows = sizes[spec.name]
+        for start in range(1, rows + 1, chunk_rows):
+            levels.setdefault(spec.level, []).append(Chunk(spec.name, start, min(chunk_rows, rows - start + 1)))
+    return dict(sorted(levels.items()))
+
+
+def load(params, sizes, workers=4, chunk_rows=250_000, seed=0, report=None):
+    """
+    Generate and COPY every table at sizes into the database psycopg2
+    params connect to, workers chunks at a time. report(table, rows) is
+    called as each chunk is committed.
+    """
+    levels = plan_chunks(sizes, chunk_rows)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_connect, initargs=(params,)) as executor:
+        for chunks in levels.values():
+            # Biggest chunks first so the level is not left waiting on one late large table
+            futures = [executor.submit(_load, chunk.table, chunk.start, chunk.count, sizes, seed)
+                       for chunk in sorted(chunks, key=lambda chunk: -chunk.count)]
+            for future in as_completed(futures):
+                table, rows = future.result()
+                if report is not None:
+                    report(table, rows)
+
+
+def total_rows(sizes):
+    return sum(sizes[spec.name] for spec in TABLES)
+
@@ -1,3 +1,527 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import tempfile
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+import numpy as np
+import pyarrow as pa
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.migrations.recorder import MigrationRecorder
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from quering.bulk_import import CatalogImporter, import_catalog, read_records
+from quering.models import (
+    Actor,
+    Analytics,
+    Episode,
+    Genre,
+    Movie,
+    MovieCast,
+    RollupState,
+    Season,
+    ShowCast,
+    TVShow,
+    User,
+)
+from quering.partitions import add_months, maintain, month_start, months, partition_name, partitions
+from quering.rollups import ROLLUPS, next_period, period_of, refresh, refresh_all, runs
+from quering.synthetic import (
+    END,
+    SEASONS_PER_SHOW,
+    generate_chunk,
+    joined_at,
+    plan_chunks,
+    skewed_ids,
+    table_sizes,
+)
+
+UTC = datetime.timezone.utc
+
+
+class DefaultDatabaseTables:
+    """
+    The quering tables live in querydb (PostgreSQL), which the test run does
+    not create. Test cases using this mixin get the tables of their models
+    in the default test database instead, with routing turned off so the
+    ORM reaches them there.
+    """
+    models = ()
+
+    @classmethod
+    def setUpClass(cls):
+        # SQLite cannot change its schema inside the transaction TestCase opens
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            for model in reversed(cls.models):
+                editor.delete_model(model)
+
+
+# ---------------------------------------------------------------------
+# Catalog bulk import
+# ---------------------------------------------------------------------
+@override_settings(DATABASE_ROUTERS=[])
+class CatalogImportTest(DefaultDatabaseTables, TestCase):
+    models = (Genre, Actor, Movie, TVShow, Season, Episode, MovieCast, ShowCast)
+
+    def ndjson(self, *lines):
+        return io.StringIO('\n'.join(lines) + '\n')
+
+    def test_csv_records(self):
+        records = list(read_records(io.StringIO('title,genres,description\nAlien,Horror| Sci-Fi,\n'), 'csv'))
+        self.assertEqual(records, [(2, {'title': 'Alien', 'genres': ['Horror', 'Sci-Fi']})])
+
+    def test_movies_are_created_with_their_genres(self):
+        Genre.objects.create(name='Horror')
+        result = import_catalog('movie', self.ndjson(
+            '{"title": "Alien", "genres": ["Horror", "Sci-Fi"]}',
+            '{"title": "Heat", "genres": ["Crime"]}',
+        ))
+        self.assertEqual((result.created, result.failed, result.genres_created, result.genre_links), (2, 0, 2, 3))
+        alien = Movie.objects.get(title='Alien')
+        self.assertEqual(sorted(alien.genres.values_list('name', flat=True)), ['Horror', 'Sci-Fi'])
+
+    def test_unknown_genre_ids_are_rejected(self):
+        drama = Genre.objects.create(name='Drama')
+        result = import_catalog('movie', self.ndjson(
+            f'{{"title": "Dark City", "genres": [{drama.pk}, "Noir"]}}',
+            f'{{"title": "Brazil", "genres": [{drama.pk}, 999]}}',
+        ))
+        self.assertEqual((result.created, result.failed, result.genres_created, result.genre_links), (1, 1, 1, 2))
+        self.assertEqual(result.errors, [{'line': 2, 'errors': {'genres': ['Genre 999 does not exist']}}])
+        self.assertFalse(Movie.objects.filter(title='Brazil').exists())
+
+    def test_invalid_records_are_reported_by_line(self):
+        result = import_catalog('movie', self.ndjson(
+            '{"title": "Alien"}',
+            '{"title": "Heat", "release_year": "soon"}',
+            'not json',
+            '{"title": "Up", "colour": "red"}',
+        ))
+        self.assertEqual((result.received, result.created, result.failed), (4, 1, 3))
+        errors = {error['line']: error['errors'] for error in result.errors}
+        self.assertIn('release_year', errors[2])
+        self.assertIn('Invalid JSON', errors[3]['__all__'][0])
+        self.assertEqual(errors[4], {'colour': ['Unknown field']})
+
+    def test_foreign_keys_and_unique_values_are_checked_per_batch(self):
+        show = TVShow.objects.create(title='Dark')
+        drama = Genre.objects.create(name='Drama')
+        result = import_catalog('season', self.ndjson(
+            f'{{"show": {show.pk}, "season_number": 2}}',
+            '{"show_id": 999}',
+        ), batch_size=1)
+        self.assertEqual((result.created, result.failed), (1, 1))
+        self.assertEqual(result.errors[0]['errors'], {'show': ['TVShow 999 does not exist']})
+
+        result = import_catalog('genre', io.StringIO(f'id,name\n,Drama\n,Comedy\n,Comedy\n{drama.pk},Noir\n'), 'csv')
+        self.assertEqual((result.created, result.skipped, result.failed), (1, 2, 1))
+        self.assertEqual(result.errors[0]['errors'], {'id': [f'{drama.pk} already exists']})
+
+    def test_copy_needs_postgresql(self):
+        with self.assertRaises(ValueError):
+            CatalogImporter(Genre, method='copy')
+
+    def test_import_endpoint(self):
+        client = Client()
+        response = client.post('/query/import/genre/', 'name\nWestern\n', content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 1)
+        response = client.post('/query/import/genre/', 'nope\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['failed'], 1)
+        response = client.post('/query/import/genre/', '{"name": "Noir"}\nnope\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.json()['created'], response.json()['errors'][0]['line']), (1, 2))
+        response = client.post('/query/import/genre/', '', content_type='application/x-ndjson')
+        self.assertEqual((response.status_code, response.json()['received']), (200, 0))
+        response = client.post('/query/import/planet/', '{}\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Unknown model', response.json()['error'])
+
+    def test_import_catalog_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'genres.csv')
+            with open(path, 'w') as f:
+                f.write('name\nWestern\nWestern\n')
+            out = io.StringIO()
+            call_command('import_catalog', 'genre', path, stdout=out)
+            self.assertIn('genre: 1 created, 1 skipped, 0 failed of 2', out.getvalue())
+            with open(path, 'w') as f:
+                f.write('{"name": "Noir", "era": 1940}\n')
+            with self.assertRaises(CommandError):
+                call_command('import_catalog', 'genre', path, '--format', 'ndjson', stderr=io.StringIO())
+
+
+# ---------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------
+class SyntheticDataTest(SimpleTestCase):
+    def test_table_sizes(self):
+        sizes = table_sizes(0.001, {'tvshow': 5})
+        self.assertEqual(sizes['user'], 100)
+        self.assertEqual(sizes['season'], 5 * SEASONS_PER_SHOW)
+        with self.assertRaises(ValueError):
+            table_sizes(1, {'season': 5})
+
+    def test_skewed_ids(self):
+        rng = np.random.default_rng(0)
+        ids = skewed_ids(rng, 1000, 100_000, 4)
+        self.assertTrue(((ids >= 1) & (ids <= 1000)).all())
+        # The most popular 1% of ids take far more than 1% of the draws
+        counts = np.sort(np.bincount(ids))[::-1]
+        self.assertGreater(counts[:10].sum(), 0.2 * len(ids))
+
+    def test_chunks_follow_the_model_and_the_seed(self):
+        sizes = table_sizes(0.001)
+        chunk = generate_chunk('season', 1, 8, sizes)
+        self.assertEqual(chunk.column_names, [f.column for f in Season._meta.concrete_fields])
+        self.assertEqual(chunk['show_id'].to_pylist(), [1, 1, 1, 1, 2, 2, 2, 2])
+        self.assertTrue(generate_chunk('movie', 1, 50, sizes, seed=1).equals(generate_chunk('movie', 1, 50, sizes, seed=1)))
+        self.assertFalse(generate_chunk('movie', 1, 50, sizes, seed=1).equals(generate_chunk('movie', 1, 50, sizes, seed=2)))
+
+    def test_activity_is_consistent(self):
+        sizes = table_sizes(0.001)
+        chunk = generate_chunk('watchhistory', 1, 2000, sizes)
+        users = chunk['user_id'].to_numpy()
+        watched = chunk['watched_on'].cast(pa.int64()).to_numpy()
+        self.assertTrue(((users >= 1) & (users <= sizes['user'])).all())
+        self.assertTrue((watched > joined_at(users, sizes['user'])).all())
+        self.assertTrue((watched < END).all())
+        # Exactly one of movie and episode is set
+        self.assertEqual(chunk['movie_id'].null_count + chunk['episode_id'].null_count, 2000)
+
+    def test_title_genres_do_not_depend_on_chunking(self):
+        sizes = table_sizes(0.001)
+        whole = generate_chunk('movie_genres', 1, 12, sizes)
+        parts = pa.concat_tables([generate_chunk('movie_genres', start, 3, sizes) for start in (1, 4, 7, 10)])
+        self.assertEqual(whole.select(['movie_id', 'genre_id']), parts.select(['movie_id', 'genre_id']))
+        pairs = set(zip(whole['movie_id'].to_pylist(), whole['genre_id'].to_pylist()))
+        self.assertEqual(len(pairs), 12)
+
+    def test_chunks_cover_every_table_by_level(self):
+        sizes = table_sizes(0.001)
+        levels = plan_chunks(sizes, 1000)
+        self.assertEqual(list(levels), sorted(levels))
+        analytics = [chunk for chunk in levels[3] if chunk.table == 'analytics']
+        self.assertEqual([chunk.start for chunk in analytics], [1, 1001, 2001, 3001, 4001])
+        self.assertEqual(sum(chunk.count for chunk in analytics), sizes['analytics'])
+
+    def test_generate_data_needs_postgresql(self):
+        with self.assertRaisesMessage(CommandError, 'needs PostgreSQL'):
+            call_command('generate_data', '--scale', '0.001', '--database', 'default')
+        with self.assertRaises(CommandError):
+            call_command('generate_data', '--rows', 'season=5', '--database', 'default')
+
+
+# ---------------------------------------------------------------------
+# Monthly partitions
+# ---------------------------------------------------------------------
+class FakePartitionCursor:
+    """Answers maintain()'s catalog queries from a {table: [partition names]} mapping and records the rest"""
+
+    def __init__(self, existing, oldest=None, fail_on=None):
+        self.existing = existing
+        self.oldest = oldest
+        self.fail_on = fail_on
+        self.executed = []
+        self.rowcount = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params=None):
+        self.executed.append(statement)
+        if self.fail_on and self.fail_on in statement:
+            raise RuntimeError(f'failed: {statement}')
+        if 'pg_inherits' in statement:
+            self._rows = [(name,) for name in self.existing.get(params[0], [])]
+        elif statement.startswith('SELECT min('):
+            self._rows = [(self.oldest,)]
+        elif statement.startswith('WITH moved'):
+            self.rowcount = 7
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0]
+
+
+class FakeConnections:
+    alias = 'default'
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getitem__(self, alias):
+        return self
+
+    def cursor(self):
+        return self._cursor
+
+
+class PartitionTest(TestCase):
+    def maintain(self, cursor, **kwargs):
+        with patch('quering.partitions.connections', FakeConnections(cursor)):
+            return maintain(now=datetime.datetime(2024, 6, 15, tzinfo=UTC), **kwargs)
+
+    def existing(self, *months):
+        return {table: [partition_name(table, datetime.datetime(2024, month, 1, tzinfo=UTC)) for month in months]
+                + [f'{table}_default'] for table in ('quering_analytics', 'quering_watchhistory')}
+
+    def test_month_math(self):
+        self.assertEqual(add_months(datetime.datetime(2024, 11, 1, tzinfo=UTC), 3), datetime.datetime(2025, 2, 1, tzinfo=UTC))
+        self.assertEqual(add_months(datetime.datetime(2024, 1, 1, tzinfo=UTC), -1), datetime.datetime(2023, 12, 1, tzinfo=UTC))
+        # Month boundaries are UTC
+        local = datetime.datetime(2024, 3, 1, 0, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        self.assertEqual(month_start(local), datetime.datetime(2024, 2, 1, tzinfo=UTC))
+        self.assertEqual(month_start(datetime.date(2024, 3, 9)), datetime.datetime(2024, 3, 1, tzinfo=UTC))
+        self.assertEqual([month.month for month in months(datetime.date(2024, 11, 30), datetime.date(2025, 2, 1))],
+                         [11, 12, 1, 2])
+        self.assertEqual(partition_name('quering_analytics', datetime.date(2024, 3, 1)), 'quering_analytics_p2024_03')
+
+    def test_partitions_are_parsed_from_their_names(self):
+        cursor = FakePartitionCursor(self.existing(5, 6))
+        found = partitions(cursor, 'quering_analytics')
+        self.assertEqual(found, {
+            datetime.datetime(2024, 5, 1, tzinfo=UTC): 'quering_analytics_p2024_05',
+            datetime.datetime(2024, 6, 1, tzinfo=UTC): 'quering_analytics_p2024_06',
+        })
+
+    def test_months_ahead_are_created(self):
+        cursor = FakePartitionCursor(self.existing(6))
+        actions = self.maintain(cursor, months_ahead=2)
+        self.assertEqual(actions, [
+            ('create', 'quering_analytics', 'quering_analytics_p2024_07', 7),
+            ('create', 'quering_analytics', 'quering_analytics_p2024_08', 7),
+            ('create', 'quering_watchhistory', 'quering_watchhistory_p2024_07', 7),
+            ('create', 'quering_watchhistory', 'quering_watchhistory_p2024_08', 7),
+        ])
+
+    def test_default_partition_is_checked_before_attaching(self):
+        cursor = FakePartitionCursor(self.existing(6))
+        self.maintain(cursor, months_ahead=1)
+        ddl = [statement.split(' (')[0] for statement in cursor.executed if statement.startswith(('ALTER', 'CREATE'))]
+        self.assertEqual(ddl[:7], [
+            'ALTER TABLE quering_analytics_default ADD CONSTRAINT quering_analytics_default_2024_07_excluded CHECK',
+            'CREATE TABLE quering_analytics_p2024_07',
+            'ALTER TABLE quering_analytics_default VALIDATE CONSTRAINT quering_analytics_default_2024_07_excluded',
+            'ALTER TABLE quering_analytics_p2024_07 ADD CONSTRAINT quering_analytics_p2024_07_bounds CHECK',
+            'ALTER TABLE quering_analytics ATTACH PARTITION quering_analytics_p2024_07 FOR VALUES FROM',
+            'ALTER TABLE quering_analytics_p2024_07 DROP CONSTRAINT quering_analytics_p2024_07_bounds',
+            'ALTER TABLE quering_analytics_default DROP CONSTRAINT IF EXISTS quering_analytics_default_2024_07_excluded',
+        ])
+        self.assertTrue(next(statement for statement in cursor.executed if 'excluded CHECK' in statement).endswith('NOT VALID'))
+
+    def test_failed_partition_lifts_the_exclusion(self):
+        cursor = FakePartitionCursor(self.existing(6), fail_on='ATTACH PARTITION')
+        with self.assertRaises(RuntimeError):
+            self.maintain(cursor, months_ahead=1)
+        self.assertEqual(cursor.executed[-1], 'ALTER TABLE quering_analytics_default DROP CONSTRAINT IF EXISTS '
+                                              'quering_analytics_default_2024_07_excluded')
+
+    def test_retention_and_backfill(self):
+        cursor = FakePartitionCursor(self.existing(1, 2, 3, 6), oldest=datetime.datetime(2023, 12, 5, tzinfo=UTC))
+        actions = self.maintain(cursor, months_ahead=0, retention_months=3, backfill=True)
+        analytics = [(action, name) for action, table, name, rows in actions if table == 'quering_analytics']
+        # The cutoff is March: older months are dropped, none are backfilled before it
+        self.assertEqual(analytics, [
+            ('create', 'quering_analytics_p2024_04'),
+            ('create', 'quering_analytics_p2024_05'),
+            ('drop', 'quering_analytics_p2024_01'),
+            ('drop', 'quering_analytics_p2024_02'),
+        ])
+
+    def test_dry_run_changes_nothing(self):
+        cursor = FakePartitionCursor(self.existing())
+        actions = self.maintain(cursor, months_ahead=1, dry_run=True)
+        self.assertEqual(len(actions), 4)
+        self.assertFalse([statement for statement in cursor.executed if statement.startswith(('ALTER', 'CREATE', 'WITH'))])
+
+    def test_months_are_given_as_year_and_month(self):
+        with self.assertRaises(CommandError):
+            call_command('manage_partitions', '--from', '2024/01')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Partitioning needs PostgreSQL')
+@override_settings(DATABASE_ROUTERS=[])
+class PartitionMigrationTest(TransactionTestCase):
+    """
+    Migration 0002 and maintain() run for real, in a PostgreSQL default
+    test database. The router kept the quering tables out of it, though
+    their migrations were recorded, so they are unrecorded and applied
+    here, and rolled back to zero afterwards.
+    """
+
+    def setUp(self):
+        recorder = MigrationRecorder(connection)
+        applied = [name for app, name in recorder.applied_migrations() if app == 'quering']
+        for name in applied:
+            recorder.record_unapplied('quering', name)
+        self.addCleanup(lambda: [recorder.record_applied('quering', name) for name in applied])
+        self.addCleanup(self.migrate, 'zero')
+        self.migrate('0001_initial')
+        self.user = User.objects.create(username='viewer', email='viewer@example.com')
+
+    def migrate(self, target):
+        call_command('migrate', 'quering', target, database='default', verbosity=0)
+
+    def event(self, timestamp):
+        return Analytics.objects.create(user=self.user, event_type='Play', event_timestamp=timestamp).id
+
+    def relkind(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT relkind FROM pg_class WHERE oid = %s::regclass', [table])
+            return cursor.fetchone()[0]
+
+    def located(self):
+        """Which table or partition holds each analytics row"""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, tableoid::regclass::text FROM quering_analytics')
+            return dict(cursor.fetchall())
+
+    def test_rows_move_across_the_month_boundary_and_back(self):
+        last = self.event(datetime.datetime(2024, 1, 31, 23, 59, 59, 999999, tzinfo=UTC))
+        first = self.event(datetime.datetime(2024, 2, 1, tzinfo=UTC))
+
+        self.migrate('0002_partition_analytics_watchhistory')
+        self.assertEqual(self.relkind('quering_analytics'), 'p')
+        # The old table is the default partition; nothing is copied
+        self.assertEqual(self.located(), {last: 'quering_analytics_default', first: 'quering_analytics_default'})
+
+        maintain(start=datetime.date(2024, 1, 1), months_ahead=0, now=datetime.datetime(2024, 2, 15, tzinfo=UTC))
+        self.assertEqual(self.located(), {last: 'quering_analytics_p2024_01', first: 'quering_analytics_p2024_02'})
+        # Ids continue the old sequence and new rows go straight to their month
+        later = self.event(datetime.datetime(2024, 2, 29, tzinfo=UTC))
+        self.assertGreater(later, first)
+        self.assertEqual(self.located()[later], 'quering_analytics_p2024_02')
+
+        self.migrate('0001_initial')
+        self.assertEqual(self.relkind('quering_analytics'), 'r')
+        self.assertEqual(self.located(), {last: 'quering_analytics', first: 'quering_analytics',
+                                          later: 'quering_analytics'})
+        self.assertGreater(self.event(datetime.datetime(2024, 3, 1, tzinfo=UTC)), later)
+
+
+# ---------------------------------------------------------------------
+# Rollups
+# ---------------------------------------------------------------------
+class FakeRollupCursor:
+    """The source's max(id) and the periods of its new rows; DELETEs and INSERTs are recorded"""
+
+    def __init__(self, max_id, new_periods=()):
+        self.max_id = max_id
+        self.new_periods = new_periods
+        self.executed = []
+        self.rowcount = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, params=None):
+        self.executed.append((' '.join(statement.split()), params))
+        if 'max(id)' in statement:
+            self._rows = [(self.max_id,)]
+        elif statement.startswith('SELECT DISTINCT'):
+            self._rows = [(period,) for period in self.new_periods]
+        else:
+            self.rowcount = 3
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0]
+
+    def deleted(self):
+        return [params for statement, params in self.executed if statement.startswith('DELETE')]
+
+
+class RollupPeriodTest(SimpleTestCase):
+    def test_periods(self):
+        self.assertEqual(next_period(datetime.date(2024, 2, 28), 'day'), datetime.date(2024, 2, 29))
+        self.assertEqual(next_period(datetime.date(2024, 12, 1), 'month'), datetime.date(2025, 1, 1))
+        local = datetime.datetime(2024, 3, 1, 0, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        self.assertEqual(period_of(local, 'day'), datetime.date(2024, 2, 29))
+        self.assertEqual(period_of(local, 'month'), datetime.date(2024, 2, 1))
+
+    def test_consecutive_periods_are_merged(self):
+        days = [datetime.date(2024, 3, day) for day in (9, 1, 2, 3, 7, 8)]
+        self.assertEqual(runs(days, 'day'), [
+            (datetime.date(2024, 3, 1), datetime.date(2024, 3, 4)),
+            (datetime.date(2024, 3, 7), datetime.date(2024, 3, 10)),
+        ])
+        months = [datetime.date(2024, 12, 1), datetime.date(2025, 1, 1)]
+        self.assertEqual(runs(months, 'month'), [(datetime.date(2024, 12, 1), datetime.date(2025, 2, 1))])
+
+
+@override_settings(DATABASE_ROUTERS=[], QUERING_ROLLUPS={'SETTLE_DAYS': 2})
+class RollupRefreshTest(DefaultDatabaseTables, TestCase):
+    models = (RollupState,)
+    now = datetime.datetime(2024, 6, 10, 12, tzinfo=UTC)
+
+    def refresh(self, cursor, name='analytics_daily', **kwargs):
+        with patch('quering.rollups.connections', FakeConnections(cursor)):
+            return refresh(ROLLUPS[name], now=self.now, **kwargs)
+
+    def test_first_refresh_rebuilds(self):
+        cursor = FakeRollupCursor(max_id=40)
+        result = self.refresh(cursor)
+        self.assertEqual(cursor.executed[1], ('DELETE FROM quering_analytics_daily', None))
+        self.assertEqual((result.periods, result.rows, result.last_id), (None, 3, 40))
+        self.assertEqual(RollupState.objects.get(name='analytics_daily').last_id, 40)
+
+    def test_new_rows_and_the_settle_window_are_recomputed(self):
+        RollupState.objects.create(name='analytics_daily', last_id=10)
+        cursor = FakeRollupCursor(max_id=12, new_periods=[datetime.date(2024, 3, 5)])
+        result = self.refresh(cursor)
+        self.assertIn([10, 12], [params for _, params in cursor.executed])
+        self.assertEqual(cursor.deleted(), [
+            [datetime.date(2024, 3, 5), datetime.date(2024, 3, 6)],
+            [datetime.date(2024, 6, 8), datetime.date(2024, 6, 11)],
+        ])
+        inserted = [params for statement, params in cursor.executed if statement.startswith('INSERT')]
+        self.assertEqual(inserted[0], [datetime.datetime(2024, 3, 5, tzinfo=UTC), datetime.datetime(2024, 3, 6, tzinfo=UTC)])
+        self.assertEqual((result.periods, result.last_id), (4, 12))
+        self.assertEqual(RollupState.objects.get(name='analytics_daily').last_id, 12)
+
+    def test_no_new_rows_only_settles(self):
+        RollupState.objects.create(name='payment_monthly', last_id=12)
+        self.now = datetime.datetime(2024, 6, 1, 1, tzinfo=UTC)
+        cursor = FakeRollupCursor(max_id=12)
+        result = self.refresh(cursor, name='payment_monthly')
+        self.assertFalse([statement for statement, _ in cursor.executed if statement.startswith('SELECT DISTINCT')])
+        # The window reaches back into May
+        self.assertEqual(cursor.deleted(), [[datetime.date(2024, 5, 1), datetime.date(2024, 7, 1)]])
+        self.assertEqual(result.periods, 2)
+
+    def test_rebuild_ignores_the_mark(self):
+        RollupState.objects.create(name='analytics_daily', last_id=10)
+        cursor = FakeRollupCursor(max_id=12)
+        self.assertIsNone(self.refresh(cursor, rebuild=True).periods)
+        self.assertEqual(cursor.deleted(), [None])
+
+    def test_unknown_rollup(self):
+        with self.assertRaises(ValueError):
+            refresh_all(['hourly'])
+        with self.assertRaises(CommandError):
+            call_command('refresh_rollups', 'hourly')
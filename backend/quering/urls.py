@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import add_movie
+from .views import add_movie, bulk_import
 
 urlpatterns = [
     path('add/', add_movie, name='add_movie'),
+    path('import/<str:model>/', bulk_import, name='bulk_import'),
 ]
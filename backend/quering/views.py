@@ -1,6 +1,7 @@
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+from .bulk_import import import_catalog
 from .models import Movie
 from .serializers import MovieSerializer
 
@@ -15,3 +16,34 @@ def add_movie(request):
             serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _import_format(request):
+    # ?format= is taken by DRF's renderer negotiation, so the Content-Type decides
+    return 'csv' if 'csv' in request.content_type else 'ndjson'
+
+
+@api_view(['POST'])
+def bulk_import(request, model):
+    """
+    Import the records of one catalog model: CSV when the Content-Type
+    says so (text/csv), otherwise NDJSON. Answers 200 when every record
+    was imported or skipped, 207 when some were rejected and 400 when
+    nothing was imported, listing the rejected records by line.
+    """
+    import_format = _import_format(request)
+    batch_size = request.query_params.get('batch_size')
+    try:
+        batch_size = int(batch_size) if batch_size else None
+        encoding = request.encoding or 'utf-8'
+        # The body is read a line at a time, so a large file is never held in memory
+        lines = (line.decode(encoding) for line in request.stream or ())
+        result = import_catalog(model, lines, import_format, batch_size=batch_size)
+    except (ValueError, UnicodeDecodeError) as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    # Rows that failed are listed in the body: 207 when others were
+    # imported, 400 when none were
+    if result.failed:
+        return Response(result.as_dict(), status=status.HTTP_207_MULTI_STATUS if result.created
+                        else status.HTTP_400_BAD_REQUEST)
+    return Response(result.as_dict(), status=status.HTTP_200_OK)